@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Metabolite Annotation
+Assigns compound classes to feature names from the offline lookup table
+metabolite_annotations.csv. Exact and synonym matches go through a
+normalized-name hash index; names not in the table fall back to one
+set of compiled class patterns.
+"""
+
+import os
+import re
+import sys
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+ANNOTATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'metabolite_annotations.csv')
+
+AMINO_ACIDS = ('Ala|Arg|Asn|Asp|Cys|Gln|Glu|Gly|His|Ile|Leu|Lys|Met|Phe|Pro|'
+               'Ser|Thr|Trp|Tyr|Val')
+
+# Fallback rules in priority order: (class, regex, ignore case). Amino acid
+# and nucleotide codes are matched case-sensitively so "Glu" never hits
+# "Glucose"; ignore-case rules are written in lower case and run against a
+# lower-cased copy of the names, which is much faster than re.IGNORECASE.
+FALLBACK_PATTERNS = [
+    ('Peptide', rf'^(?:gamma-)?(?:{AMINO_ACIDS})(?:-(?:{AMINO_ACIDS}))+$', False),
+    ('Antioxidant', r'glutathione', True),
+    ('Lipid metabolism', r'\bCoA\b', False),
+    ('Lipid metabolism', r'carnitine|choline|cholic acid', True),
+    ('Nucleotide', r'^d?[ACGUTI][MDT]P\b', False),
+    ('Amino acid derivative', r'^N-Acetyl|^N\d?-Methyl', False),
+    ('Amino acid derivative', r'guanidino', True),
+    ('Nucleoside/base', r'(?:osine|idine)$', True),
+    ('Central carbon metabolism', r'(?:ose|itol) \d-phosphate$', True),
+    ('Amine/polyamine', r'spermi|amine$', True),
+    ('Organic acid', r'(?:ic acid|oate)$', True),
+]
+
+# Patterns are compiled in MULTILINE mode so each one scans a whole
+# newline-joined batch of names in a single C-level pass
+COMPILED_FALLBACK = [(compound_class, re.compile(pattern, re.MULTILINE), ignore_case)
+                     for compound_class, pattern, ignore_case in FALLBACK_PATTERNS]
+
+_ADDUCT = re.compile(r'_(?:divalent|\+H2O)$', re.IGNORECASE | re.MULTILINE)
+_STEREO = re.compile(r'^[LD]-', re.MULTILINE)
+# Same prefix as _STEREO after a newline; the leading literal lets re skip ahead
+_LINE_STEREO = re.compile(r'\n[LD]-')
+_NON_KEY = re.compile(r'[^a-z0-9+\n]')
+# Code points kept in a hash key: a-z, 0-9, "+" and the newline separator
+_KEY_CODES = np.zeros(128, dtype=bool)
+_KEY_CODES[[ord(c) for c in 'abcdefghijklmnopqrstuvwxyz0123456789+\n']] = True
+
+
+def normalize_name(name):
+    """Hash key for a metabolite name: no adduct tag, stereo prefix, case or punctuation"""
+    name = _ADDUCT.sub('', str(name).strip())
+    name = _STEREO.sub('', name)
+    return _NON_KEY.sub('', name.lower())
+
+
+def load_annotation_table(path=ANNOTATION_FILE):
+    """Read the offline name/synonym/class table"""
+    return pd.read_csv(path, keep_default_na=False)
+
+
+@lru_cache(maxsize=4)
+def build_name_index(path=ANNOTATION_FILE):
+    """Normalized names and synonyms (pd.Index) with the canonical name and class of each
+
+    Built once per table; the first entry wins when two aliases share a key.
+    """
+    table = load_annotation_table(path)
+    aliases = (table['Name'] + '|' + table['Synonyms']).str.split('|').explode()
+    aliases = aliases[aliases != '']
+    keys = normalize_names(aliases)
+    first = ~keys.duplicated().to_numpy()
+    rows = aliases.index.to_numpy()[first]
+    return (pd.Index(keys[first]), table['Name'].to_numpy(dtype=object)[rows],
+            table['Class'].to_numpy(dtype=object)[rows])
+
+
+def _join_names(names):
+    """One newline-separated text block, so a regex can scan all names at once"""
+    return '\n'.join(name.replace('\n', ' ') for name in names)
+
+
+def _line_starts(text):
+    """Character offset at which every line of text starts"""
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    return np.concatenate([[0], np.flatnonzero(codes == 10) + 1])
+
+
+def fallback_classes(names):
+    """Highest-priority fallback class per name (vectorized over a Series)"""
+    text = _ADDUCT.sub('', _join_names(names.tolist()))
+    starts = _line_starts(text)
+    lowered = text.lower()
+    best = np.full(len(names), len(COMPILED_FALLBACK))
+    for priority, (_, pattern, ignore_case) in enumerate(COMPILED_FALLBACK):
+        matches = pattern.finditer(lowered if ignore_case else text)
+        positions = np.fromiter((match.start() for match in matches),
+                                dtype=np.int64)
+        lines = np.searchsorted(starts, positions, side='right') - 1
+        np.minimum.at(best, lines, priority)
+    classes = np.array([compound_class for compound_class, _, _ in COMPILED_FALLBACK] + [None],
+                       dtype=object)
+    return pd.Series(classes[best], index=names.index)
+
+
+def _strip_lines(text):
+    """Newline-joined names with every line stripped, framed by a newline on each side"""
+    return '\n'.join(['', *(line.strip() for line in text.split('\n')), ''])
+
+
+def _line_keys(text):
+    """normalize_name of every line of a _strip_lines text, as a list
+
+    The whole text goes through each step once; punctuation is dropped with a
+    numpy mask over the code points instead of a regex.
+    """
+    text = _LINE_STEREO.sub('\n', _ADDUCT.sub('', text))
+    codes = np.frombuffer(text.lower().encode('utf-32-le'), dtype=np.uint32)
+    keep = (codes < len(_KEY_CODES)) & _KEY_CODES[np.minimum(codes, len(_KEY_CODES) - 1)]
+    return codes[keep].tobytes().decode('utf-32-le').split('\n')[1:-1]
+
+
+def normalize_names(names):
+    """Vectorized normalize_name over a Series of names"""
+    return pd.Series(_line_keys(_strip_lines(_join_names(names.tolist()))), index=names.index)
+
+
+def annotate_metabolites(names, path=ANNOTATION_FILE):
+    """Annotation table (Metabolite, Canonical_Name, Class, Match) for feature names"""
+    keys, canonical_names, table_classes = build_name_index(path)
+    names = pd.Index([str(name) for name in names])
+    codes, unique_names = pd.factorize(names.to_numpy())
+
+    # Ambiguous peaks such as "UDP-glucose ; UDP-galactose" list every candidate;
+    # each candidate becomes one line of a single text that is normalized at once
+    text = _strip_lines(_join_names(unique_names).replace(';', '\n'))
+    n_parts = np.array([name.count(';') for name in unique_names], dtype=np.int64) + 1
+    owners = np.repeat(np.arange(len(unique_names)), n_parts)
+    parts = np.array(text.split('\n')[1:-1], dtype=object)
+    candidate = parts != ''
+    positions = keys.get_indexer(_line_keys(text))
+    hits = candidate & (positions >= 0)
+    hit_owners, positions = owners[hits], positions[hits]
+    starts = np.flatnonzero(np.r_[True, hit_owners[1:] != hit_owners[:-1]])
+    canonical = canonical_names[positions[starts]]
+    bounds = np.r_[starts, len(positions)].tolist()
+    hit_names = canonical_names[positions].tolist()
+    for group in np.flatnonzero(np.diff(bounds) > 1).tolist():
+        canonical[group] = ' ; '.join(hit_names[bounds[group]:bounds[group + 1]])
+
+    resolved = pd.DataFrame({'Canonical_Name': canonical,
+                             'Class': table_classes[positions[starts]],
+                             'Match': 'table'}, index=hit_owners[starts])
+    resolved = resolved.reindex(np.arange(len(unique_names)))
+
+    # Only names missing from the table go through the pattern fallback
+    unresolved = candidate & resolved['Class'].isnull().to_numpy()[owners]
+    fallback = fallback_classes(pd.Series(parts[unresolved], index=owners[unresolved]))
+    fallback = fallback.dropna().groupby(level=0).first()
+    resolved.loc[fallback.index, 'Class'] = fallback
+    resolved.loc[fallback.index, 'Match'] = 'pattern'
+    resolved['Match'] = resolved['Match'].fillna('none')
+
+    annotations = resolved.take(codes).reset_index(drop=True)
+    annotations.insert(0, 'Metabolite', names)
+    return annotations
+
+
+def class_members(annotations):
+    """Class -> list of feature names, in input order"""
+    classified = annotations.dropna(subset=['Class'])
+    return {compound_class: group['Metabolite'].tolist()
+            for compound_class, group in classified.groupby('Class', sort=True)}
+
+
+def main():
+    """Annotate the columns of a dataset and save metabolite_annotation_results.csv"""
+    from metabolomics_analysis import load_data
+
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'fasting.csv'
+    data = load_data(filename)
+    if data is None:
+        return
+    annotations = annotate_metabolites(data.columns)
+    annotations.to_csv('metabolite_annotation_results.csv', index=False)
+    print(annotations['Match'].value_counts().to_string())
+    print(annotations['Class'].value_counts().to_string())
+    print("Annotations saved to metabolite_annotation_results.csv")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Batch-Effect Correction
+ComBat-style location/scale adjustment with empirical-Bayes shrinkage. The
+design only has batch and biological group, so every statistic ComBat needs
+comes from per-cell (batch x group) counts, sums and sums of squares taken
+in one pass over the data; the EB iteration then runs on small
+(batches x metabolites) arrays. Fitted parameters are saved so new samples
+from known batches get the same adjustment.
+"""
+
+import numpy as np
+import pandas as pd
+from linear_models import sample_groups
+
+# Column of sample_covariates.csv holding the batch label
+BATCH_COLUMN = 'batch'
+PARAMETER_FILE = 'batch_parameters.npz'
+# Convergence tolerance and iteration cap of the EB location/scale updates
+EB_TOLERANCE = 1e-4
+EB_MAX_ITER = 100
+# Metabolites per block of the summing pass; bounds the temporaries
+COLUMN_BLOCK = 2048
+
+
+def group_levels(samples):
+    """Biological groups preserved by the correction; the first is the reference"""
+    return sorted({group for group in sample_groups(samples) if group is not None})
+
+
+def group_codes(samples, levels):
+    """0 for the reference group (and unlabelled samples), i for levels[i]"""
+    groups = sample_groups(samples)
+    codes = np.zeros(len(groups), dtype=np.int64)
+    for i, level in enumerate(levels[1:], start=1):
+        codes[groups == level] = i
+    return codes
+
+
+def cell_sums(values, cells, n_cells, shift, block_size=COLUMN_BLOCK):
+    """Observed count, sum and sum of squares of (values - shift) per cell
+
+    Summing rows by cell is a product with the (cells x samples) indicator
+    matrix, which BLAS does faster than a grouped reduction.
+    """
+    indicator = np.zeros((n_cells, len(cells)))
+    indicator[cells, np.arange(len(cells))] = 1.0
+    n_features = values.shape[1]
+    counts, sums, squares = (np.empty((n_cells, n_features)) for _ in range(3))
+    for start in range(0, n_features, block_size):
+        block = slice(start, start + block_size)
+        shifted = values[:, block] - shift[block]
+        observed = ~np.isnan(shifted)
+        shifted[~observed] = 0.0
+        counts[:, block] = indicator @ observed.astype(np.float64)
+        sums[:, block] = indicator @ shifted
+        squares[:, block] = indicator @ (shifted * shifted)
+    return counts, sums, squares
+
+
+def solve_normal_equations(xtx, xty):
+    """Coefficients (k x p) from stacked (p x k x k) normal equations
+
+    Falls back to the pseudo-inverse when a metabolite is unobserved in a
+    whole batch and its system is singular.
+    """
+    try:
+        return np.linalg.solve(xtx, xty.T[:, :, None])[:, :, 0].T
+    except np.linalg.LinAlgError:
+        return np.einsum('pij,jp->ip', np.linalg.pinv(xtx), xty)
+
+
+def eb_shrinkage(gamma_hat, delta_hat, n_obs, tol=EB_TOLERANCE, max_iter=EB_MAX_ITER):
+    """Shrunken batch locations and scales (batches x features)
+
+    Normal prior on the locations and inverse-gamma prior on the scales are
+    fitted per batch by moments, then the coupled posterior means are
+    iterated to convergence. The squared deviations about a new location are
+    (n-1)*delta_hat + n*(gamma_hat - gamma)^2, so no pass over the data is
+    needed inside the loop.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        gamma_bar = np.nanmean(gamma_hat, axis=1, keepdims=True)
+        tau2 = np.nanvar(gamma_hat, axis=1, ddof=1, keepdims=True)
+        mean_delta = np.nanmean(delta_hat, axis=1, keepdims=True)
+        var_delta = np.nanvar(delta_hat, axis=1, ddof=1, keepdims=True)
+        a_prior = (2 * var_delta + mean_delta ** 2) / var_delta
+        b_prior = (mean_delta * var_delta + mean_delta ** 3) / var_delta
+
+    gamma, delta = gamma_hat.copy(), delta_hat.copy()
+    for iteration in range(max_iter):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            gamma_new = (tau2 * n_obs * gamma_hat + delta * gamma_bar) / (tau2 * n_obs + delta)
+            squares = (n_obs - 1) * delta_hat + n_obs * (gamma_hat - gamma_new) ** 2
+            delta_new = (b_prior + squares / 2) / (n_obs / 2 + a_prior - 1)
+            change = np.nanmax(np.abs(np.concatenate([gamma_new - gamma, delta_new - delta]))
+                               / np.abs(np.concatenate([gamma, delta])))
+        gamma, delta = gamma_new, delta_new
+        if not change > tol:
+            break
+    # Batches/features without enough data keep the unshrunk estimates
+    gamma = np.where(np.isfinite(gamma), gamma, np.nan_to_num(gamma_hat))
+    delta = np.where(np.isfinite(delta) & (delta > 0), delta, 1.0)
+    return gamma, delta, iteration + 1
+
+
+def fit_batch_correction(data, batches, preserve_groups=True):
+    """Estimate ComBat parameters; returns a dict of arrays"""
+    values = data.to_numpy(dtype=np.float64)
+    batches = pd.Series(batches, index=data.index).astype(str)
+    batch_levels = np.array(sorted(batches.unique()))
+    n_batches = len(batch_levels)
+    batch_codes = np.searchsorted(batch_levels, batches.to_numpy())
+    levels = group_levels(data.index) if preserve_groups else []
+    levels = levels if len(levels) > 1 else []
+    n_groups = max(len(levels), 1)
+
+    # Design row of every (batch, group) cell: batch one-hot + group indicators
+    cell_batch = np.repeat(np.arange(n_batches), n_groups)
+    cell_group = np.tile(np.arange(n_groups), n_batches)
+    cell_design = np.hstack([np.eye(n_batches)[cell_batch],
+                             np.eye(n_groups)[cell_group][:, 1:]])
+    cells = batch_codes * n_groups + group_codes(data.index, levels)
+
+    # Shifting by the column mean keeps the sums of squares well conditioned
+    with np.errstate(invalid='ignore'):
+        shift = np.nan_to_num(np.nanmean(values, axis=0))
+    counts, sums, squares = cell_sums(values, cells, len(cell_design), shift)
+
+    # Per-feature least squares from the cell sums (observed samples only)
+    xtx = np.einsum('cp,ci,cj->pij', counts, cell_design, cell_design)
+    coefficients = solve_normal_equations(xtx, cell_design.T @ sums)
+    fitted = cell_design @ coefficients
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var_pooled = np.maximum((squares - 2 * fitted * sums + counts * fitted ** 2).sum(axis=0)
+                                / counts.sum(axis=0), 0.0)
+
+    # Grand mean weighted by batch size; standardized moments per batch
+    weights = np.bincount(batch_codes, minlength=n_batches) / len(values)
+    grand_mean = weights @ coefficients[:n_batches]
+    group_effects = coefficients[n_batches:]
+    cell_mean = grand_mean + cell_design[:, n_batches:] @ group_effects
+    to_batch = np.eye(n_batches)[cell_batch].T
+    n_obs = to_batch @ counts
+    with np.errstate(invalid='ignore', divide='ignore'):
+        deviation = to_batch @ (sums - counts * cell_mean) / np.sqrt(var_pooled)
+        deviation_sq = (to_batch @ (squares - 2 * cell_mean * sums + counts * cell_mean ** 2)
+                        / var_pooled)
+        gamma_hat = deviation / n_obs
+        delta_hat = np.where(n_obs > 1, (deviation_sq - n_obs * gamma_hat ** 2) / (n_obs - 1),
+                             np.nan)
+
+    gamma_star, delta_star, n_iter = eb_shrinkage(gamma_hat, delta_hat, n_obs)
+    return {
+        'metabolites': data.columns.to_numpy(dtype=str),
+        'batches': batch_levels,
+        'groups': np.array(levels, dtype=str),
+        'grand_mean': grand_mean + shift,
+        'group_effects': group_effects,
+        'var_pooled': var_pooled,
+        'gamma_star': gamma_star,
+        'delta_star': delta_star,
+        'n_iter': n_iter,
+    }
+
+
+def apply_batch_correction(data, batches, params):
+    """Adjust samples of known batches with previously fitted parameters
+
+    Within one (batch, group) cell the ComBat adjustment is the same affine
+    map for every sample, so each cell is a single multiply-add.
+    """
+    data = data.reindex(columns=params['metabolites'])
+    batches = pd.Series(batches, index=data.index).astype(str).to_numpy()
+    unknown = sorted(set(batches) - set(params['batches']))
+    if unknown:
+        raise ValueError(f"No fitted parameters for batches: {unknown}")
+    batch_codes = np.searchsorted(params['batches'], batches)
+    codes = group_codes(data.index, list(params['groups']))
+
+    scale = np.sqrt(params['var_pooled'])
+    usable = scale > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Constant metabolites have nothing to adjust: slope 1, offset 0
+        slope = np.where(usable, 1 / np.sqrt(params['delta_star']), 1.0)
+        location = np.where(usable, params['gamma_star'] * scale * slope, 0.0)
+    effects = np.vstack([np.zeros(len(scale)), params['group_effects']])
+
+    values = data.to_numpy(dtype=np.float64)
+    adjusted = np.empty_like(values)
+    for batch, group in set(zip(batch_codes, codes)):
+        rows = (batch_codes == batch) & (codes == group)
+        stand_mean = params['grand_mean'] + effects[group]
+        offset = stand_mean * (1 - slope[batch]) - location[batch]
+        adjusted[rows] = values[rows] * slope[batch] + offset
+    return pd.DataFrame(adjusted, index=data.index, columns=data.columns)
+
+
+def save_batch_parameters(params, filename=PARAMETER_FILE):
+    """Write fitted parameters for reuse on new samples"""
+    np.savez_compressed(filename, **params)
+
+
+def load_batch_parameters(filename=PARAMETER_FILE):
+    """Read parameters written by save_batch_parameters"""
+    with np.load(filename, allow_pickle=False) as stored:
+        return {key: stored[key] for key in stored.files}
+
+
+def batch_correction(data, covariates=None, batch_column=BATCH_COLUMN,
+                     parameter_file=PARAMETER_FILE):
+    """Remove batch effects if batch labels are available; otherwise return data unchanged"""
+    if covariates is None or batch_column not in covariates.columns:
+        return data
+    print("\nCorrecting batch effects...")
+    batches = covariates[batch_column].reindex(data.index)
+    if batches.isnull().any():
+        print(f"Skipping: {int(batches.isnull().sum())} samples have no batch label")
+        return data
+    if batches.nunique() < 2:
+        print("Skipping: only one batch")
+        return data
+
+    params = fit_batch_correction(data, batches)
+    corrected = apply_batch_correction(data, batches, params)
+    if parameter_file:
+        save_batch_parameters(params, parameter_file)
+
+    sizes = batches.value_counts().sort_index()
+    print(f"Batches: {', '.join(f'{b} (n={n})' for b, n in sizes.items())}")
+    print(f"Empirical Bayes converged in {params['n_iter']} iterations")
+    if parameter_file:
+        print(f"Batch parameters saved to {parameter_file}")
+    return corrected
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Bootstrap Confidence Intervals
+Percentile bootstrap CIs for fasting/normal fold changes. Resample indices
+are drawn once as count matrices, group means for a block of metabolites
+are a single matrix product, and metabolite blocks run in a process pool.
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+N_BOOTSTRAP = 2000
+# Metabolites per worker task
+CHUNK_SIZE = 500
+
+
+def resample_counts(n_samples, n_boot, rng):
+    """B x n matrix: how often each sample appears in each bootstrap draw"""
+    draws = rng.integers(0, n_samples, size=(n_boot, n_samples))
+    counts = np.zeros((n_boot, n_samples))
+    np.add.at(counts, (np.arange(n_boot)[:, None], draws), 1)
+    return counts
+
+
+def bootstrap_means(counts, values):
+    """Resampled column means (B x p), skipping missing values"""
+    observed = ~np.isnan(values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (counts @ np.where(observed, values, 0.0)) / (counts @ observed)
+
+
+def _fold_change_chunk(args):
+    """Percentile CI of fasting/normal mean ratio for one metabolite block"""
+    normal_counts, fasting_counts, normal_block, fasting_block, alpha = args
+    normal_means = bootstrap_means(normal_counts, normal_block)
+    fasting_means = bootstrap_means(fasting_counts, fasting_block)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fold_change = np.where(normal_means > 0, fasting_means / normal_means, np.nan)
+    fold_change[~np.isfinite(fold_change)] = np.nan
+    return np.nanpercentile(fold_change, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+
+
+def bootstrap_fold_change_ci(normal_values, fasting_values, n_boot=N_BOOTSTRAP,
+                             alpha=0.05, chunk_size=CHUNK_SIZE, n_jobs=None, seed=0):
+    """Lower/upper CI of the fold change for every metabolite column
+
+    normal_values and fasting_values are (samples x metabolites) arrays with
+    NaN for missing values. Returns two arrays of length p.
+    """
+    normal_values = np.asarray(normal_values, dtype=np.float64)
+    fasting_values = np.asarray(fasting_values, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    normal_counts = resample_counts(normal_values.shape[0], n_boot, rng)
+    fasting_counts = resample_counts(fasting_values.shape[0], n_boot, rng)
+
+    n_features = normal_values.shape[1]
+    tasks = [(normal_counts, fasting_counts,
+              normal_values[:, start:start + chunk_size],
+              fasting_values[:, start:start + chunk_size], alpha)
+             for start in range(0, n_features, chunk_size)]
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if len(tasks) <= 1 or n_jobs == 1:
+        results = [_fold_change_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(tasks))) as pool:
+            results = list(pool.map(_fold_change_chunk, tasks))
+
+    if not results:
+        return np.array([]), np.array([])
+    bounds = np.concatenate(results, axis=1)
+    return bounds[0], bounds[1]
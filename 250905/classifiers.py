@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Normal vs Fasting Classifiers
+PLS-DA, L1 logistic regression and random forest with nested
+cross-validation and label-permutation significance. Fold splits are drawn
+once and the fitted preprocessing of every fold is cached, so all models
+and permutations reuse the same scaled matrices; (model, permutation)
+tasks run in parallel with joblib.
+"""
+
+from collections import Counter
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.cross_decomposition import PLSRegression
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold
+from linear_models import sample_groups
+
+N_OUTER_FOLDS = 5
+N_INNER_FOLDS = 3
+N_PERMUTATIONS = 100
+# Parallel workers for (model, permutation) tasks; -1 uses every core
+N_JOBS = -1
+CV_SEED = 0
+
+# Hyper-parameter grids tuned in the inner loop; a single candidate skips it
+PARAM_GRIDS = {
+    'PLS-DA': {'n_components': [1, 2, 3]},
+    'L1 logistic regression': {'C': [0.1, 1.0, 10.0]},
+    'Random forest': {'max_features': ['sqrt']},
+}
+# Used without an inner search when a training fold is too small to split
+DEFAULT_PARAMS = {
+    'PLS-DA': 2,
+    'L1 logistic regression': 1.0,
+    'Random forest': 'sqrt',
+}
+# Column of classifier_importance.csv filled by each model
+IMPORTANCE_COLUMNS = {
+    'PLS-DA': 'PLS_DA_VIP',
+    'L1 logistic regression': 'L1_Logistic_Abs_Coef',
+    'Random forest': 'RF_Importance',
+}
+
+
+def make_model(name, param):
+    """Unfitted estimator for one grid value"""
+    if name == 'PLS-DA':
+        return PLSRegression(n_components=param, scale=False)
+    if name == 'L1 logistic regression':
+        return LogisticRegression(l1_ratio=1, C=param, solver='liblinear')
+    if name == 'Random forest':
+        return RandomForestClassifier(n_estimators=100, max_features=param,
+                                      random_state=CV_SEED)
+    raise ValueError(f"Unknown model: {name}")
+
+
+def fit_predict(name, param, x_train, y_train, x_test):
+    """Fit on one split and return 0/1 predictions for the test rows"""
+    # Permuted labels can leave a training split with a single class
+    if np.all(y_train == y_train[0]):
+        return np.full(len(x_test), y_train[0])
+    if name == 'PLS-DA':
+        param = min(param, x_train.shape[0] - 1, x_train.shape[1])
+    model = make_model(name, param).fit(x_train, y_train)
+    if name == 'PLS-DA':
+        return (model.predict(x_test).ravel() > 0.5).astype(int)
+    return model.predict(x_test)
+
+
+def fit_preprocessing(x_train):
+    """Median imputation and autoscaling parameters from training rows only"""
+    median = np.nanmedian(x_train, axis=0)
+    median = np.where(np.isnan(median), 0.0, median)
+    filled = np.where(np.isnan(x_train), median, x_train)
+    std = filled.std(axis=0, ddof=1) if len(filled) > 1 else np.ones(filled.shape[1])
+    return median, filled.mean(axis=0), np.where(std > 0, std, 1.0)
+
+
+def apply_preprocessing(x, params):
+    """Impute and scale rows with fitted parameters"""
+    median, mean, std = params
+    return (np.where(np.isnan(x), median, x) - mean) / std
+
+
+def build_folds(values, labels, n_outer=N_OUTER_FOLDS, n_inner=N_INNER_FOLDS, seed=CV_SEED):
+    """Outer/inner splits with their preprocessed train/test matrices, computed once
+
+    Preprocessing does not look at labels, so every model and every
+    permutation reuses these matrices; the splits stay fixed while labels
+    are permuted.
+    """
+    cache = {}
+
+    def split(train, test):
+        key = train.tobytes()
+        if key not in cache:
+            cache[key] = fit_preprocessing(values[train])
+        return {'train': train, 'test': test,
+                'x_train': apply_preprocessing(values[train], cache[key]),
+                'x_test': apply_preprocessing(values[test], cache[key])}
+
+    folds = []
+    outer = StratifiedKFold(n_outer, shuffle=True, random_state=seed)
+    for train, test in outer.split(values, labels):
+        fold = split(train, test)
+        n_splits = min(n_inner, np.bincount(labels[train], minlength=2).min())
+        fold['inner'] = []
+        # A single minority sample cannot be stratified; models use DEFAULT_PARAMS
+        if n_splits >= 2:
+            inner = StratifiedKFold(n_splits, shuffle=True, random_state=seed)
+            fold['inner'] = [split(train[inner_train], train[inner_test])
+                             for inner_train, inner_test in inner.split(train, labels[train])]
+        folds.append(fold)
+    return folds
+
+
+def select_param(name, grid, inner_folds, labels):
+    """Grid value with the best inner-CV accuracy (DEFAULT_PARAMS without inner folds)"""
+    if not inner_folds:
+        return DEFAULT_PARAMS[name]
+    if len(grid) == 1:
+        return grid[0]
+    scores = [np.mean([np.mean(fit_predict(name, param, split['x_train'], labels[split['train']],
+                                           split['x_test']) == labels[split['test']])
+                       for split in inner_folds])
+              for param in grid]
+    return grid[int(np.argmax(scores))]
+
+
+def nested_cv(name, label_sets, folds):
+    """Outer-fold predictions for each label vector (the observed one and permutations)"""
+    (param_name, grid), = PARAM_GRIDS[name].items()
+    results = []
+    for labels in label_sets:
+        predictions = np.empty(len(labels), dtype=int)
+        chosen = []
+        for fold in folds:
+            param = select_param(name, grid, fold['inner'], labels)
+            predictions[fold['test']] = fit_predict(name, param, fold['x_train'],
+                                                    labels[fold['train']], fold['x_test'])
+            chosen.append(param)
+        results.append((predictions, chosen))
+    return results
+
+
+def balanced_accuracy(labels, predictions):
+    """Mean of the per-class recalls"""
+    return np.mean([np.mean(predictions[labels == c] == c) for c in np.unique(labels)])
+
+
+def vip_scores(pls):
+    """Variable importance in projection of a fitted PLSRegression"""
+    scores, weights, loadings = pls.x_scores_, pls.x_weights_, pls.y_loadings_
+    explained = np.sum(scores ** 2, axis=0) * np.sum(loadings ** 2, axis=0)
+    normalized = weights / np.linalg.norm(weights, axis=0)
+    return np.sqrt(weights.shape[0] * (normalized ** 2 @ explained) / explained.sum())
+
+
+def feature_importance(name, param, x, labels):
+    """VIP (PLS-DA), |coefficient| (L1 logistic) or impurity importance (forest)"""
+    if name == 'PLS-DA':
+        param = min(param, x.shape[0] - 1, x.shape[1])
+    model = make_model(name, param).fit(x, labels)
+    if name == 'PLS-DA':
+        return vip_scores(model)
+    if name == 'L1 logistic regression':
+        return np.abs(model.coef_.ravel())
+    return model.feature_importances_
+
+
+def classification_analysis(data, n_perm=N_PERMUTATIONS, n_jobs=N_JOBS, seed=CV_SEED):
+    """Nested-CV accuracy, permutation p-values and importance tables per model"""
+    print("\nRunning cross-validated classifiers...")
+    groups = sample_groups(data.index)
+    keep = pd.notnull(groups)
+    labels = (groups[keep] == 'Fasting').astype(int)
+    counts = np.bincount(labels, minlength=2)
+    if counts.min() < 2:
+        print("Need at least 2 normal and 2 fasting samples for cross-validation")
+        return None
+
+    values = data.loc[keep].to_numpy(dtype=np.float64)
+    n_outer = min(N_OUTER_FOLDS, counts.min())
+    folds = build_folds(values, labels, n_outer=n_outer, seed=seed)
+    if min(np.bincount(labels[fold['train']], minlength=2).min() for fold in folds) < 2:
+        print("Need at least 2 normal and 2 fasting samples in every training fold")
+        return None
+    print(f"{len(labels)} samples, {n_outer} outer x up to {N_INNER_FOLDS} inner folds, "
+          f"{n_perm} permutations")
+
+    rng = np.random.default_rng(seed)
+    label_sets = [labels] + [rng.permutation(labels) for _ in range(n_perm)]
+    chunk = max(1, len(label_sets) // 8)
+    chunks = [label_sets[i:i + chunk] for i in range(0, len(label_sets), chunk)]
+    tasks = [(name, block) for name in PARAM_GRIDS for block in chunks]
+    outputs = Parallel(n_jobs=n_jobs)(delayed(nested_cv)(name, block, folds)
+                                      for name, block in tasks)
+
+    performance = []
+    importance = pd.DataFrame({'Metabolite': data.columns})
+    x_all = apply_preprocessing(values, fit_preprocessing(values))
+    for name in PARAM_GRIDS:
+        results = [result for (task_name, _), output in zip(tasks, outputs)
+                   if task_name == name for result in output]
+        accuracies = np.array([np.mean(pred == lab) for (pred, _), lab in zip(results, label_sets)])
+        (predictions, chosen), observed = results[0], accuracies[0]
+        p_value = (1 + np.sum(accuracies[1:] >= observed)) / (1 + n_perm)
+
+        # Final model on all samples with the most often chosen parameter
+        (param_name, _), = PARAM_GRIDS[name].items()
+        best = Counter(chosen).most_common(1)[0][0]
+        importance[IMPORTANCE_COLUMNS[name]] = feature_importance(name, best, x_all, labels)
+
+        performance.append({
+            'Model': name,
+            'CV_Accuracy': observed,
+            'CV_Balanced_Accuracy': balanced_accuracy(labels, predictions),
+            'Permutation_P_Value': p_value,
+            'Best_Param': f"{param_name}={best}",
+            'N_Samples': len(labels),
+            'Outer_Folds': n_outer,
+            'Permutations': n_perm,
+        })
+
+    performance = pd.DataFrame(performance)
+    performance.to_csv('classifier_performance.csv', index=False)
+    importance = importance.sort_values('PLS_DA_VIP', ascending=False)
+    importance.to_csv('classifier_importance.csv', index=False)
+
+    for row in performance.itertuples():
+        print(f"  {row.Model}: accuracy {row.CV_Accuracy:.2f} "
+              f"(balanced {row.CV_Balanced_Accuracy:.2f}), permutation p={row.Permutation_P_Value:.3f}")
+    print("Classifier performance saved to classifier_performance.csv")
+    print("VIP / importance table saved to classifier_importance.csv")
+    return performance, importance
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Multi-Cohort Merge
+Streams the rows of many cohort CSVs into one aligned samples x metabolites
+matrix. Metabolite headers are interned into a persistent integer ID table
+(metabolite_ids.csv), every file's columns are mapped to matrix columns
+with one vectorized lookup, and rows are written chunk by chunk into a
+memory-mapped .npy file, so memory is bounded by the chunk size. The
+cohort, file and row of every sample go to merged_samples.csv. Headers of
+one file that intern to the same metabolite (synonyms, spelling variants)
+are coalesced to the first non-missing value and listed in merge_log.csv.
+Usage: python cohort_merge.py cohort1.csv cohort2.csv ... (or a directory)
+(paths are required; outputs of this module and of the main workflow are
+never merged as cohorts)
+"""
+
+import os
+import re
+import csv
+import sys
+import glob
+import numpy as np
+import pandas as pd
+
+METABOLITE_ID_FILE = 'metabolite_ids.csv'
+MERGED_MATRIX_FILE = 'merged_cohorts.npy'
+MERGED_SAMPLES_FILE = 'merged_samples.csv'
+MERGE_LOG_FILE = 'merge_log.csv'
+# Rows read per chunk of a cohort file
+CHUNK_ROWS = 5000
+# CSVs the analysis workflow writes next to its input; never cohorts
+WORKFLOW_OUTPUTS = {
+    'summary_statistics.csv', 'high_correlations.csv', 'correlation_modules.csv',
+    'correlation_edges.csv', 'feature_filter_report.csv', 'sample_qc.csv',
+    'differential_analysis_results.csv', 'linear_model_results.csv',
+    'classifier_performance.csv', 'classifier_importance.csv', 'enrichment_results.csv',
+    'embedding.csv', 'equivalence_report.csv', 'power_analysis.csv',
+    'power_by_metabolite.csv', 'metabolite_annotation_results.csv', 'sample_covariates.csv',
+}
+
+_SPACES = re.compile(r'\s+')
+_SEPARATOR = re.compile(r'\s*;\s*')
+
+
+def canonical_name(name):
+    """Interning key: trimmed name with single spaces and ' ; ' between alternatives"""
+    return _SEPARATOR.sub(' ; ', _SPACES.sub(' ', str(name).strip()))
+
+
+def load_metabolite_ids(filename=METABOLITE_ID_FILE):
+    """Name -> integer ID table of earlier merges (empty if none)"""
+    if not os.path.exists(filename):
+        return {}
+    table = pd.read_csv(filename, keep_default_na=False)
+    return dict(zip(table['Metabolite'], table['ID'].astype(int)))
+
+
+def save_metabolite_ids(ids, filename=METABOLITE_ID_FILE):
+    """Write the ID table in ID order"""
+    table = pd.DataFrame({'ID': list(ids.values()), 'Metabolite': list(ids.keys())})
+    table.sort_values('ID').to_csv(filename, index=False)
+
+
+def intern_names(names, ids):
+    """Integer IDs of the names, adding unseen names to the table"""
+    codes = np.empty(len(names), dtype=np.int64)
+    for position, name in enumerate(names):
+        key = canonical_name(name)
+        code = ids.get(key)
+        if code is None:
+            code = ids[key] = len(ids)
+        codes[position] = code
+    return codes
+
+
+def read_header(path):
+    """Separator (';' or ',') and metabolite names from the header line only"""
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        header = f.readline()
+    sep = ';' if header.count(';') > header.count(',') else ','
+    # pandas builds one empty column per name for nrows=0; csv just splits the line
+    names = next(csv.reader([header.rstrip('\r\n')], delimiter=sep))
+    return sep, names[1:]
+
+
+def count_rows(path):
+    """Data rows of a CSV without parsing values
+
+    Counts lines with any non-whitespace content, as pd.read_csv skips blank
+    and whitespace-only lines.
+    """
+    with open(path, 'rb') as f:
+        return sum(1 for line in f if not line.isspace()) - 1
+
+
+def scan_cohort(path):
+    """Separator, metabolite headers and row count of one file (no values parsed)"""
+    sep, columns = read_header(path)
+    return sep, columns, count_rows(path)
+
+
+def numeric_values(chunk):
+    """Chunk as a float array; text cells become NaN"""
+    try:
+        return chunk.to_numpy(dtype=np.float64)
+    except (ValueError, TypeError):
+        return chunk.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+
+
+def duplicate_headers(path, columns, codes, names_by_id):
+    """Merge-log rows for headers of one file that share a metabolite ID"""
+    unique, counts = np.unique(codes, return_counts=True)
+    return [{'Source_File': path, 'Metabolite_ID': int(code), 'Metabolite': names_by_id[code],
+             'Headers': ' | '.join(np.asarray(columns)[codes == code]),
+             'Resolution': 'first non-missing value in header order'}
+            for code in unique[counts > 1]]
+
+
+def coalesce_columns(values, codes):
+    """(unique codes, values with duplicate-code columns merged to the first non-NaN)"""
+    unique, first, counts = np.unique(codes, return_index=True, return_counts=True)
+    block = values[:, first]
+    for position in np.flatnonzero(counts > 1):
+        group = values[:, codes == unique[position]]
+        observed = ~np.isnan(group)
+        block[:, position] = group[np.arange(len(group)), np.argmax(observed, axis=1)]
+    return unique, block
+
+
+def cohort_files(paths):
+    """Expand directories and glob patterns into a sorted list of CSV files"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.csv'))))
+        else:
+            files.extend(sorted(glob.glob(path)) or [path])
+    # Never merge this module's own outputs or the workflow's result tables
+    outputs = {METABOLITE_ID_FILE, MERGED_SAMPLES_FILE, MERGE_LOG_FILE} | WORKFLOW_OUTPUTS
+    return [path for path in files if os.path.basename(path) not in outputs]
+
+
+def unique_sample_names(samples, cohorts):
+    """Sample names, prefixed with the cohort where a name occurs in several cohorts"""
+    samples = pd.Series(samples)
+    duplicated = samples.duplicated(keep=False).to_numpy()
+    return np.where(duplicated, pd.Series(cohorts) + ':' + samples, samples)
+
+
+def merge_cohorts(paths, matrix_file=MERGED_MATRIX_FILE, samples_file=MERGED_SAMPLES_FILE,
+                  id_file=METABOLITE_ID_FILE, chunk_rows=CHUNK_ROWS, log_file=MERGE_LOG_FILE):
+    """Align many cohort files on interned metabolite IDs into one matrix
+
+    Returns (memory-mapped matrix, sample provenance table, metabolite IDs of
+    the matrix columns).
+    """
+    print("\nMerging cohorts...")
+    files = cohort_files(paths)
+    ids = load_metabolite_ids(id_file)
+
+    # Pass 1: headers and row counts only, to size the output
+    scans = []
+    conflicts = []
+    for path in files:
+        sep, columns, n_rows = scan_cohort(path)
+        codes = intern_names(columns, ids)
+        scans.append((path, sep, codes, n_rows))
+        if len(np.unique(codes)) < len(codes):
+            names_by_id = {code: name for name, code in ids.items()}
+            conflicts.extend(duplicate_headers(path, columns, codes, names_by_id))
+    used = np.unique(np.concatenate([codes for _, _, codes, _ in scans] or [[]])).astype(np.int64)
+    column_of = np.full(len(ids), -1, dtype=np.int64)
+    column_of[used] = np.arange(len(used))
+    n_samples = sum(n_rows for *_, n_rows in scans)
+    print(f"{len(files)} files, {n_samples} samples, {len(used)} metabolites "
+          f"({len(ids)} known IDs)")
+
+    matrix = np.lib.format.open_memmap(matrix_file, mode='w+', dtype=np.float64,
+                                       shape=(n_samples, len(used)))
+    matrix[:] = np.nan
+
+    # Pass 2: stream values; each chunk is one fancy-indexed block assignment
+    provenance = []
+    row = 0
+    for path, sep, codes, n_rows in scans:
+        cohort = os.path.splitext(os.path.basename(path))[0]
+        samples = []
+        for chunk in pd.read_csv(path, sep=sep, index_col=0, chunksize=chunk_rows):
+            if row + len(chunk) > n_samples:
+                raise ValueError(f"{path} has more rows than its line count; "
+                                 "quoted line breaks are not supported")
+            unique, values = coalesce_columns(numeric_values(chunk), codes)
+            matrix[row:row + len(chunk), column_of[unique]] = values
+            samples.extend(chunk.index.astype(str))
+            row += len(chunk)
+        provenance.append(pd.DataFrame({
+            'Sample': samples,
+            'Cohort': cohort,
+            'Source_File': path,
+            'Source_Row': np.arange(len(samples)),
+        }))
+    matrix.flush()
+    if row != n_samples:
+        raise ValueError(f"Read {row} rows but counted {n_samples}; check for blank lines")
+
+    samples = pd.concat(provenance, ignore_index=True) if provenance else pd.DataFrame(
+        columns=['Sample', 'Cohort', 'Source_File', 'Source_Row'])
+    samples.insert(0, 'Merged_Sample', unique_sample_names(samples['Sample'], samples['Cohort']))
+    samples.to_csv(samples_file, index=False)
+    save_metabolite_ids(ids, id_file)
+    np.save(os.path.splitext(matrix_file)[0] + '_ids.npy', used)
+    pd.DataFrame(conflicts, columns=['Source_File', 'Metabolite_ID', 'Metabolite', 'Headers',
+                                     'Resolution']).to_csv(log_file, index=False)
+    if conflicts:
+        print(f"Warning: {len(conflicts)} metabolite(s) had several headers in one file "
+              f"and were coalesced; see {log_file}")
+        for conflict in conflicts[:10]:
+            print(f"  {os.path.basename(conflict['Source_File'])}: {conflict['Headers']}")
+
+    print(f"Merged matrix ({n_samples} x {len(used)}) saved to {matrix_file}")
+    print(f"Sample provenance saved to {samples_file}; metabolite IDs in {id_file}")
+    return matrix, samples, used
+
+
+def load_merged(matrix_file=MERGED_MATRIX_FILE, samples_file=MERGED_SAMPLES_FILE,
+                id_file=METABOLITE_ID_FILE, mmap_mode='r'):
+    """Merged matrix as a samples x metabolite-name DataFrame"""
+    matrix = np.load(matrix_file, mmap_mode=mmap_mode)
+    used = np.load(os.path.splitext(matrix_file)[0] + '_ids.npy')
+    names_by_id = {code: name for name, code in load_metabolite_ids(id_file).items()}
+    samples = pd.read_csv(samples_file, keep_default_na=False)
+    return pd.DataFrame(matrix, index=samples['Merged_Sample'].to_numpy(),
+                        columns=[names_by_id[code] for code in used])
+
+
+def main():
+    """python cohort_merge.py cohort1.csv cohort2.csv ... (or a directory)"""
+    if len(sys.argv) < 2:
+        print("Usage: python cohort_merge.py cohort1.csv cohort2.csv ... (or a directory)")
+        sys.exit(1)
+    merge_cohorts(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
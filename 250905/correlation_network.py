@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Correlation Network
+Thresholded metabolite correlations built block by block into a sparse CSR
+adjacency (no dense p x p matrix), plus module detection and GraphML /
+edge-list export. Spearman reuses the Pearson kernel on columns ranked
+once; partial correlations come from a shrinkage (Ledoit-Wolf) or sparse
+(graphical lasso) precision matrix.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from sklearn.covariance import GraphicalLasso
+from xml.sax.saxutils import escape
+from stats_utils import VARIANCE_EPS
+
+# Columns per block; memory per block pair is O(BLOCK_SIZE^2)
+BLOCK_SIZE = 1024
+# Default |r| cutoff per correlation method; partial correlations are much
+# smaller than marginal ones, so they need a lower cutoff
+CORRELATION_THRESHOLDS = {'pearson': 0.7, 'spearman': 0.7, 'partial': 0.3}
+# Precision-matrix estimator for partial correlations and the graphical
+# lasso penalty
+PARTIAL_ESTIMATOR = 'ledoit_wolf'
+GLASSO_ALPHA = 0.1
+
+
+def _block_sums(values, mask):
+    """Centered values with missing entries zeroed, and their squares"""
+    x = np.where(mask, values, 0.0)
+    return x, x * x
+
+
+def pearson_from_sums(n, sum_i, sum_j, sq_i, sq_j, cross):
+    """Pearson correlations from pairwise-complete count, sum, square and cross sums"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = cross - sum_i * sum_j / n
+        var_i = sq_i - sum_i ** 2 / n
+        var_j = sq_j - sum_j ** 2 / n
+        corr = cov / np.sqrt(var_i * var_j)
+    # Degenerate pairs (fewer than two shared rows or zero variance) are undefined
+    corr[(n < 2) | (var_i <= VARIANCE_EPS * sq_i) | (var_j <= VARIANCE_EPS * sq_j)] = np.nan
+    return np.clip(corr, -1, 1)
+
+
+def pearson_block(x_i, m_i, x_j, m_j):
+    """Pairwise-complete Pearson correlations between two column blocks
+
+    Matches DataFrame.corr(): each pair only uses rows where both columns
+    are observed. All sums are matrix products over the observation masks.
+    """
+    x_i, xx_i = _block_sums(x_i, m_i)
+    x_j, xx_j = _block_sums(x_j, m_j)
+    m_i = m_i.astype(np.float64)
+    m_j = m_j.astype(np.float64)
+    return pearson_from_sums(m_i.T @ m_j, x_i.T @ m_j, m_i.T @ x_j,
+                             xx_i.T @ m_j, m_i.T @ xx_j, x_i.T @ x_j)
+
+
+def center_columns(data):
+    """Column-mean centered values (missing as NaN) and the observation mask"""
+    values = data.to_numpy(dtype=np.float64)
+    mask = ~np.isnan(values)
+    # Centering by the column mean keeps the one-pass sums numerically stable
+    return values - np.nanmean(np.where(mask, values, np.nan), axis=0), mask
+
+
+def block_pairs(n_features, block_size=BLOCK_SIZE):
+    """(start_i, stop_i, start_j, stop_j) of every upper-triangle block pair"""
+    starts = range(0, n_features, block_size)
+    return [(start_i, min(start_i + block_size, n_features),
+             start_j, min(start_j + block_size, n_features))
+            for start_i in starts for start_j in starts if start_j >= start_i]
+
+
+def block_pair_edges(x_i, m_i, x_j, m_j, start_i, start_j, threshold, kernel=pearson_block):
+    """Global (rows, cols, weights) of the |r| > threshold pairs of one block pair"""
+    corr = kernel(x_i, m_i, x_j, m_j)
+    keep = np.abs(np.nan_to_num(corr)) > threshold
+    if start_i == start_j:
+        keep = np.triu(keep, k=1)
+    block_rows, block_cols = np.nonzero(keep)
+    return block_rows + start_i, block_cols + start_j, corr[block_rows, block_cols]
+
+
+def edges_to_adjacency(edges, n_features):
+    """Symmetric CSR adjacency from per-block-pair (rows, cols, weights) lists"""
+    edges = list(edges)
+    if edges:
+        rows, cols, weights = (np.concatenate(part) for part in zip(*edges))
+    else:
+        rows, cols, weights = np.array([], dtype=int), np.array([], dtype=int), np.array([])
+    upper = sparse.coo_matrix((weights, (rows, cols)), shape=(n_features, n_features))
+    return (upper + upper.T).tocsr()
+
+
+def threshold_correlations(data, threshold=0.7, block_size=BLOCK_SIZE,
+                           kernel=pearson_block):
+    """Sparse symmetric adjacency of correlations with |r| > threshold"""
+    values, mask = center_columns(data)
+    edges = [block_pair_edges(values[:, start_i:stop_i], mask[:, start_i:stop_i],
+                              values[:, start_j:stop_j], mask[:, start_j:stop_j],
+                              start_i, start_j, threshold, kernel)
+             for start_i, stop_i, start_j, stop_j in block_pairs(values.shape[1], block_size)]
+    return edges_to_adjacency(edges, values.shape[1])
+
+
+def adjacency_to_pairs(adjacency, names):
+    """high_correlations.csv layout from the upper triangle of the adjacency"""
+    upper = sparse.triu(adjacency, k=1).tocoo()
+    # Row-major order first so the stable sort reproduces the pairwise loop
+    order = np.lexsort((upper.col, upper.row))
+    rows, cols, weights = upper.row[order], upper.col[order], upper.data[order]
+    names = np.asarray(names, dtype=object)
+    pairs = pd.DataFrame({'Metabolite1': names[rows],
+                          'Metabolite2': names[cols],
+                          'Correlation': weights})
+    return pairs.sort_values('Correlation', key=abs, ascending=False,
+                             kind='stable').reset_index(drop=True)
+
+
+def rank_columns(data):
+    """Average ranks of every column (NaN stays NaN), computed once for Spearman
+
+    Ranks are taken over each column's observed values; with missing data
+    this differs slightly from DataFrame.corr('spearman'), which re-ranks
+    every pair over its shared rows.
+    """
+    return data.rank(method='average')
+
+
+def ledoit_wolf_shrinkage(values):
+    """(shrinkage intensity, target variance mu) of centered (n x p) values
+
+    Same estimate as sklearn's LedoitWolf(assume_centered=True), but it only
+    needs the row norms and the n x n Gram matrix instead of blocked p x p
+    products.
+    """
+    n_samples, n_features = values.shape
+    row_norms = np.einsum('ij,ij->i', values, values)
+    mu = row_norms.sum() / (n_samples * n_features)
+    frobenius = np.sum((values @ values.T) ** 2) / n_samples ** 2
+    beta = (np.sum(row_norms ** 2) / n_samples - frobenius) / (n_features * n_samples)
+    delta = (frobenius - 2 * mu * row_norms.sum() / n_samples
+             + n_features * mu ** 2) / n_features
+    shrinkage = 0.0 if beta == 0 else min(beta, delta) / delta
+    return shrinkage, mu
+
+
+def ledoit_wolf_covariance(values):
+    """Ledoit-Wolf shrinkage of the covariance of centered (n x p) values"""
+    shrinkage, mu = ledoit_wolf_shrinkage(values)
+    covariance = values.T @ values / values.shape[0]
+    covariance *= 1 - shrinkage
+    covariance[np.diag_indices(values.shape[1])] += shrinkage * mu
+    return covariance
+
+
+def partial_correlations(data, estimator=PARTIAL_ESTIMATOR, alpha=GLASSO_ALPHA):
+    """p x p partial correlations -P_ij / sqrt(P_ii P_jj) from a regularized precision
+
+    Missing values are median-imputed and columns autoscaled first; constant
+    columns get NaN.
+    """
+    values = data.to_numpy(dtype=np.float64)
+    values = np.where(np.isnan(values), np.nanmedian(values, axis=0), values)
+    std = values.std(axis=0, ddof=1)
+    usable = std > 0
+    scaled = (values[:, usable] - values[:, usable].mean(axis=0)) / std[usable]
+
+    if estimator == 'ledoit_wolf':
+        # The shrunk covariance is positive definite, so a plain inverse is enough
+        precision = np.linalg.inv(ledoit_wolf_covariance(scaled))
+    elif estimator == 'graphical_lasso':
+        precision = GraphicalLasso(alpha=alpha, max_iter=200).fit(scaled).precision_
+    else:
+        raise ValueError(f"Unknown precision estimator: {estimator}")
+
+    scale = np.sqrt(np.diag(precision))
+    partial = -precision / np.outer(scale, scale)
+    np.fill_diagonal(partial, 1.0)
+
+    full = np.full((len(usable), len(usable)), np.nan)
+    full[np.ix_(usable, usable)] = np.clip(partial, -1, 1)
+    return pd.DataFrame(full, index=data.columns, columns=data.columns)
+
+
+def dense_to_adjacency(matrix, threshold):
+    """Sparse symmetric adjacency of the |r| > threshold entries of a dense matrix"""
+    matrix = np.asarray(matrix, dtype=np.float64)
+    rows, cols = np.nonzero(np.triu(np.abs(np.nan_to_num(matrix)) > threshold, k=1))
+    upper = sparse.coo_matrix((matrix[rows, cols], (rows, cols)), shape=matrix.shape)
+    return (upper + upper.T).tocsr()
+
+
+def label_propagation(adjacency, max_iter=100, seed=0):
+    """Weighted label propagation on |r|; each step is one sparse product"""
+    n_nodes = adjacency.shape[0]
+    weights = abs(adjacency).tocsr()
+    # Self-loops damp the oscillations of synchronous updates
+    weights = weights + sparse.identity(n_nodes, format='csr') * 1e-6
+    # Tiny per-label jitter gives deterministic tie-breaking
+    jitter = np.random.default_rng(seed).random(n_nodes) * 1e-9
+    labels = np.arange(n_nodes)
+
+    for _ in range(max_iter):
+        membership = sparse.csr_matrix((np.ones(n_nodes), (np.arange(n_nodes), labels)),
+                                       shape=(n_nodes, n_nodes))
+        scores = (weights @ membership).tocsr()
+        scores.data = scores.data + jitter[scores.indices]
+        new_labels = np.asarray(scores.argmax(axis=1)).ravel()
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    _, labels = np.unique(labels, return_inverse=True)
+    return labels
+
+
+def modularity(adjacency, labels):
+    """Newman modularity of a partition on the |r|-weighted graph"""
+    weights = abs(adjacency).tocsr()
+    total = weights.sum()
+    if total == 0:
+        return 0.0
+    degree = np.asarray(weights.sum(axis=1)).ravel()
+    membership = sparse.csr_matrix((np.ones(len(labels)), (np.arange(len(labels)), labels)))
+    internal = (membership.T @ weights @ membership).diagonal().sum()
+    community_degree = membership.T @ degree
+    return float(internal / total - np.sum((community_degree / total) ** 2))
+
+
+def correlation_modules(adjacency, names):
+    """Connected components and label-propagation communities per metabolite"""
+    n_components, components = connected_components(adjacency, directed=False)
+    communities = label_propagation(adjacency)
+    degree = np.diff(adjacency.indptr)
+
+    modules = pd.DataFrame({'Metabolite': list(names),
+                            'Degree': degree,
+                            'Component': components,
+                            'Community': communities})
+    # Isolated metabolites are not part of any module
+    modules.loc[modules['Degree'] == 0, ['Component', 'Community']] = -1
+    return modules, n_components, modularity(adjacency, communities)
+
+
+def export_edge_list(adjacency, names, filename='correlation_edges.csv'):
+    """Write the upper-triangle edges as Source,Target,Correlation"""
+    pairs = adjacency_to_pairs(adjacency, names)
+    pairs.columns = ['Source', 'Target', 'Correlation']
+    pairs.to_csv(filename, index=False)
+
+
+def export_graphml(adjacency, names, filename='correlation_network.graphml', modules=None):
+    """Write the network as GraphML with correlation weights on the edges"""
+    upper = sparse.triu(adjacency, k=1).tocoo()
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+        f.write('  <key id="name" for="node" attr.name="name" attr.type="string"/>\n')
+        f.write('  <key id="community" for="node" attr.name="community" attr.type="int"/>\n')
+        f.write('  <key id="weight" for="edge" attr.name="correlation" attr.type="double"/>\n')
+        f.write('  <graph id="correlations" edgedefault="undirected">\n')
+        for i, name in enumerate(names):
+            community = ''
+            if modules is not None:
+                community = f'<data key="community">{int(modules["Community"].iloc[i])}</data>'
+            f.write(f'    <node id="n{i}"><data key="name">{escape(str(name))}</data>'
+                    f'{community}</node>\n')
+        for row, col, weight in zip(upper.row, upper.col, upper.data):
+            f.write(f'    <edge source="n{row}" target="n{col}">'
+                    f'<data key="weight">{weight:.6g}</data></edge>\n')
+        f.write('  </graph>\n</graphml>\n')
+
+
+def network_analysis(adjacency, names):
+    """Find co-regulated modules and export the correlation network"""
+    print("\nAnalyzing correlation network...")
+    modules, n_components, score = correlation_modules(adjacency, names)
+    modules.to_csv('correlation_modules.csv', index=False)
+    export_edge_list(adjacency, names, 'correlation_edges.csv')
+    export_graphml(adjacency, names, 'correlation_network.graphml', modules)
+
+    connected = modules[modules['Degree'] > 0]
+    print(f"Network: {len(connected)} connected metabolites, "
+          f"{adjacency.nnz // 2} edges")
+    print(f"Modules: {connected['Component'].nunique()} components, "
+          f"{connected['Community'].nunique()} communities (modularity {score:.3f})")
+    print("Network saved to correlation_network.graphml and correlation_edges.csv")
+    return modules
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""
+Static Results Dashboard
+Exports dashboard/index.html plus chunked data shards: paginated
+differential results, heatmap tiles pre-binned at several zoom levels and
+PCA scores thinned per zoom level. Shards are small .js files that hand
+their JSON to the page, so the dashboard opens from local disk (file://)
+without a server and only loads the pages and tiles on screen.
+"""
+
+import os
+import json
+import base64
+import shutil
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from linear_models import sample_groups
+
+DASHBOARD_DIR = 'dashboard'
+# Differential rows per page shard
+PAGE_SIZE = 500
+# Heatmap cells per tile side; coarser levels halve each axis until it fits one tile
+TILE_SIZE = 256
+# Heatmap colors cover z-scores in [-HEATMAP_CLIP, HEATMAP_CLIP]
+HEATMAP_CLIP = 3.0
+# PCA grid cells per axis at zoom level 0 (one point kept per cell); doubled per level
+PCA_GRID = 64
+PCA_MAX_LEVELS = 8
+
+
+def write_shard(output_dir, path, payload):
+    """Write data/<path> as a script that passes its payload to the page"""
+    full_path = os.path.join(output_dir, 'data', path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    text = json.dumps(payload, separators=(',', ':'), allow_nan=False)
+    with open(full_path, 'w') as f:
+        f.write(f"dashboardShard({json.dumps(path)},{text});\n")
+
+
+def json_values(frame):
+    """Rows of a DataFrame as JSON-safe lists (NaN -> null, 6 significant digits)"""
+    return json.loads(frame.to_json(orient='values', double_precision=6))
+
+
+def export_differential(ttest_df, output_dir, page_size=PAGE_SIZE):
+    """Differential results in p-value order, one shard per page plus a name list for search"""
+    table = ttest_df.sort_values('P_Value').reset_index(drop=True)
+    n_pages = max(1, -(-len(table) // page_size))
+    for page in range(n_pages):
+        rows = table.iloc[page * page_size:(page + 1) * page_size]
+        write_shard(output_dir, f'differential/page_{page}.js', {'rows': json_values(rows)})
+    write_shard(output_dir, 'differential/names.js',
+                {'names': table['Metabolite'].astype(str).tolist()})
+    return {'columns': table.columns.tolist(), 'n_rows': len(table),
+            'page_size': page_size, 'pages': n_pages}
+
+
+def heatmap_values(data):
+    """log2 concentrations z-scored per metabolite, most variable metabolites first"""
+    order = data.std().sort_values(ascending=False, kind='stable').index
+    values = np.log2(data[order].to_numpy(dtype=np.float64) + 1e-6)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nanmean(values, axis=0)
+        std = np.nanstd(values, axis=0, ddof=1)
+        scores = (values - mean) / np.where(std > 0, std, 1.0)
+    return scores, np.asarray(data.index, dtype=str), np.asarray(order, dtype=str)
+
+
+def halve(sums, counts, axis):
+    """Pairwise-sum neighbouring cells along one axis (odd sizes padded with empty cells)"""
+    if sums.shape[axis] % 2:
+        pad = [(0, 0), (0, 0)]
+        pad[axis] = (0, 1)
+        sums, counts = np.pad(sums, pad), np.pad(counts, pad)
+    shape = list(sums.shape)
+    shape[axis:axis + 1] = [shape[axis] // 2, 2]
+    return sums.reshape(shape).sum(axis=axis + 1), counts.reshape(shape).sum(axis=axis + 1)
+
+
+def bin_labels(labels, bin_size):
+    """Cell labels of one binned axis: the name, or 'first .. last (n)' for a bin"""
+    if bin_size == 1:
+        return labels.tolist()
+    return [f"{labels[i]} .. {labels[min(i + bin_size, len(labels)) - 1]} "
+            f"({min(bin_size, len(labels) - i)})" for i in range(0, len(labels), bin_size)]
+
+
+def quantize(means, clip=HEATMAP_CLIP):
+    """z-scores as bytes 0-254 over [-clip, clip]; 255 marks empty cells"""
+    scaled = np.round((np.clip(means, -clip, clip) + clip) / (2 * clip) * 254)
+    return np.where(np.isnan(means), 255, scaled).astype(np.uint8)
+
+
+def export_heatmap(data, output_dir, tile_size=TILE_SIZE):
+    """Heatmap tiles for every zoom level, from the finest (one cell per value) up"""
+    scores, row_names, col_names = heatmap_values(data)
+    observed = ~np.isnan(scores)
+    sums, counts = np.where(observed, scores, 0.0), observed.astype(np.float64)
+
+    # Binning steps each axis needs until it fits in one tile
+    steps = [max(0, int(np.ceil(np.log2(max(size, 1) / tile_size)))) for size in scores.shape]
+    n_levels = max(steps) + 1
+    levels = []
+    for z in range(n_levels - 1, -1, -1):
+        if z < n_levels - 1:
+            for axis in (0, 1):
+                if z < steps[axis]:
+                    sums, counts = halve(sums, counts, axis)
+        row_bin = 2 ** max(0, steps[0] - z)
+        col_bin = 2 ** max(0, steps[1] - z)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cells = quantize(sums / counts)
+        row_labels = bin_labels(row_names, row_bin)
+        col_labels = bin_labels(col_names, col_bin)
+        n_rows, n_cols = cells.shape
+        tiles_y, tiles_x = -(-n_rows // tile_size), -(-n_cols // tile_size)
+        for ty in range(tiles_y):
+            for tx in range(tiles_x):
+                rows = slice(ty * tile_size, (ty + 1) * tile_size)
+                cols = slice(tx * tile_size, (tx + 1) * tile_size)
+                tile = np.ascontiguousarray(cells[rows, cols])
+                write_shard(output_dir, f'heatmap/z{z}/{ty}_{tx}.js', {
+                    'rows': tile.shape[0], 'cols': tile.shape[1],
+                    'data': base64.b64encode(tile.tobytes()).decode('ascii'),
+                    'row_labels': row_labels[rows], 'col_labels': col_labels[cols],
+                })
+        levels.append({'z': z, 'rows': n_rows, 'cols': n_cols, 'row_bin': row_bin,
+                       'col_bin': col_bin, 'tiles_y': tiles_y, 'tiles_x': tiles_x})
+    return {'tile_size': tile_size, 'clip': HEATMAP_CLIP, 'levels': levels[::-1]}
+
+
+def thin_points(x, y, grid):
+    """Indices of one point per occupied cell of a grid x grid raster"""
+    def cell(values):
+        low, high = np.nanmin(values), np.nanmax(values)
+        span = high - low if high > low else 1.0
+        return np.minimum(((values - low) / span * grid).astype(int), grid - 1)
+    _, first = np.unique(cell(x) * grid + cell(y), return_index=True)
+    return np.sort(first)
+
+
+def export_pca(pca_df, output_dir, explained=None):
+    """PC1/PC2 scores thinned per zoom level; the last level holds every sample"""
+    x = pca_df['PC1'].to_numpy(dtype=np.float64)
+    y = pca_df['PC2'].to_numpy(dtype=np.float64) if 'PC2' in pca_df else np.zeros(len(x))
+    names = np.asarray(pca_df.index, dtype=str)
+    groups = pd.Series(sample_groups(pca_df.index)).fillna('Other').to_numpy()
+
+    levels = []
+    for z in range(PCA_MAX_LEVELS):
+        last = z == PCA_MAX_LEVELS - 1
+        keep = np.arange(len(x)) if last else thin_points(x, y, PCA_GRID * 2 ** z)
+        points = pd.DataFrame({'x': x[keep], 'y': y[keep], 'name': names[keep],
+                               'group': groups[keep]})
+        write_shard(output_dir, f'pca/level_{z}.js', {'points': json_values(points)})
+        levels.append({'z': z, 'n_points': len(keep)})
+        if len(keep) == len(x):
+            break
+    bounds = [float(np.nanmin(x)), float(np.nanmax(x)), float(np.nanmin(y)), float(np.nanmax(y))]
+    return {'levels': levels, 'bounds': bounds,
+            'explained': [float(v) for v in explained[:2]] if explained is not None else None}
+
+
+def export_dashboard(data, pca_df, ttest_df=None, explained=None, output_dir=DASHBOARD_DIR):
+    """Write the static dashboard page and all of its data shards"""
+    print("\nExporting dashboard...")
+    shutil.rmtree(os.path.join(output_dir, 'data'), ignore_errors=True)
+    manifest = {
+        'generated': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'n_samples': int(data.shape[0]),
+        'n_metabolites': int(data.shape[1]),
+        'differential': export_differential(ttest_df, output_dir) if ttest_df is not None else None,
+        'heatmap': export_heatmap(data, output_dir),
+        'pca': export_pca(pca_df, output_dir, explained),
+    }
+    write_shard(output_dir, 'manifest.js', manifest)
+    with open(os.path.join(output_dir, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write(DASHBOARD_PAGE)
+
+    n_tiles = sum(level['tiles_y'] * level['tiles_x'] for level in manifest['heatmap']['levels'])
+    print(f"Dashboard saved to {output_dir}/index.html "
+          f"({len(manifest['heatmap']['levels'])} heatmap levels, {n_tiles} tiles)")
+    return manifest
+
+
+DASHBOARD_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="UTF-8">
+<title>Metabolomics Dashboard</title>
+<style>
+    body { font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; color: #333; max-width: 1100px; margin: 0 auto; padding: 20px; }
+    h1 { color: #4a4a8a; }
+    h2 { border-bottom: 2px solid #667eea; padding-bottom: 4px; }
+    table { border-collapse: collapse; width: 100%; font-size: 13px; }
+    th, td { border-bottom: 1px solid #ddd; padding: 3px 6px; text-align: right; }
+    th:first-child, td:first-child { text-align: left; }
+    canvas { border: 1px solid #ccc; cursor: grab; display: block; margin-top: 6px; }
+    .controls { margin: 6px 0; }
+    .info { color: #666; font-size: 13px; margin-left: 8px; }
+</style>
+</head>
+<body>
+<h1>Metabolomics Dashboard</h1>
+<p id="summary" class="info"></p>
+
+<h2>Differential Results</h2>
+<div class="controls">
+    <input id="search" placeholder="Search metabolite">
+    <button id="prev">&lt;</button><button id="next">&gt;</button>
+    <span id="page" class="info"></span>
+</div>
+<table id="diff"><thead></thead><tbody></tbody></table>
+
+<h2>Concentration Heatmap</h2>
+<div class="controls">
+    <button id="heat-out">-</button><button id="heat-in">+</button>
+    <span id="heat-info" class="info"></span>
+</div>
+<canvas id="heatmap" width="1024" height="512"></canvas>
+<div id="heat-hover" class="info">&nbsp;</div>
+
+<h2>PCA</h2>
+<div class="controls">
+    <button id="pca-out">-</button><button id="pca-in">+</button>
+    <span id="pca-info" class="info"></span>
+</div>
+<canvas id="pca" width="720" height="480"></canvas>
+<div id="pca-hover" class="info">&nbsp;</div>
+
+<script>
+// Shards are <script> files calling dashboardShard(path, payload); works from file://
+const shards = {}, pending = {};
+function dashboardShard(path, payload) {
+    shards[path] = payload;
+    (pending[path] || []).forEach(resolve => resolve(payload));
+    delete pending[path];
+}
+function load(path) {
+    return new Promise(resolve => {
+        if (path in shards) return resolve(shards[path]);
+        if (pending[path]) return pending[path].push(resolve);
+        pending[path] = [resolve];
+        const script = document.createElement('script');
+        script.src = 'data/' + path;
+        document.head.appendChild(script);
+    });
+}
+const $ = id => document.getElementById(id);
+const escapeHtml = s => String(s).replace(/[&<>"]/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'}[c]));
+function format(v) {
+    if (v === null) return '';
+    if (typeof v !== 'number') return escapeHtml(v);
+    return v !== 0 && Math.abs(v) < 1e-3 ? v.toExponential(2) : v.toFixed(3);
+}
+let manifest;
+
+// Differential table: one page shard at a time; search loads the name list once
+let diffPage = 0;
+function renderRows(rows) {
+    $('diff').tBodies[0].innerHTML = rows.map(row =>
+        '<tr>' + row.map(v => '<td>' + format(v) + '</td>').join('') + '</tr>').join('');
+}
+async function showPage(page) {
+    const diff = manifest.differential;
+    diffPage = Math.max(0, Math.min(page, diff.pages - 1));
+    renderRows((await load(`differential/page_${diffPage}.js`)).rows);
+    $('page').textContent = `page ${diffPage + 1} / ${diff.pages} (${diff.n_rows} metabolites)`;
+}
+async function search(query) {
+    if (!query) return showPage(diffPage);
+    const diff = manifest.differential, names = (await load('differential/names.js')).names;
+    const q = query.toLowerCase(), hits = [];
+    for (let i = 0; i < names.length && hits.length < 50; i++)
+        if (names[i].toLowerCase().includes(q)) hits.push(i);
+    const rows = [];
+    for (const i of hits) {
+        const page = await load(`differential/page_${Math.floor(i / diff.page_size)}.js`);
+        rows.push(page.rows[i % diff.page_size]);
+    }
+    renderRows(rows);
+    $('page').textContent = `${hits.length}${hits.length === 50 ? '+' : ''} matches`;
+}
+
+// Heatmap: the view is one canvas of cells at the current level; only visible tiles load
+const heat = {z: 0, x: 0, y: 0};
+function heatColor(q) {
+    if (q === 255) return [235, 235, 235];
+    const t = q / 127 - 1, w = 1 - Math.abs(t);
+    return t < 0 ? [Math.round(255 * w + 33 * -t), Math.round(255 * w + 102 * -t), Math.round(255 * w + 172 * -t)]
+                 : [Math.round(255 * w + 178 * t), Math.round(255 * w + 24 * t), Math.round(255 * w + 43 * t)];
+}
+function heatLayout() {
+    const level = manifest.heatmap.levels[heat.z], canvas = $('heatmap'), T = manifest.heatmap.tile_size;
+    const cols = Math.min(level.cols, T), rows = Math.min(level.rows, T);
+    heat.x = Math.max(0, Math.min(heat.x, level.cols - cols));
+    heat.y = Math.max(0, Math.min(heat.y, level.rows - rows));
+    return {level, cols, rows, cw: canvas.width / cols, ch: canvas.height / rows};
+}
+async function drawHeatmap() {
+    const {level, cols, rows} = heatLayout(), T = manifest.heatmap.tile_size, z = heat.z;
+    const x0 = Math.floor(heat.x), y0 = Math.floor(heat.y);
+    const image = new ImageData(cols, rows), tiles = [];
+    for (let ty = Math.floor(y0 / T); ty <= Math.floor((y0 + rows - 1) / T); ty++)
+        for (let tx = Math.floor(x0 / T); tx <= Math.floor((x0 + cols - 1) / T); tx++)
+            tiles.push(load(`heatmap/z${z}/${ty}_${tx}.js`).then(tile => [ty, tx, tile]));
+    for (const [ty, tx, tile] of await Promise.all(tiles)) {
+        const bytes = atob(tile.data);
+        for (let r = 0; r < tile.rows; r++) {
+            const y = ty * T + r - y0;
+            if (y < 0 || y >= rows) continue;
+            for (let c = 0; c < tile.cols; c++) {
+                const x = tx * T + c - x0;
+                if (x < 0 || x >= cols) continue;
+                const [red, green, blue] = heatColor(bytes.charCodeAt(r * tile.cols + c)), i = 4 * (y * cols + x);
+                image.data[i] = red; image.data[i + 1] = green; image.data[i + 2] = blue; image.data[i + 3] = 255;
+            }
+        }
+    }
+    if (z !== heat.z) return;
+    const buffer = document.createElement('canvas');
+    buffer.width = cols; buffer.height = rows;
+    buffer.getContext('2d').putImageData(image, 0, 0);
+    const ctx = $('heatmap').getContext('2d');
+    ctx.imageSmoothingEnabled = false;
+    ctx.clearRect(0, 0, ctx.canvas.width, ctx.canvas.height);
+    ctx.drawImage(buffer, 0, 0, ctx.canvas.width, ctx.canvas.height);
+    $('heat-info').textContent = `level ${z + 1}/${manifest.heatmap.levels.length}: ` +
+        `${level.col_bin} metabolite(s) x ${level.row_bin} sample(s) per cell, ` +
+        `columns ${x0 + 1}-${x0 + cols} of ${level.cols} (drag to pan, z-scores clipped at ` +
+        `±${manifest.heatmap.clip})`;
+}
+function zoomHeatmap(step) {
+    const levels = manifest.heatmap.levels, z = Math.max(0, Math.min(heat.z + step, levels.length - 1));
+    if (z === heat.z) return;
+    const {cols, rows} = heatLayout(), old = levels[heat.z], next = levels[z];
+    const cx = (heat.x + cols / 2) * old.col_bin / next.col_bin, cy = (heat.y + rows / 2) * old.row_bin / next.row_bin;
+    heat.z = z;
+    const view = heatLayout();
+    heat.x = cx - view.cols / 2; heat.y = cy - view.rows / 2;
+    drawHeatmap();
+}
+async function hoverHeatmap(event) {
+    const {cw, ch} = heatLayout(), T = manifest.heatmap.tile_size;
+    const x = Math.floor(heat.x) + Math.floor(event.offsetX / cw), y = Math.floor(heat.y) + Math.floor(event.offsetY / ch);
+    const tile = shards[`heatmap/z${heat.z}/${Math.floor(y / T)}_${Math.floor(x / T)}.js`];
+    if (!tile || y % T >= tile.rows || x % T >= tile.cols) return;
+    const q = atob(tile.data).charCodeAt((y % T) * tile.cols + x % T), clip = manifest.heatmap.clip;
+    $('heat-hover').textContent = `${tile.row_labels[y % T]} | ${tile.col_labels[x % T]} | z = ` +
+        (q === 255 ? 'missing' : (q / 254 * 2 * clip - clip).toFixed(2));
+}
+
+// PCA: each zoom level loads a denser thinned point set
+const pca = {z: 0, cx: 0, cy: 0, points: []};
+const GROUP_COLORS = {Normal: '#1f77b4', Fasting: '#d62728', Other: '#7f7f7f'};
+function pcaTransform() {
+    const [x0, x1, y0, y1] = manifest.pca.bounds, canvas = $('pca'), zoom = 2 ** pca.z;
+    const sx = canvas.width * 0.9 * zoom / ((x1 - x0) || 1), sy = canvas.height * 0.9 * zoom / ((y1 - y0) || 1);
+    return [x => canvas.width / 2 + (x - pca.cx) * sx, y => canvas.height / 2 - (y - pca.cy) * sy, sx, sy];
+}
+async function drawPca() {
+    const levels = manifest.pca.levels, level = levels[Math.min(pca.z, levels.length - 1)];
+    pca.points = (await load(`pca/level_${level.z}.js`)).points;
+    const [tx, ty] = pcaTransform(), ctx = $('pca').getContext('2d');
+    ctx.clearRect(0, 0, ctx.canvas.width, ctx.canvas.height);
+    for (const [x, y, name, group] of pca.points) {
+        ctx.fillStyle = GROUP_COLORS[group] || GROUP_COLORS.Other;
+        ctx.beginPath(); ctx.arc(tx(x), ty(y), 4, 0, 2 * Math.PI); ctx.fill();
+    }
+    const explained = manifest.pca.explained;
+    $('pca-info').textContent = `zoom x${2 ** pca.z}, ${pca.points.length} of ${manifest.n_samples} samples shown` +
+        (explained ? ` | PC1 ${(100 * explained[0]).toFixed(1)}%, PC2 ${(100 * explained[1]).toFixed(1)}%` : '') +
+        ' (drag to pan)';
+}
+function hoverPca(event) {
+    const [tx, ty] = pcaTransform();
+    let best = null, bestDistance = 64;
+    for (const point of pca.points) {
+        const d = (tx(point[0]) - event.offsetX) ** 2 + (ty(point[1]) - event.offsetY) ** 2;
+        if (d < bestDistance) { best = point; bestDistance = d; }
+    }
+    $('pca-hover').textContent = best ? `${best[2]} (${best[3]}): PC1 ${best[0].toFixed(2)}, PC2 ${best[1].toFixed(2)}` : ' ';
+}
+
+function draggable(canvas, onDrag, onHover) {
+    let last = null;
+    canvas.addEventListener('mousedown', e => { last = [e.offsetX, e.offsetY]; });
+    window.addEventListener('mouseup', () => { last = null; });
+    canvas.addEventListener('mousemove', e => {
+        if (!last) return onHover(e);
+        onDrag(e.offsetX - last[0], e.offsetY - last[1]);
+        last = [e.offsetX, e.offsetY];
+    });
+}
+
+load('manifest.js').then(m => {
+    manifest = m;
+    $('summary').textContent = `${m.n_samples} samples x ${m.n_metabolites} metabolites, generated ${m.generated}`;
+    if (m.differential) {
+        $('diff').tHead.innerHTML = '<tr>' + m.differential.columns.map(c => `<th>${escapeHtml(c)}</th>`).join('') + '</tr>';
+        showPage(0);
+        $('prev').onclick = () => showPage(diffPage - 1);
+        $('next').onclick = () => showPage(diffPage + 1);
+        $('search').oninput = e => search(e.target.value.trim());
+    }
+    drawHeatmap();
+    $('heat-in').onclick = () => zoomHeatmap(1);
+    $('heat-out').onclick = () => zoomHeatmap(-1);
+    draggable($('heatmap'), (dx, dy) => {
+        const {cw, ch} = heatLayout();
+        heat.x -= dx / cw; heat.y -= dy / ch;
+        drawHeatmap();
+    }, hoverHeatmap);
+
+    pca.cx = (m.pca.bounds[0] + m.pca.bounds[1]) / 2;
+    pca.cy = (m.pca.bounds[2] + m.pca.bounds[3]) / 2;
+    drawPca();
+    $('pca-in').onclick = () => { pca.z = Math.min(pca.z + 1, 10); drawPca(); };
+    $('pca-out').onclick = () => { pca.z = Math.max(pca.z - 1, 0); drawPca(); };
+    draggable($('pca'), (dx, dy) => {
+        const [, , sx, sy] = pcaTransform();
+        pca.cx -= dx / sx; pca.cy += dy / sy;
+        drawPca();
+    }, hoverPca);
+});
+</script>
+</body>
+</html>
+"""
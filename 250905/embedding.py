@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Nonlinear Sample Embedding
+UMAP / t-SNE layouts of the PCA scores on top of one cached k-nearest-
+neighbour graph. The graph is built once (pynndescent when installed,
+exact sklearn search otherwise), stored in knn_graph.npz keyed by the
+scores, and reused for every layout, for kNN imputation and for the
+neighbour-distance QC score.
+"""
+
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from scipy import sparse
+from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors
+from plotting import pca_scatter
+from sample_qc import robust_z
+
+try:
+    from pynndescent import NNDescent
+except ImportError:
+    NNDescent = None
+
+try:
+    import umap
+except ImportError:
+    umap = None
+
+# 'umap' (falls back to t-SNE when umap-learn is missing) or 'tsne'
+EMBEDDING_METHOD = 'umap'
+# Leading principal components used as the embedding input
+EMBED_COMPONENTS = 50
+# Neighbours stored in the graph; enough for t-SNE perplexity 30 (3 x 30)
+N_NEIGHBORS = 90
+UMAP_NEIGHBORS = 15
+UMAP_MIN_DIST = 0.1
+TSNE_PERPLEXITY = 30
+KNN_CACHE_FILE = 'knn_graph.npz'
+
+
+def graph_key(scores, n_neighbors):
+    """Cache key of a kNN graph: the scores it was built on and k"""
+    digest = hashlib.sha1(np.ascontiguousarray(scores, dtype=np.float64).tobytes())
+    digest.update(f"{scores.shape}:{n_neighbors}".encode())
+    return digest.hexdigest()
+
+
+def _drop_self(indices, distances):
+    """Remove each point from its own neighbour list (or the farthest if absent)"""
+    n_points = len(indices)
+    is_self = indices == np.arange(n_points)[:, None]
+    is_self[~is_self.any(axis=1), -1] = True
+    keep = ~is_self
+    width = indices.shape[1] - 1
+    return indices[keep].reshape(n_points, width), distances[keep].reshape(n_points, width)
+
+
+def build_knn_graph(scores, n_neighbors=N_NEIGHBORS, seed=0):
+    """(indices, distances) of the k nearest other samples, sorted by distance"""
+    if NNDescent is not None:
+        index = NNDescent(scores, n_neighbors=n_neighbors + 1, random_state=seed)
+        return _drop_self(*index.neighbor_graph)
+    # Without pynndescent: exact search; kneighbors() without X skips the point itself
+    distances, indices = NearestNeighbors(n_neighbors=n_neighbors).fit(scores).kneighbors()
+    return indices, distances
+
+
+def knn_graph(scores, n_neighbors=N_NEIGHBORS, cache_file=KNN_CACHE_FILE):
+    """Cached kNN graph; rebuilt only when the scores or k change"""
+    n_neighbors = min(n_neighbors, len(scores) - 1)
+    key = graph_key(scores, n_neighbors)
+    if cache_file and os.path.exists(cache_file):
+        with np.load(cache_file, allow_pickle=False) as cached:
+            if str(cached['key']) == key:
+                print(f"Reusing kNN graph from {cache_file}")
+                return cached['indices'], cached['distances']
+
+    indices, distances = build_knn_graph(scores, n_neighbors)
+    if cache_file:
+        np.savez_compressed(cache_file, key=key, indices=indices, distances=distances)
+        print(f"kNN graph ({n_neighbors} neighbours) saved to {cache_file}")
+    return indices, distances
+
+
+def distance_matrix(indices, distances, n_neighbors=None):
+    """Sparse n x n matrix of the first n_neighbors graph distances, rows sorted by distance"""
+    n_neighbors = n_neighbors or indices.shape[1]
+    n_points = len(indices)
+    indptr = np.arange(n_points + 1) * n_neighbors
+    return sparse.csr_matrix((distances[:, :n_neighbors].ravel(),
+                              indices[:, :n_neighbors].ravel(), indptr),
+                             shape=(n_points, n_points))
+
+
+def umap_layout(scores, indices, distances, n_neighbors=UMAP_NEIGHBORS,
+                min_dist=UMAP_MIN_DIST, seed=0):
+    """UMAP on the precomputed graph (umap-learn's own neighbour lists include self)"""
+    n_neighbors = min(n_neighbors, indices.shape[1] + 1)
+    self_index = np.arange(len(indices))[:, None]
+    knn = (np.hstack([self_index, indices])[:, :n_neighbors],
+           np.hstack([np.zeros((len(indices), 1)), distances])[:, :n_neighbors])
+    model = umap.UMAP(n_neighbors=n_neighbors, min_dist=min_dist, random_state=seed,
+                      precomputed_knn=knn + (None,))
+    return model.fit_transform(scores)
+
+
+def tsne_layout(indices, distances, perplexity=TSNE_PERPLEXITY, seed=0):
+    """Barnes-Hut t-SNE on the sparse graph distances (3 x perplexity neighbours)"""
+    perplexity = max(1.0, min(perplexity, (indices.shape[1] - 1) / 3))
+    n_neighbors = min(indices.shape[1], int(3 * perplexity) + 1)
+    # sklearn expects every sample's own (zero) distance as the first entry
+    self_index = np.arange(len(indices))[:, None]
+    graph = distance_matrix(np.hstack([self_index, indices]),
+                            np.hstack([np.zeros((len(indices), 1)), distances]),
+                            n_neighbors + 1)
+    model = TSNE(perplexity=perplexity, metric='precomputed', init='random',
+                 random_state=seed)
+    return model.fit_transform(graph)
+
+
+def knn_impute(data, indices):
+    """Fill missing values with the mean of the observed graph neighbours
+
+    One sparse (samples x samples) @ (samples x metabolites) product for all
+    metabolites; values with no observed neighbour stay missing.
+    """
+    n_points, n_neighbors = indices.shape
+    neighbours = sparse.csr_matrix((np.ones(indices.size), indices.ravel(),
+                                    np.arange(n_points + 1) * n_neighbors),
+                                   shape=(n_points, n_points))
+    values = data.to_numpy(dtype=np.float64)
+    observed = ~np.isnan(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (neighbours @ np.where(observed, values, 0.0)) / (neighbours @ observed)
+    return pd.DataFrame(np.where(observed, values, means), index=data.index, columns=data.columns)
+
+
+def knn_outlier_scores(distances):
+    """Mean distance to the graph neighbours and its robust z-score"""
+    mean_distance = distances.mean(axis=1)
+    return mean_distance, robust_z(mean_distance)
+
+
+def embedding_analysis(pca_df, method=EMBEDDING_METHOD, n_components=EMBED_COMPONENTS,
+                       n_neighbors=N_NEIGHBORS, cache_file=KNN_CACHE_FILE):
+    """2-D UMAP/t-SNE layout of the samples plus kNN-distance QC"""
+    print("\nComputing nonlinear embedding...")
+    if len(pca_df) < 4:
+        print("Need at least 4 samples for an embedding")
+        return None
+    scores = pca_df.iloc[:, :n_components].to_numpy(dtype=np.float64)
+    indices, distances = knn_graph(scores, n_neighbors, cache_file)
+
+    if method == 'umap' and umap is None:
+        print("umap-learn not installed; using t-SNE")
+        method = 'tsne'
+    if method == 'umap':
+        layout, label = umap_layout(scores, indices, distances), 'UMAP'
+    elif method == 'tsne':
+        layout, label = tsne_layout(indices, distances), 'TSNE'
+    else:
+        raise ValueError(f"Unknown embedding method: {method}")
+
+    mean_distance, distance_z = knn_outlier_scores(distances)
+    columns = [f'{label}1', f'{label}2']
+    embedding_df = pd.DataFrame(layout, index=pca_df.index, columns=columns)
+    embedding_df['KNN_Mean_Distance'] = mean_distance
+    embedding_df['KNN_Distance_Z'] = distance_z
+    embedding_df.rename_axis('Sample').to_csv('embedding.csv')
+
+    fig, ax = plt.subplots(figsize=(8, 6))
+    pca_scatter(ax, embedding_df, pca_df.index, columns=columns)
+    ax.set_xlabel(columns[0])
+    ax.set_ylabel(columns[1])
+    ax.set_title(f'{label} Embedding - Sample Distribution')
+    ax.grid(True, alpha=0.3)
+    fig.tight_layout()
+    fig.savefig('embedding_plot.png', dpi=300, bbox_inches='tight')
+    plt.close(fig)
+
+    print(f"{label} embedding of {len(embedding_df)} samples on "
+          f"{scores.shape[1]} PCs, {indices.shape[1]} neighbours")
+    print("Embedding saved to embedding.csv and embedding_plot.png")
+    return embedding_df
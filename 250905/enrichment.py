@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Metabolite-Set Enrichment
+Over-representation (hypergeometric) and rank-based permutation enrichment
+of compound classes in the differential analysis results. Set membership is
+a sparse sets x metabolites matrix, so every set is tested at once and each
+permutation batch is one sparse-dense product.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse, stats
+from annotation import annotate_metabolites, class_members
+from stats_utils import adjust_pvalues_bh
+
+N_PERMUTATIONS = 1000
+# Permutations per sparse-dense product; bounds memory at p x PERMUTATION_BATCH
+PERMUTATION_BATCH = 250
+
+
+def membership_matrix(set_members, universe):
+    """Sparse (sets x universe) 0/1 matrix and the list of set names"""
+    position = {name: i for i, name in enumerate(universe)}
+    set_names, rows, cols = [], [], []
+    for set_name, members in set_members.items():
+        columns = sorted({position[m] for m in members if m in position})
+        if not columns:
+            continue
+        rows.extend([len(set_names)] * len(columns))
+        cols.extend(columns)
+        set_names.append(set_name)
+    membership = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                   shape=(len(set_names), len(universe)))
+    return membership, set_names
+
+
+def over_representation(membership, hits):
+    """Hypergeometric test of every set against a boolean hit vector"""
+    hits = np.asarray(hits, dtype=np.float64)
+    set_sizes = np.asarray(membership.sum(axis=1)).ravel()
+    set_hits = membership @ hits
+    n_universe = membership.shape[1]
+    n_hits = hits.sum()
+
+    expected = set_sizes * n_hits / n_universe if n_universe else np.zeros_like(set_sizes)
+    p_values = stats.hypergeom.sf(set_hits - 1, n_universe, set_sizes, n_hits)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fold = np.where(expected > 0, set_hits / expected, np.nan)
+    return set_sizes, set_hits, expected, fold, p_values
+
+
+def rank_enrichment(membership, scores, n_perm=N_PERMUTATIONS,
+                    batch_size=PERMUTATION_BATCH, seed=0):
+    """Mean centered rank per set with a two-sided permutation p-value
+
+    Permuting the ranks and summing them per set is a sparse-dense product
+    (sets x p) @ (p x batch), so all sets share every permutation.
+    """
+    ranks = stats.rankdata(scores)
+    ranks = ranks - ranks.mean()
+    set_sizes = np.asarray(membership.sum(axis=1)).ravel()
+    observed = (membership @ ranks) / set_sizes
+
+    rng = np.random.default_rng(seed)
+    exceed = np.zeros(len(set_sizes))
+    perm_sum = np.zeros(len(set_sizes))
+    perm_sq = np.zeros(len(set_sizes))
+    for start in range(0, n_perm, batch_size):
+        batch = min(batch_size, n_perm - start)
+        permuted = rng.permuted(np.tile(ranks[:, None], (1, batch)), axis=0)
+        null = (membership @ permuted) / set_sizes[:, None]
+        exceed += (np.abs(null) >= np.abs(observed)[:, None]).sum(axis=1)
+        perm_sum += null.sum(axis=1)
+        perm_sq += (null ** 2).sum(axis=1)
+
+    perm_mean = perm_sum / n_perm
+    perm_std = np.sqrt(np.maximum(perm_sq / n_perm - perm_mean ** 2, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized = (observed - perm_mean) / perm_std
+    p_values = (exceed + 1) / (n_perm + 1)
+    return observed, normalized, p_values
+
+
+def enrichment_analysis(ttest_df, set_members=None, p_cutoff=0.05, n_perm=N_PERMUTATIONS):
+    """Test compound classes for enrichment among the differential results"""
+    print("\nPerforming metabolite-set enrichment analysis...")
+
+    results = ttest_df.dropna(subset=['T_Statistic', 'P_Value'])
+    universe = results['Metabolite'].tolist()
+    if set_members is None:
+        set_members = class_members(annotate_metabolites(universe))
+    membership, set_names = membership_matrix(set_members, universe)
+    if not set_names:
+        print("No metabolite sets overlap the tested metabolites")
+        return None
+
+    hits = (results['P_Value'] < p_cutoff).to_numpy()
+    sizes, set_hits, expected, fold, ora_p = over_representation(membership, hits)
+
+    # Positive scores mean higher in fasting (T_Statistic is normal - fasting)
+    scores = -results['T_Statistic'].to_numpy(dtype=np.float64)
+    mean_rank, nes, perm_p = rank_enrichment(membership, scores, n_perm)
+
+    enrichment_df = pd.DataFrame({
+        'Set': set_names,
+        'Size': sizes.astype(int),
+        'Hits': set_hits.astype(int),
+        'Expected': expected,
+        'Fold_Enrichment': fold,
+        'ORA_P_Value': ora_p,
+        'ORA_FDR': adjust_pvalues_bh(ora_p),
+        'Mean_Centered_Rank': mean_rank,
+        'NES': nes,
+        'Direction': np.where(mean_rank > 0, 'Up in fasting', 'Down in fasting'),
+        'Perm_P_Value': perm_p,
+        'Perm_FDR': adjust_pvalues_bh(perm_p),
+    }).sort_values('ORA_P_Value')
+    enrichment_df.to_csv('enrichment_results.csv', index=False)
+
+    print(f"Tested {len(set_names)} metabolite sets against {len(universe)} metabolites")
+    print(f"Over-represented sets (p<0.05): {(enrichment_df['ORA_P_Value'] < 0.05).sum()}")
+    print(f"Rank-enriched sets (permutation p<0.05): {(enrichment_df['Perm_P_Value'] < 0.05).sum()}")
+    print("Enrichment results saved to enrichment_results.csv")
+    return enrichment_df
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+Golden-Output Equivalence and Speed Harness
+Runs pinned copies of the original metabolomics_analysis.py stages
+(basic_statistics, perform_pca_analysis, the DataFrame.corr() pair scan of
+correlation_analysis and the per-metabolite ttest_ind loop of
+differential_analysis) and the rewritten / accelerated variants side by
+side on the stored run snapshots and on synthetic scale-ups, checks that
+the numbers agree within tolerances (PCA loadings and scores up to sign)
+and reports the speedup per stage. Nothing is plotted, so the timings
+compare the computation only.
+The stored R summaries in results/metabolomics-analysis/*/summary_stats.csv
+are checked against basic_statistics as golden outputs.
+Usage: python 250905/equivalence.py [results_dir] (run from the repository root)
+"""
+
+import os
+import sys
+import time
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import stats
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import StandardScaler
+import metabolomics_analysis as reference
+from correlation_network import (threshold_correlations, dense_to_adjacency, adjacency_to_pairs,
+                                 CORRELATION_THRESHOLDS)
+from incremental import (empty_state, update_state, summary_from_state, correlations_from_state,
+                         batch_moments, moment_ttests)
+from sharding import sharded_ttests, sharded_threshold_correlations
+from results_index import RESULTS_DIR, discover_runs
+
+REPORT_FILE = 'equivalence_report.csv'
+# (samples, metabolites) of the synthetic scale-ups of the stored data
+SCALE_UPS = [(100, 1000), (400, 2000)]
+# rtol/atol per stage
+TOLERANCES = {
+    'basic_statistics': (1e-9, 1e-12),
+    'perform_pca_analysis': (1e-6, 1e-6),
+    'correlation_analysis': (1e-9, 1e-9),
+    'differential_analysis': (1e-7, 1e-12),
+}
+# Leading principal components compared (explained variance, loadings, scores)
+PCA_COMPONENTS = 2
+# R's summary() prints 4 significant digits
+GOLDEN_RTOL = 5e-3
+R_SUMMARY_ROWS = {'Min.': 'Min', '1st Qu.': 'Q25', 'Median': 'Median', 'Mean': 'Mean',
+                  '3rd Qu.': 'Q75', 'Max.': 'Max'}
+
+
+# --- Baselines: the original stage computations, pinned here without plots or CSVs ---
+
+def baseline_statistics(data):
+    """Original basic_statistics table"""
+    return pd.DataFrame({
+        'Mean': data.mean(),
+        'Std': data.std(),
+        'Min': data.min(),
+        'Max': data.max(),
+        'Median': data.median(),
+        'Q25': data.quantile(0.25),
+        'Q75': data.quantile(0.75)
+    })
+
+
+def baseline_pca(data):
+    """Original full PCA of the autoscaled, zero-filled data"""
+    pca = PCA()
+    scores = pca.fit_transform(StandardScaler().fit_transform(data.fillna(0)))
+    return pca, pd.DataFrame(scores, index=data.index,
+                             columns=[f'PC{i + 1}' for i in range(scores.shape[1])])
+
+
+def baseline_correlations(data):
+    """Original DataFrame.corr() matrix and nested-loop |r| > 0.7 pair scan"""
+    corr_matrix = data.corr()
+    high_corr_pairs = []
+    for i in range(len(corr_matrix.columns)):
+        for j in range(i + 1, len(corr_matrix.columns)):
+            corr_val = corr_matrix.iloc[i, j]
+            if abs(corr_val) > 0.7:
+                high_corr_pairs.append({
+                    'Metabolite1': corr_matrix.columns[i],
+                    'Metabolite2': corr_matrix.columns[j],
+                    'Correlation': corr_val
+                })
+    return corr_matrix, pd.DataFrame(high_corr_pairs,
+                                     columns=['Metabolite1', 'Metabolite2', 'Correlation'])
+
+
+def baseline_differential(data):
+    """Original per-metabolite ttest_ind loop (no bootstrap CIs)"""
+    normal_samples, fasting_samples = group_samples(data)
+    ttest_results = []
+    for metabolite in data.columns:
+        normal_values = data.loc[normal_samples, metabolite].dropna()
+        fasting_values = data.loc[fasting_samples, metabolite].dropna()
+        if len(normal_values) >= 2 and len(fasting_values) >= 2:
+            stat, pvalue = stats.ttest_ind(normal_values, fasting_values)
+            normal_mean = normal_values.mean()
+            fasting_mean = fasting_values.mean()
+            fold_change = fasting_mean / normal_mean if normal_mean > 0 else np.nan
+            ttest_results.append({
+                'Metabolite': metabolite,
+                'Normal_Mean': normal_mean,
+                'Fasting_Mean': fasting_mean,
+                'Fold_Change': fold_change,
+                'Log2_FC': np.log2(fold_change) if fold_change > 0 else np.nan,
+                'T_Statistic': stat,
+                'P_Value': pvalue,
+                'Significant': pvalue < 0.05
+            })
+    return pd.DataFrame(ttest_results).sort_values('P_Value')
+
+
+# Stage -> baseline every variant is checked against
+BASELINES = {
+    'basic_statistics': baseline_statistics,
+    'perform_pca_analysis': baseline_pca,
+    'correlation_analysis': baseline_correlations,
+    'differential_analysis': baseline_differential,
+}
+
+
+# --- Rewritten and accelerated variants: same inputs, outputs shaped like the baseline ---
+
+def incremental_summary(data):
+    """basic_statistics from one incremental-state update"""
+    state = empty_state(data.columns, np.zeros(data.shape[1]), 1)
+    return summary_from_state(update_state(state, data))
+
+
+def randomized_pca(data, n_components=10):
+    """Leading components only, randomized SVD, no plots"""
+    scaled = StandardScaler().fit_transform(data.fillna(0))
+    n_components = min(n_components, *scaled.shape)
+    pca = PCA(n_components=n_components, svd_solver='randomized', random_state=0)
+    scores = pca.fit_transform(scaled)
+    return pca, pd.DataFrame(scores, index=data.index,
+                             columns=[f'PC{i + 1}' for i in range(n_components)])
+
+
+def blocked_correlations(data):
+    """High-correlation pairs from the blocked kernel correlation_analysis now uses"""
+    adjacency = threshold_correlations(data, threshold=CORRELATION_THRESHOLDS['pearson'])
+    return adjacency, adjacency_to_pairs(adjacency, data.columns)
+
+
+def sharded_correlations(data):
+    """High-correlation pairs from block pairs on a local process pool"""
+    adjacency = sharded_threshold_correlations(data, CORRELATION_THRESHOLDS['pearson'],
+                                               'multiprocessing')
+    return adjacency, adjacency_to_pairs(adjacency, data.columns)
+
+
+def incremental_correlations(data):
+    """High-correlation pairs from the accumulated cross-product sums"""
+    values = data.to_numpy(dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        shift = np.nan_to_num(np.nanmean(values, axis=0))
+    state = update_state(empty_state(data.columns, shift, 1), data)
+    adjacency = dense_to_adjacency(correlations_from_state(state), CORRELATION_THRESHOLDS['pearson'])
+    return adjacency, adjacency_to_pairs(adjacency, data.columns)
+
+
+def group_samples(data):
+    """Normal and fasting sample names as differential_analysis selects them"""
+    return ([idx for idx in data.index if 'normal' in idx.lower()],
+            [idx for idx in data.index if 'fasting' in idx.lower()])
+
+
+def sharded_differential(data):
+    """t-tests and bootstrap CIs in metabolite shards on a local process pool"""
+    normal, fasting = group_samples(data)
+    return sharded_ttests(data, normal, fasting, 'multiprocessing').sort_values('P_Value')
+
+
+def moment_differential(data):
+    """t-tests from group moments (no bootstrap CIs)"""
+    normal, fasting = group_samples(data)
+    moments = [batch_moments(data.loc[samples].to_numpy(dtype=np.float64))
+               for samples in (normal, fasting)]
+    counts, means, m2s = (np.vstack(part) for part in zip(*moments))
+    return moment_ttests(data.columns, counts, means, m2s).sort_values('P_Value')
+
+
+# Stage -> {variant name: function taking the preprocessed data}
+STAGE_VARIANTS = {
+    'basic_statistics': {'incremental': incremental_summary},
+    'perform_pca_analysis': {'randomized': randomized_pca},
+    'correlation_analysis': {'blocked': blocked_correlations,
+                             'sharded': sharded_correlations,
+                             'incremental': incremental_correlations},
+    'differential_analysis': {'sharded': sharded_differential,
+                              'incremental': moment_differential},
+}
+
+
+# --- Comparisons: (max absolute difference, passed) ---
+
+def compare_arrays(expected, actual, rtol, atol):
+    """Elementwise agreement with matching NaN positions"""
+    expected = np.asarray(expected, dtype=np.float64)
+    actual = np.asarray(actual, dtype=np.float64)
+    if expected.shape != actual.shape:
+        return np.inf, False
+    if not np.array_equal(np.isnan(expected), np.isnan(actual)):
+        return np.inf, False
+    both = ~np.isnan(expected)
+    diff = float(np.max(np.abs(expected[both] - actual[both]), initial=0.0))
+    return diff, bool(np.allclose(expected[both], actual[both], rtol=rtol, atol=atol))
+
+
+def compare_frames(expected, actual, rtol, atol):
+    """Same index and numeric columns (columns missing from actual are skipped)"""
+    if not expected.index.equals(actual.index):
+        return np.inf, False
+    columns = [c for c in expected.columns if c in actual.columns
+               and pd.api.types.is_numeric_dtype(expected[c])
+               and not actual[c].isnull().all()]
+    return compare_arrays(expected[columns].astype(float).to_numpy(),
+                          actual[columns].astype(float).to_numpy(), rtol, atol)
+
+
+def compare_signless(expected, actual, rtol, atol):
+    """Columns compared up to sign (PCA components are defined up to a flip)"""
+    expected = np.asarray(expected, dtype=np.float64)
+    actual = np.asarray(actual, dtype=np.float64)
+    signs = np.where(np.sum(expected * actual, axis=0) < 0, -1.0, 1.0)
+    return compare_arrays(expected, actual * signs, rtol, atol)
+
+
+def compare_pca(expected, actual, rtol, atol, n_components=PCA_COMPONENTS):
+    """Explained variance, loadings and scores of the leading components"""
+    (pca_ref, scores_ref), (pca_new, scores_new) = expected, actual
+    k = min(n_components, len(pca_ref.components_), len(pca_new.components_))
+    checks = [
+        compare_arrays(pca_ref.explained_variance_ratio_[:k], pca_new.explained_variance_ratio_[:k],
+                       rtol, atol),
+        compare_signless(pca_ref.components_[:k].T, pca_new.components_[:k].T, rtol, atol),
+        compare_signless(scores_ref.iloc[:, :k], scores_new.iloc[:, :k], rtol, atol),
+    ]
+    return max(diff for diff, _ in checks), all(ok for _, ok in checks)
+
+
+def compare_pairs(expected, actual, rtol, atol, threshold=CORRELATION_THRESHOLDS['pearson']):
+    """Same high-correlation pairs and values; pairs within atol of the cutoff may differ"""
+    def keyed(pairs):
+        keys = [tuple(sorted(pair)) for pair in zip(pairs['Metabolite1'], pairs['Metabolite2'])]
+        return pd.Series(pairs['Correlation'].to_numpy(), index=keys)
+    ref, new = keyed(expected[1]), keyed(actual[1])
+    shared = ref.index.intersection(new.index)
+    only = pd.concat([ref.drop(shared), new.drop(shared)])
+    if (np.abs(np.abs(only) - threshold) > atol).any():
+        return np.inf, False
+    return compare_arrays(ref[shared], new[shared], rtol, atol)
+
+
+def compare_differential(expected, actual, rtol, atol):
+    """Differential tables aligned by metabolite"""
+    return compare_frames(expected.set_index('Metabolite').sort_index(),
+                          actual.set_index('Metabolite').sort_index(), rtol, atol)
+
+
+COMPARE = {
+    'basic_statistics': compare_frames,
+    'perform_pca_analysis': compare_pca,
+    'correlation_analysis': compare_pairs,
+    'differential_analysis': compare_differential,
+}
+
+
+# --- Fixtures ---
+
+def snapshot_fixtures(results_dir=RESULTS_DIR):
+    """Distinct fasting.csv snapshots of the stored runs, keyed by run name"""
+    fixtures = {}
+    seen = set()
+    for run in discover_runs(results_dir):
+        path = os.path.join(results_dir, run, 'fasting.csv')
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        if digest not in seen:
+            seen.add(digest)
+            fixtures[run] = os.path.abspath(path)
+    return fixtures
+
+
+def load_fixture(path):
+    """Preprocessed numeric data of a snapshot, as the pipeline sees it"""
+    return reference.preprocess_data(reference.load_data(path))
+
+
+def scale_up(data, n_samples, n_metabolites, seed=0):
+    """Synthetic cohort resampled from data: same groups, log-normal noise, tiled metabolites"""
+    rng = np.random.default_rng(seed)
+    normal, fasting = group_samples(data)
+    half = n_samples // 2
+    rows = np.concatenate([rng.choice(len(normal), half),
+                           len(normal) + rng.choice(len(fasting), n_samples - half)])
+    source = data.loc[normal + fasting].to_numpy(dtype=np.float64)
+    columns = np.arange(n_metabolites) % data.shape[1]
+    values = source[np.ix_(rows, columns)] * rng.lognormal(0, 0.2, size=(n_samples, n_metabolites))
+    index = [f'normal_{i + 1}' for i in range(half)] + \
+            [f'12h_fasting_{i + 1}' for i in range(n_samples - half)]
+    names = [f'{data.columns[c]} #{i // data.shape[1]}' if i >= data.shape[1] else data.columns[c]
+             for i, c in enumerate(columns)]
+    return pd.DataFrame(values, index=index, columns=names)
+
+
+# --- Runs ---
+
+def parse_r_summary(path):
+    """Min/Q25/Median/Mean/Q75/Max per metabolite from an R summary() CSV"""
+    raw = pd.read_csv(path, index_col=0).astype(str)
+    raw.columns = [str(c).strip() for c in raw.columns]
+    table = {}
+    for column in raw.columns:
+        cells = raw[column].str.split(':', n=1)
+        labels = cells.str[0].str.strip()
+        values = pd.to_numeric(cells.str[-1].str.strip(), errors='coerce')
+        stats = dict(zip(labels.map(R_SUMMARY_ROWS), values))
+        if set(R_SUMMARY_ROWS.values()) <= set(stats):
+            table[column] = {name: stats[name] for name in R_SUMMARY_ROWS.values()}
+    return pd.DataFrame.from_dict(table, orient='index', columns=list(R_SUMMARY_ROWS.values()))
+
+
+def golden_checks(results_dir=RESULTS_DIR):
+    """basic_statistics of each run snapshot against the stored R summary"""
+    rows = []
+    for run in discover_runs(results_dir):
+        summary_path = os.path.join(results_dir, run, 'summary_stats.csv')
+        snapshot_path = os.path.join(results_dir, run, 'fasting.csv')
+        if not (os.path.exists(summary_path) and os.path.exists(snapshot_path)):
+            continue
+        golden = parse_r_summary(summary_path)
+        raw = reference.load_data(snapshot_path)
+        data = reference.preprocess_data(raw)
+        # Text cells the Python pipeline drops as NaN (e.g. decimal commas R parses)
+        unparsed = int((raw.notna() & raw.apply(pd.to_numeric, errors='coerce').isna()).sum().sum())
+        ours = baseline_statistics(data)
+        shared = golden.index.intersection(ours.index)
+        if len(shared) == 0:
+            continue
+        expected = golden.loc[shared, list(R_SUMMARY_ROWS.values())].to_numpy(dtype=float)
+        actual = ours.loc[shared, list(R_SUMMARY_ROWS.values())].to_numpy(dtype=float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            relative = np.abs(expected - actual) / np.maximum(np.abs(expected), 1e-12)
+        # R rounds to significant digits; exact zeros stay exact
+        ok = np.isnan(expected) | (relative <= GOLDEN_RTOL) | (np.abs(expected - actual) < 1e-9)
+        rows.append({'Fixture': run, 'Stage': 'basic_statistics', 'Variant': 'golden R summary',
+                     'N_Samples': data.shape[0], 'N_Metabolites': len(shared),
+                     'Max_Abs_Diff': float(np.nanmax(np.abs(expected - actual), initial=0.0)),
+                     'Unparsed_Cells': unparsed, 'Passed': bool(ok.all())})
+    return rows
+
+
+def timed(func, data):
+    """(result, seconds) of one call, run in a scratch directory so outputs don't leak"""
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            start = time.perf_counter()
+            result = func(data)
+            seconds = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    return result, seconds
+
+
+def run_fixture(name, data):
+    """Baseline vs every variant, stage by stage, for one dataset"""
+    rows = []
+    for stage, variants in STAGE_VARIANTS.items():
+        expected, reference_seconds = timed(BASELINES[stage], data)
+        rtol, atol = TOLERANCES[stage]
+        for variant, func in variants.items():
+            actual, seconds = timed(func, data)
+            diff, ok = COMPARE[stage](expected, actual, rtol, atol)
+            rows.append({'Fixture': name, 'Stage': stage, 'Variant': variant,
+                         'N_Samples': data.shape[0], 'N_Metabolites': data.shape[1],
+                         'Reference_Seconds': reference_seconds, 'Variant_Seconds': seconds,
+                         'Speedup': reference_seconds / seconds if seconds > 0 else np.inf,
+                         'Max_Abs_Diff': diff, 'Passed': ok})
+    return rows
+
+
+def equivalence_report(results_dir=RESULTS_DIR, scale_ups=SCALE_UPS, output_file=REPORT_FILE):
+    """Golden checks, then reference vs variants on snapshots and scale-ups"""
+    print("Running equivalence harness...")
+    output_file = os.path.abspath(output_file)
+    rows = golden_checks(results_dir)
+
+    fixtures = snapshot_fixtures(results_dir)
+    base = None
+    for name, path in fixtures.items():
+        data = load_fixture(path)
+        base = data if base is None else base
+        rows.extend(run_fixture(name, data))
+    if base is not None:
+        for n_samples, n_metabolites in scale_ups:
+            data = scale_up(base, n_samples, n_metabolites)
+            rows.extend(run_fixture(f'synthetic {n_samples}x{n_metabolites}', data))
+
+    if not rows:
+        print(f"No run snapshots found in {results_dir}")
+        return None
+
+    report = pd.DataFrame(rows)
+    report.to_csv(output_file, index=False)
+    columns = ['Fixture', 'Stage', 'Variant', 'Speedup', 'Max_Abs_Diff', 'Unparsed_Cells', 'Passed']
+    print(report.reindex(columns=columns).to_string(index=False, float_format='%.3g'))
+    print(f"\n{int(report['Passed'].sum())}/{len(report)} checks passed")
+    print(f"Equivalence report saved to {output_file}")
+    return report
+
+
+if __name__ == "__main__":
+    equivalence_report(*sys.argv[1:2])
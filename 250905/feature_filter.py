@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Feature Pre-Filter
+Drops mostly-missing, near-constant and irreproducible metabolites before
+the expensive stages. All criteria are computed in one vectorized pass and
+every dropped feature is recorded with the reason.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Default cutoffs; pass keyword arguments to filter_features to override
+FILTER_DEFAULTS = {
+    'max_missing': 0.5,    # drop if more than this fraction of samples is missing
+    'min_variance': 0.0,   # drop if the sample variance is not above this
+    'min_iqr': 0.0,        # drop if the interquartile range is below this
+    'max_qc_rsd': 0.3,     # drop if the RSD across QC injections exceeds this
+    'qc_pattern': 'qc',    # sample names containing this are QC injections
+}
+
+
+def feature_metrics(data, qc_pattern=FILTER_DEFAULTS['qc_pattern']):
+    """Missing ratio, variance, IQR and QC RSD for every column at once"""
+    values = data.to_numpy(dtype=np.float64)
+    observed = ~np.isnan(values)
+    n_observed = observed.sum(axis=0)
+
+    metrics = pd.DataFrame(index=data.columns)
+    metrics['Missing_Ratio'] = 1 - n_observed / max(len(values), 1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(n_observed > 0, np.nansum(values, axis=0) / np.maximum(n_observed, 1), np.nan)
+        squares = np.nansum((values - mean) ** 2, axis=0)
+        metrics['Variance'] = np.where(n_observed > 1, squares / (n_observed - 1), np.nan)
+
+    if observed.any():
+        q25, q75 = np.nanquantile(values, [0.25, 0.75], axis=0)
+        metrics['IQR'] = q75 - q25
+    else:
+        metrics['IQR'] = np.nan
+
+    is_qc = data.index.astype(str).str.lower().str.contains(qc_pattern.lower(), regex=False)
+    metrics['QC_RSD'] = np.nan
+    if is_qc.sum() >= 2:
+        qc_values = values[is_qc]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            metrics['QC_RSD'] = np.nanstd(qc_values, axis=0, ddof=1) / np.nanmean(qc_values, axis=0)
+    return metrics
+
+
+def filter_features(data, report_file='feature_filter_report.csv', **cutoffs):
+    """Return the filtered matrix and a per-feature report of kept/dropped"""
+    print("\nFiltering features...")
+    settings = {**FILTER_DEFAULTS, **cutoffs}
+    metrics = feature_metrics(data, settings['qc_pattern'])
+
+    # Reasons are checked in order; a feature is labelled with the first it fails
+    checks = [
+        ('missing', metrics['Missing_Ratio'] > settings['max_missing']),
+        ('low_variance', ~(metrics['Variance'] > settings['min_variance'])),
+        ('low_iqr', metrics['IQR'] < settings['min_iqr']),
+        ('qc_rsd', metrics['QC_RSD'] > settings['max_qc_rsd']),
+    ]
+    metrics['Reason'] = np.select([mask.to_numpy() for _, mask in checks],
+                                  [reason for reason, _ in checks], default='')
+    metrics['Kept'] = metrics['Reason'] == ''
+
+    if report_file:
+        metrics.rename_axis('Metabolite').to_csv(report_file)
+
+    kept = metrics.index[metrics['Kept']]
+    dropped = metrics.loc[~metrics['Kept'], 'Reason'].value_counts()
+    print(f"Kept {len(kept)}/{len(metrics)} metabolites")
+    for reason, count in dropped.items():
+        print(f"  Dropped {count} ({reason})")
+    if report_file:
+        print(f"Filter report saved to {report_file}")
+
+    return data.loc[:, kept], metrics
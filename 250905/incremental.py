@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Incremental Cohort Updates
+Keeps sufficient statistics of a cohort in incremental_state.npz so that
+appended samples update summary_statistics.csv, the differential results
+and high_correlations.csv without re-reading the old rows. The state has a
+fixed size (SKETCH_SIZE x p values plus four p x p matrices), so an update
+costs O(new rows x p^2 + SKETCH_SIZE x p + p^2) however large the cohort is:
+  - per-metabolite count / mean / M2 (Chan-Welford merge), min / max and a
+    quantile sketch that is exact up to SKETCH_SIZE values per metabolite
+  - per-group count / mean / M2 for the normal vs fasting t-tests
+  - pairwise-complete count, sum, square and cross-product matrices for
+    the Pearson correlations
+  - an IncrementalPCA model
+Usage: python incremental.py [data.csv] [--rebuild]
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+from scipy import stats
+from sklearn.decomposition import IncrementalPCA
+from correlation_network import (dense_to_adjacency, adjacency_to_pairs, pearson_from_sums,
+                                 CORRELATION_THRESHOLDS)
+from linear_models import sample_groups
+
+STATE_FILE = 'incremental_state.npz'
+# Append-only side file with the sample names already in the state
+SAMPLES_SUFFIX = '_samples.txt'
+# Points per metabolite in the quantile sketch; quantiles are exact up to this
+# many observed values and approximate (rank error ~ n / SKETCH_SIZE) beyond
+SKETCH_SIZE = 1024
+GROUPS = ['Normal', 'Fasting']
+INCREMENTAL_PCA_COMPONENTS = 10
+# IncrementalPCA attributes stored in the state file
+PCA_ATTRIBUTES = ['components_', 'mean_', 'var_', 'n_samples_seen_', 'singular_values_',
+                  'explained_variance_', 'explained_variance_ratio_', 'noise_variance_']
+
+
+def batch_moments(values):
+    """NaN-aware count, mean and M2 of every column of one batch of rows"""
+    count = np.sum(~np.isnan(values), axis=0).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, np.nansum(values, axis=0) / count, 0.0)
+    m2 = np.nansum((values - mean) ** 2, axis=0)
+    return count, mean, m2
+
+
+def merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    """Chan et al. parallel merge of two (count, mean, M2) summaries"""
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share = np.where(count > 0, count_b / count, 0.0)
+    mean = mean_a + delta * share
+    m2 = m2_a + m2_b + delta ** 2 * count_a * share
+    return count, mean, m2
+
+
+def merge_sketch(sketch_values, sketch_weights, new_values, size=SKETCH_SIZE):
+    """Column-wise quantile sketch (sorted values and weights, NaN last) with the new rows added
+
+    Every observed value is its own point while a metabolite has at most
+    `size` values; beyond that the points are pooled into `size` bins of
+    equal total weight, each kept as its weighted mean. The sketch never
+    holds more than `size` rows.
+    """
+    n_columns = new_values.shape[1]
+    values = np.vstack([sketch_values, new_values])
+    weights = np.vstack([sketch_weights, (~np.isnan(new_values)).astype(np.float64)])
+    order = np.argsort(values, axis=0, kind='stable')
+    values = np.take_along_axis(values, order, axis=0)
+    weights = np.take_along_axis(weights, order, axis=0)
+
+    observed = weights > 0
+    n_points = observed.sum(axis=0)
+    total = weights.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rank_bins = np.floor((np.cumsum(weights, axis=0) - weights / 2) / total * size)
+    bins = np.where(n_points > size, rank_bins, np.arange(len(values))[:, None])
+    columns = np.broadcast_to(np.arange(n_columns), bins.shape)
+    flat = bins[observed].astype(np.int64) * n_columns + columns[observed]
+    bin_weights = np.bincount(flat, weights=weights[observed], minlength=size * n_columns)
+    bin_sums = np.bincount(flat, weights=(values * weights)[observed], minlength=size * n_columns)
+    bin_weights = bin_weights.reshape(size, n_columns)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bin_values = np.where(bin_weights > 0, bin_sums.reshape(size, n_columns) / bin_weights,
+                              np.nan)
+    # Empty bins move to the end; the others keep their order
+    order = np.argsort(bin_weights == 0, axis=0, kind='stable')
+    used = int(np.minimum(n_points, size).max(initial=0))
+    return (np.take_along_axis(bin_values, order, axis=0)[:used],
+            np.take_along_axis(bin_weights, order, axis=0)[:used])
+
+
+def empty_state(metabolites, shift, n_components):
+    """Statistics of a cohort with no samples yet"""
+    p = len(metabolites)
+    return {
+        'metabolites': np.asarray(metabolites, dtype=str),
+        'samples': np.array([], dtype=str),
+        'shift': shift,
+        'count': np.zeros(p), 'mean': np.zeros(p), 'm2': np.zeros(p),
+        'minimum': np.full(p, np.nan), 'maximum': np.full(p, np.nan),
+        'sketch_values': np.empty((0, p)), 'sketch_weights': np.empty((0, p)),
+        'group_count': np.zeros((len(GROUPS), p)),
+        'group_mean': np.zeros((len(GROUPS), p)),
+        'group_m2': np.zeros((len(GROUPS), p)),
+        'pair_count': np.zeros((p, p)), 'pair_sum': np.zeros((p, p)),
+        'pair_square': np.zeros((p, p)), 'pair_cross': np.zeros((p, p)),
+        'pca_scale': np.ones(p),
+        'pca_components': np.array(n_components),
+        'pca_pending': np.empty((0, p)),
+        # Sample names of this session not yet appended to the side file
+        'new_samples': np.array([], dtype=str),
+    }
+
+
+def update_state(state, new_rows):
+    """Fold new sample rows into the state; cost does not depend on the rows already in it"""
+    values = new_rows.reindex(columns=state['metabolites']).to_numpy(dtype=np.float64)
+    names = np.asarray(new_rows.index, dtype=str)
+    state['samples'] = np.concatenate([state['samples'], names])
+    state['new_samples'] = np.concatenate([state['new_samples'], names])
+
+    state['count'], state['mean'], state['m2'] = merge_moments(
+        state['count'], state['mean'], state['m2'], *batch_moments(values))
+    state['minimum'] = np.fmin(state['minimum'], np.fmin.reduce(values, axis=0))
+    state['maximum'] = np.fmax(state['maximum'], np.fmax.reduce(values, axis=0))
+    state['sketch_values'], state['sketch_weights'] = merge_sketch(
+        state['sketch_values'], state['sketch_weights'], values)
+
+    groups = sample_groups(new_rows.index)
+    for g, group in enumerate(GROUPS):
+        moments = merge_moments(state['group_count'][g], state['group_mean'][g],
+                                state['group_m2'][g], *batch_moments(values[groups == group]))
+        state['group_count'][g], state['group_mean'][g], state['group_m2'][g] = moments
+
+    # Pairwise-complete sums (shifted by the first batch's means for stability)
+    observed = (~np.isnan(values)).astype(np.float64)
+    shifted = np.where(observed > 0, values - state['shift'], 0.0)
+    state['pair_count'] += observed.T @ observed
+    state['pair_sum'] += shifted.T @ observed
+    state['pair_square'] += (shifted ** 2).T @ observed
+    state['pair_cross'] += shifted.T @ shifted
+
+    state['pca_pending'] = np.vstack([state['pca_pending'], values])
+    return state
+
+
+def update_pca(state, model):
+    """partial_fit the pending rows once there are enough for a batch"""
+    pending = state['pca_pending']
+    n_components = int(state['pca_components'])
+    if len(pending) < n_components:
+        return model
+    if model is None:
+        model = IncrementalPCA(n_components=n_components)
+    model.partial_fit(np.nan_to_num(pending) / state['pca_scale'])
+    state['pca_pending'] = np.empty((0, pending.shape[1]))
+    return model
+
+
+def samples_file(filename=STATE_FILE):
+    """Path of the sample-name file that belongs to a state file"""
+    return os.path.splitext(filename)[0] + SAMPLES_SUFFIX
+
+
+def save_state(state, model, filename=STATE_FILE):
+    """Write statistics and the IncrementalPCA attributes; append the new sample names
+
+    The .npz only holds fixed-size arrays (p, p x p and the sketch) and is
+    rewritten; the names file is only rewritten for a fresh state.
+    """
+    fresh = len(state['new_samples']) == len(state['samples'])
+    with open(samples_file(filename), 'w' if fresh else 'a', encoding='utf-8') as f:
+        f.writelines(f"{name}\n" for name in state['new_samples'])
+    state['new_samples'] = np.array([], dtype=str)
+
+    arrays = {key: value for key, value in state.items()
+              if key not in ('samples', 'new_samples')}
+    if model is not None:
+        arrays.update({f'pca_{name}': np.asarray(getattr(model, name)) for name in PCA_ATTRIBUTES})
+    np.savez(filename, **arrays)
+
+
+def load_state(filename=STATE_FILE):
+    """Read a state file and its sample names; returns (state, IncrementalPCA or None)"""
+    with np.load(filename, allow_pickle=False) as stored:
+        arrays = {key: stored[key] for key in stored.files}
+    with open(samples_file(filename), encoding='utf-8') as f:
+        arrays['samples'] = np.array(f.read().splitlines(), dtype=str)
+    arrays['new_samples'] = np.array([], dtype=str)
+    model = None
+    if 'pca_components_' in arrays:
+        model = IncrementalPCA(n_components=int(arrays['pca_components']))
+        for name in PCA_ATTRIBUTES:
+            value = arrays.pop(f'pca_{name}')
+            setattr(model, name, value.item() if value.ndim == 0 else value)
+        model.n_components_ = model.components_.shape[0]
+        model.batch_size_ = model.n_components_
+    return arrays, model
+
+
+def quantiles(state, q):
+    """Quantile of the observed values from the sketch, interpolated as pandas does
+
+    Exact while the sketch holds every value; otherwise each point sits at
+    the centre rank of its bin and the exact min/max pin the ends.
+    """
+    count = state['count']
+    result = np.full(len(count), np.nan)
+    for j in np.flatnonzero(count > 0):
+        weights = state['sketch_weights'][:, j]
+        values = state['sketch_values'][weights > 0, j]
+        weights = weights[weights > 0]
+        positions = np.cumsum(weights) - (weights + 1) / 2
+        if len(values) < count[j]:
+            positions = np.concatenate([[0], positions, [count[j] - 1]])
+            values = np.concatenate([[state['minimum'][j]], values, [state['maximum'][j]]])
+        result[j] = np.interp(q * (count[j] - 1), positions, values)
+    return result
+
+
+def summary_from_state(state):
+    """summary_statistics.csv table from the state"""
+    count = state['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(np.where(count > 1, state['m2'] / (count - 1), np.nan))
+    has_values = count > 0
+    summary = pd.DataFrame({
+        'Mean': np.where(has_values, state['mean'], np.nan),
+        'Std': std,
+        'Min': state['minimum'],
+        'Max': state['maximum'],
+        'Median': quantiles(state, 0.5),
+        'Q25': quantiles(state, 0.25),
+        'Q75': quantiles(state, 0.75),
+    }, index=state['metabolites'])
+    return summary[has_values]
+
+
+def moment_ttests(metabolites, group_count, group_mean, group_m2):
+    """Pooled-variance t-tests (as stats.ttest_ind) from normal/fasting moments
+
+    Rows in metabolite order, only metabolites with two values per group.
+    """
+    (n_normal, n_fasting), (mean_normal, mean_fasting), (m2_normal, m2_fasting) = (
+        group_count, group_mean, group_m2)
+    testable = (n_normal >= 2) & (n_fasting >= 2)
+    df = n_normal + n_fasting - 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pooled = (m2_normal + m2_fasting) / df
+        t_stat = (mean_normal - mean_fasting) / np.sqrt(pooled * (1 / n_normal + 1 / n_fasting))
+        fold_change = np.where(mean_normal > 0, mean_fasting / mean_normal, np.nan)
+        log2_fc = np.where(fold_change > 0, np.log2(fold_change), np.nan)
+    p_values = 2 * stats.t.sf(np.abs(t_stat), df)
+
+    results = pd.DataFrame({
+        'Metabolite': metabolites,
+        'Normal_Mean': mean_normal,
+        'Fasting_Mean': mean_fasting,
+        'Fold_Change': fold_change,
+        'Log2_FC': log2_fc,
+        'T_Statistic': t_stat,
+        'P_Value': p_values,
+        'Significant': p_values < 0.05,
+    })
+    return results[testable].reset_index(drop=True)
+
+
+def differential_from_state(state):
+    """Differential results table from the group moments
+
+    Bootstrap fold-change CIs need the raw rows and are left empty here.
+    """
+    results = moment_ttests(state['metabolites'], state['group_count'],
+                            state['group_mean'], state['group_m2'])
+    results['FC_CI_Lower'] = np.nan
+    results['FC_CI_Upper'] = np.nan
+    return results.sort_values('P_Value')
+
+
+def correlations_from_state(state):
+    """Pairwise-complete Pearson matrix from the accumulated sums"""
+    return pearson_from_sums(state['pair_count'], state['pair_sum'], state['pair_sum'].T,
+                             state['pair_square'], state['pair_square'].T, state['pair_cross'])
+
+
+def write_outputs(state, model):
+    """Refresh the summary, differential and correlation CSVs from the state"""
+    summary = summary_from_state(state)
+    summary.to_csv('summary_statistics.csv')
+    print("Basic statistics saved to summary_statistics.csv")
+
+    results = differential_from_state(state)
+    results.to_csv('differential_analysis_results.csv', index=False)
+    print(f"Differential analysis: {len(results)} metabolites, "
+          f"{int(results['Significant'].sum())} significant (p<0.05)")
+
+    threshold = CORRELATION_THRESHOLDS['pearson']
+    adjacency = dense_to_adjacency(correlations_from_state(state), threshold)
+    pairs = adjacency_to_pairs(adjacency, state['metabolites'])
+    pairs.to_csv('high_correlations.csv', index=False)
+    print(f"Found {len(pairs)} high correlation pairs (|r|>{threshold})")
+
+    if model is not None:
+        ratios = ', '.join(f"{r:.1%}" for r in model.explained_variance_ratio_[:2])
+        print(f"Incremental PCA ({int(model.n_samples_seen_)} samples): PC1/PC2 {ratios}")
+
+
+def incremental_update(data, state_file=STATE_FILE, rebuild=False):
+    """Fold rows not seen before into the state and refresh the outputs"""
+    print("\nUpdating cohort statistics incrementally...")
+    if rebuild or not os.path.exists(state_file):
+        # All-NaN columns are kept: later samples may observe them
+        values = data.to_numpy(dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            shift = np.nan_to_num(np.nanmean(values, axis=0))
+            scale = np.nanstd(values, axis=0, ddof=1)
+        n_components = max(1, min(INCREMENTAL_PCA_COMPONENTS, *data.shape))
+        state, model = empty_state(data.columns, shift, n_components), None
+        state['pca_scale'] = np.where(scale > 0, scale, 1.0)
+        new_rows = data
+        print(f"Building state from {len(new_rows)} samples")
+    else:
+        state, model = load_state(state_file)
+        seen = pd.Index(state['samples'])
+        new_rows = data.loc[~data.index.astype(str).isin(seen)]
+        missing = seen.difference(data.index.astype(str))
+        if len(missing):
+            print(f"{len(missing)} known samples are missing from the data; "
+                  f"run with --rebuild to start over")
+        added = data.columns.difference(state['metabolites'])
+        if len(added):
+            print(f"{len(added)} metabolites not in the state are ignored; "
+                  f"run with --rebuild to include them")
+        print(f"{len(new_rows)} new samples (of {len(data)})")
+
+    if len(new_rows):
+        state = update_state(state, new_rows)
+        model = update_pca(state, model)
+        save_state(state, model, state_file)
+    write_outputs(state, model)
+    return state
+
+
+def main():
+    """python incremental.py [data.csv] [--rebuild]"""
+    from metabolomics_analysis import load_data
+
+    args = [arg for arg in sys.argv[1:] if arg != '--rebuild']
+    filename = args[0] if args else 'fasting.csv'
+    data = load_data(filename)
+    if data is None:
+        return
+    numeric = data.apply(pd.to_numeric, errors='coerce')
+    incremental_update(numeric, rebuild='--rebuild' in sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
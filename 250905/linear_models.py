@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Batched Linear Models
+limma-style per-metabolite linear models with covariates (age, sex, batch,
+...). All metabolites share one design matrix, so the fit is a single
+least-squares solve per missing-value pattern, contrasts are matrix
+products, and residual variances can be moderated by empirical Bayes.
+Moderation assumes variances on a common scale; raw concentrations span
+orders of magnitude, so the prior is fitted to relative variances
+(residual variance / mean square of the metabolite), which makes the
+results invariant to rescaling any metabolite.
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+from scipy import special, stats
+from stats_utils import adjust_pvalues_bh, VARIANCE_EPS
+
+# Optional per-sample covariates (first column = sample name)
+COVARIATE_FILE = 'sample_covariates.csv'
+# Default contrast: same direction as the t-test (normal - fasting)
+DEFAULT_CONTRAST = {'Normal': 1.0, 'Fasting': -1.0}
+
+
+def sample_groups(samples):
+    """'Normal' / 'Fasting' / None for every sample name"""
+    names = pd.Index(samples).astype(str).str.lower()
+    return np.select([names.str.contains('fasting'), names.str.contains('normal')],
+                     ['Fasting', 'Normal'], default=None)
+
+
+def design_matrix(samples, covariates=None):
+    """Cell-means group columns plus covariates; categorical covariates are dummy-coded
+
+    Samples outside both groups or with a missing covariate are dropped.
+    """
+    groups = pd.Series(sample_groups(samples), index=samples)
+    design = pd.get_dummies(groups.dropna()).astype(np.float64)
+    design = design.reindex(columns=['Normal', 'Fasting'], fill_value=0.0)
+    if covariates is not None and len(covariates.columns):
+        covariates = covariates.reindex(design.index)
+        numeric = covariates.select_dtypes('number')
+        categorical = covariates.drop(columns=numeric.columns)
+        dummies = pd.get_dummies(categorical, drop_first=True, dtype=np.float64)
+        dummies[categorical.isnull().any(axis=1).to_numpy()] = np.nan
+        design = pd.concat([design, numeric.astype(np.float64), dummies], axis=1).dropna()
+    return design
+
+
+def contrast_matrix(design, contrasts=None):
+    """(coefficients x contrasts) DataFrame from {name: {coefficient: weight}}"""
+    contrasts = contrasts or {'Normal - Fasting': DEFAULT_CONTRAST}
+    matrix = pd.DataFrame(0.0, index=design.columns, columns=list(contrasts))
+    for name, weights in contrasts.items():
+        unknown = set(weights) - set(design.columns)
+        if unknown:
+            raise ValueError(f"Contrast {name} uses unknown coefficients: {sorted(unknown)}")
+        matrix.loc[list(weights), name] = list(weights.values())
+    return matrix
+
+
+def missing_patterns(observed):
+    """Group feature columns by their pattern of observed samples"""
+    packed = np.packbits(observed, axis=0)
+    _, inverse = np.unique(packed, axis=1, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.flatnonzero(np.diff(inverse[order])) + 1
+    return np.split(order, bounds)
+
+
+def fit_linear_models(values, design):
+    """Coefficients, residual variance, residual df and (X'X)^-1 per feature
+
+    values is samples x features with NaN for missing. Features that share a
+    missing-value pattern are solved together in one lstsq call, so complete
+    data needs exactly one solve. Residual variances that are only rounding
+    noise (constant values within groups) are NaN, as ttest_ind returns.
+    """
+    n_features = values.shape[1]
+    n_coef = design.shape[1]
+    coefficients = np.full((n_coef, n_features), np.nan)
+    sigma2 = np.full(n_features, np.nan)
+    df_residual = np.zeros(n_features)
+    unscaled = np.full((n_features, n_coef, n_coef), np.nan)
+
+    observed = ~np.isnan(values)
+    for columns in missing_patterns(observed):
+        rows = observed[:, columns[0]]
+        x = design[rows]
+        y = values[np.ix_(rows, columns)]
+        if np.linalg.matrix_rank(x) < n_coef or len(x) <= n_coef:
+            continue
+        beta, _, _, _ = np.linalg.lstsq(x, y, rcond=None)
+        residual_df = len(x) - n_coef
+        coefficients[:, columns] = beta
+        residual_var = np.sum((y - x @ beta) ** 2, axis=0) / residual_df
+        zero = residual_var <= VARIANCE_EPS * np.mean(y ** 2, axis=0)
+        sigma2[columns] = np.where(zero, np.nan, residual_var)
+        df_residual[columns] = residual_df
+        unscaled[columns] = np.linalg.inv(x.T @ x)
+    return coefficients, sigma2, df_residual, unscaled
+
+
+def trigamma_inverse(x):
+    """Solve trigamma(y) = x by Newton iteration (Smyth 2004)"""
+    x = np.asarray(x, dtype=np.float64)
+    y = 0.5 + 1 / x
+    for _ in range(50):
+        tri = special.polygamma(1, y)
+        step = tri * (1 - tri / x) / special.polygamma(2, y)
+        y = y + step
+        if np.all(-step / y < 1e-8):
+            break
+    return y
+
+
+def squeeze_variances(sigma2, df_residual):
+    """Empirical-Bayes posterior variances, prior df and prior variance
+
+    Fits a scaled F prior to the residual variances by moments of log s2,
+    as in limma's eBayes.
+    """
+    sigma2 = np.asarray(sigma2, dtype=np.float64)
+    valid = (df_residual > 0) & (sigma2 > 0)
+    if valid.sum() < 3:
+        return sigma2, 0.0, np.nan
+    s2, df = sigma2[valid], df_residual[valid]
+    half = df / 2
+    log_adjusted = np.log(s2) - special.digamma(half) + np.log(half)
+    mean_log = log_adjusted.mean()
+    excess = (np.var(log_adjusted, ddof=1) - np.mean(special.polygamma(1, half)))
+    if excess > 0:
+        df_prior = 2 * trigamma_inverse(excess)
+        var_prior = np.exp(mean_log + special.digamma(df_prior / 2) - np.log(df_prior / 2))
+    else:
+        df_prior = np.inf
+        var_prior = np.exp(mean_log)
+
+    if np.isinf(df_prior):
+        posterior = np.where((df_residual > 0) & ~np.isnan(sigma2), var_prior, np.nan)
+    else:
+        posterior = (df_prior * var_prior + df_residual * sigma2) / (df_prior + df_residual)
+    return posterior, df_prior, var_prior
+
+
+def contrast_statistics(coefficients, variance, df_total, unscaled, contrasts):
+    """t statistics for every contrast and the overall F over all contrasts"""
+    c = contrasts.to_numpy(dtype=np.float64)
+    estimates = c.T @ coefficients                                 # m x p
+    contrast_unscaled = np.einsum('km,pkl,ln->pmn', c, unscaled, c)  # p x m x m
+    std_unscaled = np.sqrt(np.einsum('pmm->pm', contrast_unscaled)).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std_error = std_unscaled * np.sqrt(variance)
+        t_stat = estimates / std_error
+    p_values = 2 * stats.t.sf(np.abs(t_stat), df_total)
+
+    # F = est' (C' V C)^-1 est / (m s2), solved for all features at once
+    n_contrasts = c.shape[1]
+    finite = np.isfinite(contrast_unscaled).all(axis=(1, 2)) & np.isfinite(estimates).all(axis=0)
+    f_stat = np.full(estimates.shape[1], np.nan)
+    if finite.any():
+        est = estimates[:, finite].T[:, :, None]
+        solved = np.linalg.solve(contrast_unscaled[finite], est)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f_stat[finite] = (est[:, :, 0] * solved[:, :, 0]).sum(axis=1) / (
+                n_contrasts * variance[finite])
+    f_p = stats.f.sf(f_stat, n_contrasts, df_total)
+    return estimates, std_error, t_stat, p_values, f_stat, f_p
+
+
+def linear_model_analysis(data, covariates=None, contrasts=None, moderated=True,
+                          output_file='linear_model_results.csv'):
+    """Covariate-adjusted differential analysis in the differential_analysis_results layout"""
+    print("\nFitting batched linear models...")
+    design = design_matrix(data.index, covariates)
+    if design[['Normal', 'Fasting']].sum().min() < 2:
+        print("Need at least 2 normal and 2 fasting samples with complete covariates")
+        return None
+    contrasts = contrast_matrix(design, contrasts)
+    print(f"Design: {len(design)} samples x {design.shape[1]} coefficients "
+          f"({', '.join(design.columns)})")
+
+    values = data.loc[design.index].to_numpy(dtype=np.float64)
+    coefficients, sigma2, df_residual, unscaled = fit_linear_models(
+        values, design.to_numpy())
+
+    if moderated:
+        # Squeeze on a unit-free scale so abundant metabolites don't meet a tiny prior
+        with np.errstate(invalid='ignore'):
+            mean_square = np.nanmean(values ** 2, axis=0)
+        relative, df_prior, var_prior = squeeze_variances(sigma2 / mean_square, df_residual)
+        variance = relative * mean_square
+        print(f"Empirical Bayes prior: df={df_prior:.2f}, relative s0^2={var_prior:.4g}")
+    else:
+        variance, df_prior = sigma2, 0.0
+    df_total = np.where(df_residual > 0, df_residual + df_prior, np.nan)
+    if moderated and np.isfinite(df_prior):
+        # Cap as limma does so a near-constant prior cannot dominate
+        df_total = np.minimum(df_total, np.nansum(df_residual))
+    estimates, std_error, t_stat, p_values, f_stat, f_p = contrast_statistics(
+        coefficients, variance, df_total, unscaled, contrasts)
+
+    # Raw group means keep the fold-change columns identical to the t-test output
+    observed = ~np.isnan(values)
+    is_normal = design['Normal'].to_numpy() == 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normal_mean = np.nansum(values[is_normal], axis=0) / observed[is_normal].sum(axis=0)
+        fasting_mean = np.nansum(values[~is_normal], axis=0) / observed[~is_normal].sum(axis=0)
+        fold_change = np.where(normal_mean > 0, fasting_mean / normal_mean, np.nan)
+        log2_fc = np.where(fold_change > 0, np.log2(fold_change), np.nan)
+
+    tables = []
+    for i, name in enumerate(contrasts.columns):
+        table = pd.DataFrame({
+            'Metabolite': data.columns,
+            'Normal_Mean': normal_mean,
+            'Fasting_Mean': fasting_mean,
+            'Fold_Change': fold_change,
+            'Log2_FC': log2_fc,
+            'T_Statistic': t_stat[i],
+            'P_Value': p_values[i],
+            'Significant': p_values[i] < 0.05,
+            'Contrast': name,
+            'Estimate': estimates[i],
+            'Std_Error': std_error[i],
+            'DF': df_total,
+            'Adj_P_Value': adjust_pvalues_bh(p_values[i]),
+            'F_Statistic': f_stat,
+            'F_P_Value': f_p,
+        })
+        # Zero-variance fits stay in the table with NaN statistics
+        tables.append(table[df_residual > 0])
+    results = pd.concat(tables, ignore_index=True).sort_values(['Contrast', 'P_Value'])
+    if len(contrasts.columns) == 1:
+        results = results.drop(columns='Contrast')
+
+    if output_file:
+        results.to_csv(output_file, index=False)
+    print(f"Linear models fitted for {int(np.isfinite(sigma2).sum())} metabolites")
+    print(f"Significant metabolites (p<0.05): {int(results['Significant'].sum())}")
+    if output_file:
+        print(f"Linear model results saved to {output_file}")
+    return results
+
+
+def load_covariates(filename=COVARIATE_FILE):
+    """Per-sample covariate table indexed by sample name, or None if absent"""
+    if not filename or not os.path.exists(filename):
+        return None
+    covariates = pd.read_csv(filename, index_col=0)
+    print(f"Loaded covariates {covariates.columns.tolist()} from {filename}")
+    return covariates
+
+
+def main():
+    """python linear_models.py [data.csv] [covariates.csv]"""
+    from metabolomics_analysis import load_data, preprocess_data
+
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'fasting.csv'
+    covariate_file = sys.argv[2] if len(sys.argv) > 2 else COVARIATE_FILE
+    data = load_data(filename)
+    if data is None:
+        return
+    linear_model_analysis(preprocess_data(data), load_covariates(covariate_file))
+
+
+if __name__ == "__main__":
+    main()
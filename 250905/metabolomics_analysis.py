@@ -9,13 +9,33 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
-from datetime import datetime
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 from scipy import stats
+from report_templates import build_report_context, write_report
+from plotting import pca_scatter, volcano_plot
+from bootstrap import bootstrap_fold_change_ci
+from feature_filter import filter_features
+from sample_qc import sample_qc, exclude_outliers
+from enrichment import enrichment_analysis
+from linear_models import linear_model_analysis, load_covariates
+from batch_correction import batch_correction
+from classifiers import classification_analysis
+from embedding import embedding_analysis
+from sharding import sharded_ttests, sharded_threshold_correlations
+from dashboard import export_dashboard
+from correlation_network import (threshold_correlations, adjacency_to_pairs, network_analysis,
+                                 rank_columns, partial_correlations, dense_to_adjacency,
+                                 CORRELATION_THRESHOLDS)
 import warnings
 warnings.filterwarnings('ignore')
 
+# 'pearson', 'spearman' (rank-based) or 'partial' (direct associations only)
+CORRELATION_METHOD = 'pearson'
+# None runs correlations and t-tests in this process; 'multiprocessing',
+# 'dask' or 'ray' shards them by metabolite columns (see sharding.py)
+EXECUTION_BACKEND = None
+
 def load_data(filename):
     """Load and preprocess metabolomics data"""
     print("Loading metabolomics data...")
@@ -96,18 +116,12 @@ def perform_pca_analysis(data):
     
     # Create subplot for PCA plot
     plt.subplot(2, 2, 1)
-    colors = ['red' if 'normal' in idx.lower() else 'blue' for idx in data.index]
-    plt.scatter(pca_df['PC1'], pca_df['PC2'], c=colors, alpha=0.7)
+    pca_scatter(plt.gca(), pca_df, data.index)
     plt.xlabel(f'PC1 ({pca.explained_variance_ratio_[0]:.1%} variance)')
     plt.ylabel(f'PC2 ({pca.explained_variance_ratio_[1]:.1%} variance)')
     plt.title('PCA Analysis - Sample Distribution')
     plt.grid(True, alpha=0.3)
     
-    # Add sample labels
-    for i, idx in enumerate(data.index):
-        plt.annotate(idx, (pca_df.iloc[i]['PC1'], pca_df.iloc[i]['PC2']), 
-                    fontsize=8, alpha=0.7)
-    
     # Variance explained plot
     plt.subplot(2, 2, 2)
     cumvar = np.cumsum(pca.explained_variance_ratio_)[:10]
@@ -151,38 +165,39 @@ def perform_pca_analysis(data):
     
     return pca, pca_df
 
-def correlation_analysis(data):
+def correlation_analysis(data, method=CORRELATION_METHOD, backend=EXECUTION_BACKEND,
+                         n_workers=None):
     """Perform correlation analysis"""
-    print("\nPerforming correlation analysis...")
-    
-    # Calculate correlation matrix
-    corr_matrix = data.corr()
-    
-    # Find high correlations
-    high_corr_pairs = []
-    for i in range(len(corr_matrix.columns)):
-        for j in range(i+1, len(corr_matrix.columns)):
-            corr_val = corr_matrix.iloc[i, j]
-            if abs(corr_val) > 0.7:
-                high_corr_pairs.append({
-                    'Metabolite1': corr_matrix.columns[i],
-                    'Metabolite2': corr_matrix.columns[j],
-                    'Correlation': corr_val
-                })
+    print(f"\nPerforming correlation analysis ({method})...")
+    threshold = CORRELATION_THRESHOLDS[method]
     
-    high_corr_df = pd.DataFrame(high_corr_pairs).sort_values('Correlation', 
-                                                           key=abs, 
-                                                           ascending=False)
+    # Select top 50 most variable metabolites for visualization
+    top_metabolites = data.std().nlargest(50).index
+    
+    # Threshold correlations block by block into a sparse adjacency
+    if method == 'partial':
+        partial = partial_correlations(data)
+        adjacency = dense_to_adjacency(partial, threshold)
+        corr_subset = partial.loc[top_metabolites, top_metabolites]
+    elif method in ('pearson', 'spearman'):
+        # Spearman: rank every column once, then the same Pearson kernel
+        values = rank_columns(data) if method == 'spearman' else data
+        if backend:
+            adjacency = sharded_threshold_correlations(values, threshold, backend, n_workers)
+        else:
+            adjacency = threshold_correlations(values, threshold=threshold)
+        corr_subset = values[top_metabolites].corr()
+    else:
+        raise ValueError(f"Unknown correlation method: {method}")
+    high_corr_df = adjacency_to_pairs(adjacency, data.columns)
+    high_corr_df.attrs['label'] = (f">{threshold}" if method == 'pearson'
+                                   else f"{method}, |r|>{threshold}")
     high_corr_df.to_csv('high_correlations.csv', index=False)
-    print(f"Found {len(high_corr_pairs)} high correlation pairs (>0.7)")
+    print(f"Found {len(high_corr_df)} high correlation pairs (|r|>{threshold})")
     
     # Create correlation heatmap for top metabolites
     plt.figure(figsize=(15, 12))
     
-    # Select top 50 most variable metabolites for visualization
-    top_metabolites = data.std().nlargest(50).index
-    corr_subset = corr_matrix.loc[top_metabolites, top_metabolites]
-    
     sns.heatmap(corr_subset, 
                 cmap='RdBu_r', 
                 center=0, 
@@ -196,9 +211,9 @@ def correlation_analysis(data):
     plt.savefig('correlation_heatmap.png', dpi=300, bbox_inches='tight')
     print("Correlation heatmap saved to correlation_heatmap.png")
     
-    return corr_matrix, high_corr_df
+    return adjacency, high_corr_df
 
-def differential_analysis(data):
+def differential_analysis(data, backend=EXECUTION_BACKEND, n_workers=None):
     """Compare normal vs fasting conditions"""
     print("\nPerforming differential analysis...")
     
@@ -209,7 +224,10 @@ def differential_analysis(data):
     print(f"Normal samples: {len(normal_samples)}")
     print(f"Fasting samples: {len(fasting_samples)}")
     
-    if len(normal_samples) > 0 and len(fasting_samples) > 0:
+    if len(normal_samples) > 0 and len(fasting_samples) > 0 and backend:
+        # Metabolite shards (t-tests and bootstrap CIs) on the execution backend
+        ttest_df = sharded_ttests(data, normal_samples, fasting_samples, backend, n_workers)
+    elif len(normal_samples) > 0 and len(fasting_samples) > 0:
         # Perform t-tests for each metabolite
         ttest_results = []
         
@@ -240,47 +258,30 @@ def differential_analysis(data):
                     'Significant': pvalue < 0.05
                 })
         
-        # Convert to dataframe and sort by p-value
-        ttest_df = pd.DataFrame(ttest_results).sort_values('P_Value')
-        ttest_df.to_csv('differential_analysis_results.csv', index=False)
-        
-        # Create volcano plot
-        plt.figure(figsize=(10, 8))
-        
-        # Filter out invalid values for plotting
-        plot_data = ttest_df.dropna(subset=['Log2_FC', 'P_Value'])
-        log_pval = -np.log10(plot_data['P_Value'])
-        
-        # Color points based on significance and fold change
-        colors = []
-        for _, row in plot_data.iterrows():
-            if row['P_Value'] < 0.05 and abs(row['Log2_FC']) > 1:
-                colors.append('red')  # Significant and large fold change
-            elif row['P_Value'] < 0.05:
-                colors.append('orange')  # Significant but small fold change
-            else:
-                colors.append('gray')  # Not significant
-        
-        plt.scatter(plot_data['Log2_FC'], log_pval, c=colors, alpha=0.6)
-        plt.xlabel('Log2 Fold Change (Fasting/Normal)')
-        plt.ylabel('-Log10 P-Value')
-        plt.title('Volcano Plot: Normal vs Fasting')
+        # Convert to dataframe
+        ttest_df = pd.DataFrame(ttest_results)
         
-        # Add significance lines
-        plt.axhline(y=-np.log10(0.05), color='black', linestyle='--', alpha=0.5)
-        plt.axvline(x=1, color='black', linestyle='--', alpha=0.5)
-        plt.axvline(x=-1, color='black', linestyle='--', alpha=0.5)
-        
-        plt.grid(True, alpha=0.3)
-        plt.tight_layout()
-        plt.savefig('volcano_plot.png', dpi=300, bbox_inches='tight')
-        
-        print(f"Differential analysis completed. {len(ttest_df)} metabolites analyzed.")
-        print(f"Significant metabolites (p<0.05): {sum(ttest_df['Significant'])}")
-        
-        return ttest_df
-    
-    return None
+        # Bootstrap 95% confidence intervals for the fold change
+        tested = ttest_df['Metabolite']
+        ci_lower, ci_upper = bootstrap_fold_change_ci(
+            data.loc[normal_samples, tested].to_numpy(),
+            data.loc[fasting_samples, tested].to_numpy())
+        ttest_df['FC_CI_Lower'] = ci_lower
+        ttest_df['FC_CI_Upper'] = ci_upper
+    else:
+        return None
+    
+    # Sort by p-value
+    ttest_df = ttest_df.sort_values('P_Value')
+    ttest_df.to_csv('differential_analysis_results.csv', index=False)
+    
+    # Create volcano plot (colors via np.select, top-N labels, binned when large)
+    volcano_plot(ttest_df, 'volcano_plot.png')
+    
+    print(f"Differential analysis completed. {len(ttest_df)} metabolites analyzed.")
+    print(f"Significant metabolites (p<0.05): {sum(ttest_df['Significant'])}")
+    
+    return ttest_df
 
 def create_metabolite_heatmap(data):
     """Create comprehensive metabolite heatmap"""
@@ -314,87 +315,11 @@ def generate_report(data, stats_summary, pca, high_corr_df, ttest_df=None):
     """Generate comprehensive analysis report"""
     print("\nGenerating analysis report...")
     
-    report = f"""# Metabolomics Analysis Report
-
-**Analysis Date:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-**Data Source:** fasting.csv
-
-## Data Overview
-- **Dimensions:** {data.shape[0]} samples × {data.shape[1]} metabolites
-- **Sample Types:** Normal control and 12h fasting conditions
-- **Data Type:** Metabolite concentration measurements
-
-## Data Quality Assessment
-- **Missing values:** {data.isnull().sum().sum()}/{data.size} ({(data.isnull().sum().sum()/data.size)*100:.2f}%)
-- **Data completeness:** {100-(data.isnull().sum().sum()/data.size)*100:.2f}%
-
-## Statistical Summary
-- **Concentration range:** {stats_summary['Mean'].min():.6f} to {stats_summary['Mean'].max():.6f}
-- **Most variable metabolites:** {', '.join(data.std().nlargest(5).index[:3])}...
-
-## Principal Component Analysis Results
-- **PC1 variance explained:** {pca.explained_variance_ratio_[0]:.1%}
-- **PC2 variance explained:** {pca.explained_variance_ratio_[1]:.1%}
-- **Total variance explained (PC1+PC2):** {(pca.explained_variance_ratio_[0] + pca.explained_variance_ratio_[1]):.1%}
-
-## Correlation Analysis Results
-- **High correlations (>0.7):** {len(high_corr_df)} metabolite pairs identified
-- **Strongest positive correlation:** {high_corr_df.iloc[0]['Correlation']:.3f} between {high_corr_df.iloc[0]['Metabolite1'][:30]}... and {high_corr_df.iloc[0]['Metabolite2'][:30]}...
-
-"""
-
-    if ttest_df is not None:
-        significant_metabolites = sum(ttest_df['Significant'])
-        upregulated = sum((ttest_df['Significant']) & (ttest_df['Log2_FC'] > 0))
-        downregulated = sum((ttest_df['Significant']) & (ttest_df['Log2_FC'] < 0))
-        
-        report += f"""## Differential Analysis Results (Normal vs Fasting)
-- **Total metabolites analyzed:** {len(ttest_df)}
-- **Significantly different metabolites (p<0.05):** {significant_metabolites}
-- **Upregulated in fasting:** {upregulated}
-- **Downregulated in fasting:** {downregulated}
-- **Most significant metabolite:** {ttest_df.iloc[0]['Metabolite'][:50]}... (p={ttest_df.iloc[0]['P_Value']:.2e})
-
-"""
-
-    report += """## Generated Files
-- `pca_analysis.png` - Principal Component Analysis plots
-- `correlation_heatmap.png` - Metabolite correlation visualization  
-- `metabolite_heatmap.png` - Concentration heatmap of top variable metabolites
-- `volcano_plot.png` - Differential analysis volcano plot
-- `summary_statistics.csv` - Statistical summary of all metabolites
-- `high_correlations.csv` - List of highly correlated metabolite pairs
-- `differential_analysis_results.csv` - Complete differential analysis results
-- `analysis_report.md` - This comprehensive report
-
-## Interpretation & Insights
-
-### PCA Insights
-The PCA analysis reveals the main sources of metabolic variation between normal and fasting states. The first two principal components capture the primary metabolic differences, helping identify which metabolites contribute most to the distinction between conditions.
-
-### Correlation Patterns
-The correlation analysis identifies metabolites that show coordinated changes, potentially indicating:
-- Shared metabolic pathways
-- Co-regulated metabolites
-- Technical correlations in measurement
-
-### Differential Analysis
-The comparison between normal and fasting states reveals metabolites that show significant changes during the fasting period. These could represent:
-- Metabolic adaptations to fasting
-- Biomarkers of fasting state
-- Key metabolites in energy metabolism
-
-## Conclusion
-This comprehensive metabolomics analysis provides insights into the metabolic changes associated with 12-hour fasting. The results identify key metabolites and patterns that distinguish fasting from normal metabolic states, which may be valuable for understanding metabolic regulation and identifying potential biomarkers.
-
----
-*Analysis performed with Python-based metabolomics workflow*
-"""
-
-    with open('analysis_report.md', 'w') as f:
-        f.write(report)
+    # Every figure is taken from the stage results; unchanged sections are reused
+    context = build_report_context(data, stats_summary, pca, high_corr_df, ttest_df)
+    rerendered = write_report(context)
     
-    print("Analysis report saved to analysis_report.md")
+    print(f"Analysis report saved to analysis_report.md ({rerendered} sections rendered)")
 
 def main():
     """Main analysis workflow"""
@@ -410,21 +335,50 @@ def main():
     # Preprocess data
     numeric_data = preprocess_data(data)
     
+    # Drop mostly-missing, constant and irreproducible features early
+    numeric_data, filter_report = filter_features(numeric_data)
+    
+    # Remove instrument batch effects (batch column of sample_covariates.csv)
+    covariates = load_covariates()
+    numeric_data = batch_correction(numeric_data, covariates)
+    
     # Basic statistics
     stats_summary = basic_statistics(numeric_data)
     
     # PCA analysis
     pca, pca_df = perform_pca_analysis(numeric_data)
     
+    # UMAP / t-SNE layout on a cached kNN graph of the PCA scores
+    embedding_analysis(pca_df)
+    
     # Correlation analysis
-    corr_matrix, high_corr_df = correlation_analysis(numeric_data)
+    adjacency, high_corr_df = correlation_analysis(numeric_data)
+    
+    # Correlation network modules
+    network_analysis(adjacency, numeric_data.columns)
+    
+    # Sample QC: flag (or exclude) outlying injections before the t-tests
+    qc_table = sample_qc(numeric_data)
     
     # Differential analysis
-    ttest_df = differential_analysis(numeric_data)
+    ttest_df = differential_analysis(exclude_outliers(numeric_data, qc_table))
+    
+    # Covariate-adjusted linear models (covariates from sample_covariates.csv if present)
+    linear_model_analysis(exclude_outliers(numeric_data, qc_table), covariates)
+    
+    # Nested-CV classifiers (PLS-DA, L1 logistic regression, random forest)
+    classification_analysis(exclude_outliers(numeric_data, qc_table))
+    
+    # Compound-class enrichment of the differential results
+    if ttest_df is not None:
+        enrichment_analysis(ttest_df)
     
     # Create heatmap
     create_metabolite_heatmap(numeric_data)
     
+    # Static dashboard with paginated results, heatmap tiles and PCA levels
+    export_dashboard(numeric_data, pca_df, ttest_df, pca.explained_variance_ratio_)
+    
     # Generate comprehensive report
     generate_report(numeric_data, stats_summary, pca, high_corr_df, ttest_df)
     
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Scalable Plotting Helpers
+Vectorized point styling, top-N labelling and automatic switch to binned
+(rasterized) rendering for large volcano and PCA scatter plots.
+"""
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgba
+
+try:
+    import datashader as ds
+    import datashader.transfer_functions as tf
+except ImportError:
+    ds = None
+
+# Above this many points scatter plots are drawn as a binned image
+POINT_THRESHOLD = 5000
+# Resolution of the binned image
+RASTER_BINS = 400
+
+VOLCANO_COLORS = np.array(['gray', 'orange', 'red'])
+
+
+def volcano_categories(p_values, log2_fc, p_cutoff=0.05, fc_cutoff=1):
+    """Color index per point: 2 = significant and large FC, 1 = significant, 0 = not"""
+    p_values = np.asarray(p_values, dtype=float)
+    log2_fc = np.asarray(log2_fc, dtype=float)
+    significant = p_values < p_cutoff
+    return np.select([significant & (np.abs(log2_fc) > fc_cutoff), significant],
+                     [2, 1], default=0)
+
+
+def top_n_indices(scores, top_n):
+    """Indices of the top_n largest scores, largest first"""
+    scores = np.asarray(scores, dtype=float)
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    if top_n <= 0:
+        return np.array([], dtype=int)
+    if len(scores) <= top_n:
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, top_n - 1)[:top_n]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def label_top_points(ax, x, y, labels, scores, top_n=20, fontsize=8):
+    """Annotate only the top_n points by score"""
+    x = np.asarray(x)
+    y = np.asarray(y)
+    labels = np.asarray(labels)
+    for i in top_n_indices(scores, top_n):
+        ax.annotate(labels[i], (x[i], y[i]), fontsize=fontsize, alpha=0.7)
+
+
+def _binned_image(x, y, categories, palette, extent, bins=RASTER_BINS):
+    """Datashader-style aggregate: per-category counts composited into RGBA"""
+    xmin, xmax, ymin, ymax = extent
+    image = np.zeros((bins, bins, 4))
+    weight = np.zeros((bins, bins))
+    for category in np.unique(categories):
+        mask = categories == category
+        counts, _, _ = np.histogram2d(y[mask], x[mask], bins=bins,
+                                      range=[[ymin, ymax], [xmin, xmax]])
+        image += counts[..., None] * np.array(to_rgba(palette[category]))
+        weight += counts
+    filled = weight > 0
+    image[filled] /= weight[filled][:, None]
+    # Log-scaled alpha so dense regions stay visible without saturating
+    image[..., 3] = np.where(filled, 0.3 + 0.7 * np.log1p(weight) / np.log1p(weight.max() or 1), 0)
+    return image
+
+
+def scatter_points(ax, x, y, categories, palette, threshold=POINT_THRESHOLD, alpha=0.6):
+    """Scatter small point sets, rasterize large ones"""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    categories = np.asarray(categories)
+    finite = np.isfinite(x) & np.isfinite(y)
+    x, y, categories = x[finite], y[finite], categories[finite]
+
+    if len(x) <= threshold:
+        ax.scatter(x, y, c=np.asarray(palette)[categories], alpha=alpha)
+        return
+
+    pad_x = (x.max() - x.min()) * 0.02 or 1
+    pad_y = (y.max() - y.min()) * 0.02 or 1
+    extent = (x.min() - pad_x, x.max() + pad_x, y.min() - pad_y, y.max() + pad_y)
+
+    if ds is not None:
+        import pandas as pd
+        frame = pd.DataFrame({'x': x, 'y': y,
+                              'category': pd.Categorical(categories.astype(str))})
+        canvas = ds.Canvas(plot_width=RASTER_BINS, plot_height=RASTER_BINS,
+                           x_range=extent[:2], y_range=extent[2:])
+        aggregate = canvas.points(frame, 'x', 'y', ds.count_cat('category'))
+        color_key = {str(c): palette[c] for c in np.unique(categories)}
+        image = tf.shade(aggregate, color_key=color_key, how='log').to_pil()
+        ax.imshow(np.asarray(image), extent=extent, aspect='auto', origin='upper')
+    else:
+        image = _binned_image(x, y, categories, palette, extent)
+        ax.imshow(image, extent=extent, aspect='auto', origin='lower',
+                  interpolation='nearest')
+    ax.set_xlim(extent[:2])
+    ax.set_ylim(extent[2:])
+
+
+def volcano_plot(ttest_df, filename='volcano_plot.png', top_n=10,
+                 threshold=POINT_THRESHOLD):
+    """Volcano plot of Log2_FC vs -log10(P_Value)"""
+    plot_data = ttest_df.dropna(subset=['Log2_FC', 'P_Value'])
+    log2_fc = plot_data['Log2_FC'].to_numpy(dtype=float)
+    p_values = plot_data['P_Value'].to_numpy(dtype=float)
+    categories = volcano_categories(p_values, log2_fc)
+    # p == 0 would sit at infinity: draw it at the top of the finite range,
+    # but rank it above everything for labelling
+    scores = -np.log10(np.maximum(p_values, np.finfo(float).tiny))
+    with np.errstate(divide='ignore'):
+        log_pval = -np.log10(p_values)
+    finite = np.isfinite(log_pval)
+    cap = log_pval[finite].max() if finite.any() else scores.max(initial=0.0)
+    log_pval = np.where(np.isposinf(log_pval), cap, log_pval)
+
+    fig, ax = plt.subplots(figsize=(10, 8))
+    scatter_points(ax, log2_fc, log_pval, categories, VOLCANO_COLORS, threshold)
+    label_top_points(ax, log2_fc, log_pval,
+                     [m[:20] for m in plot_data['Metabolite']], scores, top_n)
+    ax.set_xlabel('Log2 Fold Change (Fasting/Normal)')
+    ax.set_ylabel('-Log10 P-Value')
+    ax.set_title('Volcano Plot: Normal vs Fasting')
+
+    # Add significance lines
+    ax.axhline(y=-np.log10(0.05), color='black', linestyle='--', alpha=0.5)
+    ax.axvline(x=1, color='black', linestyle='--', alpha=0.5)
+    ax.axvline(x=-1, color='black', linestyle='--', alpha=0.5)
+
+    ax.grid(True, alpha=0.3)
+    fig.tight_layout()
+    fig.savefig(filename, dpi=300, bbox_inches='tight')
+    plt.close(fig)
+
+
+def pca_scatter(ax, pca_df, sample_names, top_n=20, threshold=POINT_THRESHOLD,
+                columns=('PC1', 'PC2')):
+    """PC1/PC2 (or other score columns) scatter colored by group, labelling the most extreme samples"""
+    names = np.asarray(sample_names, dtype=str)
+    groups = np.where(np.char.find(np.char.lower(names), 'normal') >= 0, 0, 1)
+    pc1 = pca_df[columns[0]].to_numpy()
+    pc2 = pca_df[columns[1]].to_numpy()
+    scatter_points(ax, pc1, pc2, groups, np.array(['red', 'blue']), threshold, alpha=0.7)
+    label_top_points(ax, pc1, pc2, names, np.hypot(pc1, pc2), top_n)
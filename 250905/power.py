@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Power and Sample-Size Simulation
+Plans new normal vs fasting studies from a pilot dataset. Group means,
+pooled standard deviations and a shrunk low-rank correlation model
+(shared factors plus metabolite-specific noise) are estimated once; then
+thousands of cohorts per sample size are drawn as (simulations x samples x
+metabolites) arrays, t-tested in one pass and Benjamini-Hochberg corrected
+row by row. Reports expected discoveries, power and false discovery
+proportion against the number of samples per group.
+Usage: python power.py [data.csv] [n_simulations]
+"""
+
+import sys
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from scipy import stats
+from correlation_network import ledoit_wolf_shrinkage
+from stats_utils import bh_rejections
+
+POWER_FILE = 'power_analysis.csv'
+METABOLITE_POWER_FILE = 'power_by_metabolite.csv'
+POWER_PLOT_FILE = 'power_curve.png'
+# Samples per group to simulate
+SAMPLE_SIZES = [3, 5, 10, 15, 20, 30, 50]
+N_SIMULATIONS = 1000
+FDR_LEVEL = 0.05
+TARGET_POWER = 0.8
+# Pilot effects below this |Cohen's d| are simulated as true nulls
+MIN_EFFECT_SIZE = 0.2
+# Shared factors of the correlation model (capped by the pilot's residual rank)
+N_FACTORS = 20
+# Largest simulations x samples x metabolites block drawn at once (~128 MB)
+BATCH_ELEMENTS = 1 << 24
+SEED = 0
+
+
+def estimate_parameters(data, normal_samples, fasting_samples, n_factors=N_FACTORS):
+    """Effects, pooled SDs and factor correlation model of the testable metabolites
+
+    Returns a DataFrame (Metabolite, Normal_Mean, Fasting_Mean, Pooled_SD,
+    Effect_Size) and the loadings (p x k) and specific variances (p) of a
+    unit-diagonal correlation matrix loadings @ loadings.T + diag(specific).
+    """
+    normal = data.loc[normal_samples].to_numpy(dtype=np.float64)
+    fasting = data.loc[fasting_samples].to_numpy(dtype=np.float64)
+    n_normal = np.sum(~np.isnan(normal), axis=0)
+    n_fasting = np.sum(~np.isnan(fasting), axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_normal = np.nanmean(normal, axis=0)
+        mean_fasting = np.nanmean(fasting, axis=0)
+        residuals = np.vstack([normal - mean_normal, fasting - mean_fasting])
+        pooled_sd = np.sqrt(np.nansum(residuals ** 2, axis=0) / (n_normal + n_fasting - 2))
+    # Same metabolites differential_analysis can test, minus constant ones
+    testable = (n_normal >= 2) & (n_fasting >= 2) & (pooled_sd > 0)
+
+    # Standardized within-group residuals; missing values carry no signal
+    scaled = np.nan_to_num(residuals[:, testable] / pooled_sd[testable])
+    shrinkage, mu = ledoit_wolf_shrinkage(scaled)
+    _, singular, components = np.linalg.svd(scaled / np.sqrt(len(scaled)), full_matrices=False)
+    n_factors = min(n_factors, int(np.sum(singular > singular[0] * 1e-8)))
+    loadings = components[:n_factors].T * singular[:n_factors] * np.sqrt(1 - shrinkage)
+    # Diagonal of the shrunk covariance, used to rescale it to a correlation
+    variance = (1 - shrinkage) * np.sum(scaled ** 2, axis=0) / len(scaled) + shrinkage * mu
+    specific = np.maximum(variance - np.sum(loadings ** 2, axis=1), 0) / variance
+    loadings /= np.sqrt(variance)[:, None]
+
+    parameters = pd.DataFrame({
+        'Metabolite': data.columns[testable],
+        'Normal_Mean': mean_normal[testable],
+        'Fasting_Mean': mean_fasting[testable],
+        'Pooled_SD': pooled_sd[testable],
+        'Effect_Size': (mean_fasting - mean_normal)[testable] / pooled_sd[testable],
+    })
+    return parameters, loadings, specific
+
+
+def simulate_cohorts(n_sims, n_per_group, effects, loadings, specific, rng):
+    """(n_sims x 2n x p) standardized cohorts: normal rows first, fasting shifted by effects"""
+    factors = rng.standard_normal((n_sims, 2 * n_per_group, loadings.shape[1]))
+    noise = rng.standard_normal((n_sims, 2 * n_per_group, len(effects)))
+    cohorts = factors @ loadings.T
+    cohorts += noise * np.sqrt(specific)
+    cohorts[:, n_per_group:] += effects
+    return cohorts
+
+
+def batched_ttests(cohorts, n_per_group):
+    """Pooled-variance t-test p-values (as stats.ttest_ind) for every simulation x metabolite"""
+    normal = cohorts[:, :n_per_group]
+    fasting = cohorts[:, n_per_group:]
+    df = 2 * n_per_group - 2
+    pooled = (normal.var(axis=1, ddof=1) + fasting.var(axis=1, ddof=1)) / 2
+    t_stat = (fasting.mean(axis=1) - normal.mean(axis=1)) / np.sqrt(pooled * 2 / n_per_group)
+    return 2 * stats.t.sf(np.abs(t_stat), df)
+
+
+def simulate_power(parameters, loadings, specific, sample_sizes=SAMPLE_SIZES,
+                   n_sims=N_SIMULATIONS, fdr=FDR_LEVEL, min_effect=MIN_EFFECT_SIZE,
+                   batch_elements=BATCH_ELEMENTS, seed=SEED):
+    """Discoveries per simulated cohort and per-metabolite detection rates per sample size"""
+    # Cohorts are simulated in SD units; t-tests are scale invariant per metabolite
+    effects = parameters['Effect_Size'].to_numpy(dtype=np.float64)
+    effects = np.where(np.abs(effects) >= min_effect, effects, 0.0)
+    true_effects = effects != 0
+    rng = np.random.default_rng(seed)
+
+    summary = []
+    detection = {}
+    for n_per_group in sample_sizes:
+        batch = max(1, batch_elements // (2 * n_per_group * len(effects)))
+        discoveries, true_discoveries, detected = [], [], np.zeros(len(effects))
+        for start in range(0, n_sims, batch):
+            cohorts = simulate_cohorts(min(batch, n_sims - start), n_per_group,
+                                       effects, loadings, specific, rng)
+            rejected = bh_rejections(batched_ttests(cohorts, n_per_group), fdr)
+            discoveries.append(rejected.sum(axis=1))
+            true_discoveries.append(rejected[:, true_effects].sum(axis=1))
+            detected += rejected.sum(axis=0)
+        discoveries = np.concatenate(discoveries)
+        true_discoveries = np.concatenate(true_discoveries)
+        false_proportion = (discoveries - true_discoveries) / np.maximum(discoveries, 1)
+        summary.append({
+            'Samples_Per_Group': n_per_group,
+            'Expected_Discoveries': discoveries.mean(),
+            'Expected_True_Discoveries': true_discoveries.mean(),
+            'Expected_False_Discoveries': (discoveries - true_discoveries).mean(),
+            'Discoveries_Q05': np.percentile(discoveries, 5),
+            'Discoveries_Q95': np.percentile(discoveries, 95),
+            'Average_Power': (true_discoveries.mean() / true_effects.sum()
+                              if true_effects.any() else np.nan),
+            'Expected_FDP': false_proportion.mean(),
+        })
+        detection[f'Power_N{n_per_group}'] = detected / n_sims
+        print(f"n = {n_per_group} per group: {discoveries.mean():.1f} expected discoveries")
+
+    by_metabolite = parameters.assign(True_Effect=true_effects, **detection)
+    return pd.DataFrame(summary), by_metabolite
+
+
+def plot_power_curve(summary, n_true, fdr=FDR_LEVEL, filename=POWER_PLOT_FILE):
+    """Expected discoveries and average power against samples per group"""
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 5))
+    n = summary['Samples_Per_Group']
+    ax1.plot(n, summary['Expected_Discoveries'], 'o-', label='All discoveries')
+    ax1.plot(n, summary['Expected_True_Discoveries'], 's--', label='True discoveries')
+    ax1.fill_between(n, summary['Discoveries_Q05'], summary['Discoveries_Q95'], alpha=0.2)
+    ax1.axhline(y=n_true, color='black', linestyle=':', alpha=0.5)
+    ax1.set_xlabel('Samples per group')
+    ax1.set_ylabel(f'Discoveries (BH FDR < {fdr})')
+    ax1.set_title('Expected Discoveries')
+    ax1.legend()
+    ax2.plot(n, summary['Average_Power'], 'o-')
+    ax2.axhline(y=TARGET_POWER, color='black', linestyle='--', alpha=0.5)
+    ax2.set_ylim(0, 1)
+    ax2.set_xlabel('Samples per group')
+    ax2.set_ylabel('Average power')
+    ax2.set_title('Power vs Sample Size')
+    for ax in (ax1, ax2):
+        ax.grid(True, alpha=0.3)
+    fig.tight_layout()
+    fig.savefig(filename, dpi=300, bbox_inches='tight')
+    plt.close(fig)
+
+
+def power_analysis(data, sample_sizes=SAMPLE_SIZES, n_sims=N_SIMULATIONS, fdr=FDR_LEVEL):
+    """Estimate pilot parameters, simulate every sample size and save the tables and plot"""
+    print("\nPerforming power analysis...")
+    normal_samples = [idx for idx in data.index if 'normal' in idx.lower()]
+    fasting_samples = [idx for idx in data.index if 'fasting' in idx.lower()]
+    if len(normal_samples) < 2 or len(fasting_samples) < 2:
+        print("Need at least two normal and two fasting samples")
+        return None
+
+    parameters, loadings, specific = estimate_parameters(data, normal_samples, fasting_samples)
+    n_true = int(np.sum(np.abs(parameters['Effect_Size']) >= MIN_EFFECT_SIZE))
+    print(f"{len(parameters)} metabolites, {n_true} with |d| >= {MIN_EFFECT_SIZE}, "
+          f"{loadings.shape[1]} correlation factors")
+    summary, by_metabolite = simulate_power(parameters, loadings, specific,
+                                            sample_sizes, n_sims, fdr)
+
+    summary.to_csv(POWER_FILE, index=False)
+    by_metabolite.to_csv(METABOLITE_POWER_FILE, index=False)
+    plot_power_curve(summary, n_true, fdr)
+    reached = summary[summary['Average_Power'] >= TARGET_POWER]
+    if len(reached) > 0:
+        print(f"Average power >= {TARGET_POWER} from "
+              f"{reached['Samples_Per_Group'].iloc[0]} samples per group")
+    else:
+        print(f"Average power stays below {TARGET_POWER} up to "
+              f"{summary['Samples_Per_Group'].iloc[-1]} samples per group")
+    print(f"Power analysis saved to {POWER_FILE}, {METABOLITE_POWER_FILE} and {POWER_PLOT_FILE}")
+    return summary
+
+
+def main():
+    """python power.py [data.csv] [n_simulations]"""
+    from metabolomics_analysis import load_data, preprocess_data, filter_features
+
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'fasting.csv'
+    n_sims = int(sys.argv[2]) if len(sys.argv) > 2 else N_SIMULATIONS
+    data = load_data(filename)
+    if data is None:
+        return
+    numeric_data, _ = filter_features(preprocess_data(data))
+    power_analysis(numeric_data, n_sims=n_sims)
+
+
+if __name__ == "__main__":
+    main()
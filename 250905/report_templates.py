@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Report Templates
+Compiled Markdown/HTML templates for analysis_report.md. Every figure comes
+from a precomputed report context, and only sections whose template or
+inputs changed are re-rendered.
+"""
+
+import os
+import re
+import sys
+import json
+import hashlib
+import string
+from datetime import datetime
+
+CONTEXT_FILE = 'report_context.json'
+# Values for context keys added after older runs were stored
+CONTEXT_DEFAULTS = {'correlation_label': '>0.7'}
+
+
+def compile_template(source):
+    """Parse a str.format template once into (literal, field, spec) pieces"""
+    pieces = []
+    for literal, field, spec, conversion in string.Formatter().parse(source):
+        pieces.append((literal, field, spec or ''))
+    return source, pieces
+
+
+def render_template(compiled, context):
+    """Render a compiled template against a context dict"""
+    _, pieces = compiled
+    out = []
+    for literal, field, spec in pieces:
+        out.append(literal)
+        if field is not None:
+            out.append(format(context[field], spec))
+    return ''.join(out)
+
+
+# Section name -> (template, context keys it depends on)
+SECTION_SOURCES = [
+    ('header', """# Metabolomics Analysis Report
+
+**Analysis Date:** {analysis_date}
+**Data Source:** {data_source}
+
+""", ['analysis_date', 'data_source']),
+
+    ('overview', """## Data Overview
+- **Dimensions:** {n_samples} samples × {n_metabolites} metabolites
+- **Sample Types:** Normal control and 12h fasting conditions
+- **Data Type:** Metabolite concentration measurements
+
+""", ['n_samples', 'n_metabolites']),
+
+    ('quality', """## Data Quality Assessment
+- **Missing values:** {n_missing}/{n_values} ({missing_percent:.2f}%)
+- **Data completeness:** {completeness:.2f}%
+
+""", ['n_missing', 'n_values', 'missing_percent', 'completeness']),
+
+    ('statistics', """## Statistical Summary
+- **Concentration range:** {mean_min:.6f} to {mean_max:.6f}
+- **Most variable metabolites:** {top_variable}...
+
+""", ['mean_min', 'mean_max', 'top_variable']),
+
+    ('pca', """## Principal Component Analysis Results
+- **PC1 variance explained:** {pc1_variance:.1%}
+- **PC2 variance explained:** {pc2_variance:.1%}
+- **Total variance explained (PC1+PC2):** {pc12_variance:.1%}
+
+""", ['pc1_variance', 'pc2_variance', 'pc12_variance']),
+
+    ('correlation', """## Correlation Analysis Results
+- **High correlations ({correlation_label}):** {n_high_corr} metabolite pairs identified
+- **Strongest correlation:** {strongest_correlation}
+
+""", ['correlation_label', 'n_high_corr', 'strongest_correlation']),
+
+    ('differential', """## Differential Analysis Results (Normal vs Fasting)
+- **Total metabolites analyzed:** {n_tested}
+- **Significantly different metabolites (p<0.05):** {n_significant}
+- **Upregulated in fasting:** {n_up}
+- **Downregulated in fasting:** {n_down}
+- **Most significant metabolite:** {top_metabolite}
+
+""", ['n_tested', 'n_significant', 'n_up', 'n_down', 'top_metabolite']),
+
+    ('files', """## Generated Files
+- `pca_analysis.png` - Principal Component Analysis plots
+- `embedding_plot.png` - UMAP / t-SNE sample embedding
+- `correlation_heatmap.png` - Metabolite correlation visualization
+- `metabolite_heatmap.png` - Concentration heatmap of top variable metabolites
+- `volcano_plot.png` - Differential analysis volcano plot
+- `feature_filter_report.csv` - Per-metabolite filter metrics and drop reasons
+- `summary_statistics.csv` - Statistical summary of all metabolites
+- `high_correlations.csv` - List of highly correlated metabolite pairs
+- `correlation_modules.csv` - Correlation network modules
+- `correlation_network.graphml` - Correlation network for graph tools
+- `sample_qc.csv` - Per-sample QC metrics and outlier flags
+- `differential_analysis_results.csv` - Complete differential analysis results
+- `linear_model_results.csv` - Covariate-adjusted linear model results
+- `classifier_performance.csv` - Cross-validated classifier performance
+- `classifier_importance.csv` - VIP and feature importance per metabolite
+- `enrichment_results.csv` - Compound-class enrichment results
+- `analysis_report.md` - This comprehensive report
+- `analysis_report.html` - HTML version of this report
+- `dashboard/index.html` - Interactive dashboard (opens from disk)
+
+""", []),
+
+    ('interpretation', """## Interpretation & Insights
+
+### PCA Insights
+The PCA analysis reveals the main sources of metabolic variation between normal and fasting states. The first two principal components capture the primary metabolic differences, helping identify which metabolites contribute most to the distinction between conditions.
+
+### Correlation Patterns
+The correlation analysis identifies metabolites that show coordinated changes, potentially indicating:
+- Shared metabolic pathways
+- Co-regulated metabolites
+- Technical correlations in measurement
+
+### Differential Analysis
+The comparison between normal and fasting states reveals metabolites that show significant changes during the fasting period. These could represent:
+- Metabolic adaptations to fasting
+- Biomarkers of fasting state
+- Key metabolites in energy metabolism
+
+## Conclusion
+This comprehensive metabolomics analysis provides insights into the metabolic changes associated with 12-hour fasting. The results identify key metabolites and patterns that distinguish fasting from normal metabolic states, which may be valuable for understanding metabolic regulation and identifying potential biomarkers.
+
+---
+*Analysis performed with Python-based metabolomics workflow*
+""", []),
+]
+
+SECTIONS = [(name, compile_template(source), keys) for name, source, keys in SECTION_SOURCES]
+
+HTML_PAGE = compile_template("""<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <title>{title}</title>
+    <style>
+        body {{ font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; line-height: 1.6; color: #333; max-width: 1000px; margin: 0 auto; padding: 20px; }}
+        h1 {{ color: #4a4a8a; }}
+        h2 {{ border-bottom: 2px solid #667eea; padding-bottom: 4px; }}
+        code {{ background: #f0f0f0; padding: 1px 4px; border-radius: 3px; }}
+    </style>
+</head>
+<body>
+{body}
+</body>
+</html>
+""")
+
+
+def _shorten(name, width):
+    """Truncate long metabolite names the way the report always has"""
+    return name[:width] + '...' if len(name) > width else name
+
+
+def build_report_context(data, stats_summary, pca, high_corr_df, ttest_df=None,
+                         data_source='fasting.csv'):
+    """Collect every figure the report needs from the stage results"""
+    n_missing = int(data.isnull().sum().sum())
+    missing_percent = n_missing / data.size * 100 if data.size else 0.0
+    variance_ratio = pca.explained_variance_ratio_
+
+    context = {
+        'analysis_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'data_source': data_source,
+        'n_samples': int(data.shape[0]),
+        'n_metabolites': int(data.shape[1]),
+        'n_missing': n_missing,
+        'n_values': int(data.size),
+        'missing_percent': missing_percent,
+        'completeness': 100 - missing_percent,
+        'mean_min': float(stats_summary['Mean'].min()),
+        'mean_max': float(stats_summary['Mean'].max()),
+        'top_variable': ', '.join(stats_summary['Std'].nlargest(5).index[:3]),
+        'pc1_variance': float(variance_ratio[0]),
+        'pc2_variance': float(variance_ratio[1]) if len(variance_ratio) > 1 else 0.0,
+        'n_high_corr': int(len(high_corr_df)),
+        'correlation_label': high_corr_df.attrs.get('label', CONTEXT_DEFAULTS['correlation_label']),
+        'strongest_correlation': 'none above threshold',
+        'has_differential': ttest_df is not None,
+    }
+    context['pc12_variance'] = context['pc1_variance'] + context['pc2_variance']
+
+    if len(high_corr_df) > 0:
+        top = high_corr_df.iloc[0]
+        context['strongest_correlation'] = (
+            f"{top['Correlation']:.3f} between {top['Metabolite1'][:30]}... "
+            f"and {top['Metabolite2'][:30]}...")
+
+    if ttest_df is not None:
+        significant = ttest_df['Significant'].astype(bool)
+        context.update({
+            'n_tested': int(len(ttest_df)),
+            'n_significant': int(significant.sum()),
+            'n_up': int((significant & (ttest_df['Log2_FC'] > 0)).sum()),
+            'n_down': int((significant & (ttest_df['Log2_FC'] < 0)).sum()),
+            'top_metabolite': 'none',
+        })
+        if len(ttest_df) > 0:
+            top = ttest_df.iloc[0]
+            context['top_metabolite'] = (f"{_shorten(top['Metabolite'], 50)} "
+                                         f"(p={top['P_Value']:.2e})")
+    return context
+
+
+def _section_key(compiled, keys, context):
+    """Hash of a section's template text and the inputs it reads"""
+    source, _ = compiled
+    inputs = json.dumps([context.get(key) for key in keys], default=str)
+    return hashlib.sha1((source + inputs).encode('utf-8')).hexdigest()
+
+
+def render_sections(context, cache=None):
+    """Render every section, reusing cached text where nothing changed"""
+    cache = cache or {}
+    sections = {}
+    rerendered = 0
+    for name, compiled, keys in SECTIONS:
+        if name == 'differential' and not context.get('has_differential'):
+            continue
+        key = _section_key(compiled, keys, context)
+        cached = cache.get(name)
+        if cached is not None and cached['key'] == key:
+            sections[name] = cached
+        else:
+            sections[name] = {'key': key, 'markdown': render_template(compiled, context)}
+            rerendered += 1
+    return sections, rerendered
+
+
+def markdown_to_html(markdown):
+    """Convert the small Markdown subset used by the report templates"""
+    html = []
+    in_list = False
+    for line in markdown.splitlines():
+        text = (line.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'))
+        text = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', text)
+        text = re.sub(r'`(.+?)`', r'<code>\1</code>', text)
+        text = re.sub(r'^\*(.+)\*$', r'<em>\1</em>', text)
+        if text.startswith('- '):
+            if not in_list:
+                html.append('<ul>')
+                in_list = True
+            html.append(f'<li>{text[2:].strip()}</li>')
+            continue
+        if in_list:
+            html.append('</ul>')
+            in_list = False
+        heading = re.match(r'^(#{1,6}) (.*)$', text)
+        if heading:
+            level = len(heading.group(1))
+            html.append(f'<h{level}>{heading.group(2)}</h{level}>')
+        elif text.strip() == '---':
+            html.append('<hr>')
+        elif text.strip():
+            html.append(f'<p>{text.strip()}</p>')
+    if in_list:
+        html.append('</ul>')
+    return '\n'.join(html)
+
+
+def write_report(context, output_dir='.', report_name='analysis_report'):
+    """Render the report into output_dir as Markdown and HTML"""
+    context_path = os.path.join(output_dir, CONTEXT_FILE)
+    cache = {}
+    if os.path.exists(context_path):
+        with open(context_path) as f:
+            cache = json.load(f).get('sections', {})
+
+    sections, rerendered = render_sections(context, cache)
+    report = ''.join(section['markdown'] for section in sections.values())
+
+    with open(os.path.join(output_dir, f'{report_name}.md'), 'w') as f:
+        f.write(report)
+    with open(os.path.join(output_dir, f'{report_name}.html'), 'w') as f:
+        f.write(render_template(HTML_PAGE, {'title': 'Metabolomics Analysis Report',
+                                            'body': markdown_to_html(report)}))
+    with open(context_path, 'w') as f:
+        json.dump({'context': context, 'sections': sections}, f, indent=1, default=str)
+
+    return rerendered
+
+
+def rebuild_report(run_dir):
+    """Re-render one run's report from its stored context"""
+    context_path = os.path.join(run_dir, CONTEXT_FILE)
+    if not os.path.exists(context_path):
+        return None
+    with open(context_path) as f:
+        context = {**CONTEXT_DEFAULTS, **json.load(f)['context']}
+    return write_report(context, run_dir)
+
+
+def rebuild_reports(results_dir='results/metabolomics-analysis'):
+    """Re-render every run's report, e.g. after changing template wording"""
+    print(f"Rebuilding reports under {results_dir}...")
+    rebuilt = 0
+    sections = 0
+    for run in sorted(os.listdir(results_dir)):
+        rerendered = rebuild_report(os.path.join(results_dir, run))
+        if rerendered is not None:
+            rebuilt += 1
+            sections += rerendered
+    print(f"Rebuilt {rebuilt} report(s), re-rendered {sections} section(s)")
+    return rebuilt
+
+
+if __name__ == "__main__":
+    rebuild_reports(*sys.argv[1:2])
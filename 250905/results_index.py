@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Cross-Run Results Index
+Builds a compact columnar index over results/metabolomics-analysis/<run>/
+and answers per-metabolite queries across runs without re-reading CSVs.
+"""
+
+import os
+import sys
+import warnings
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+RESULTS_DIR = 'results/metabolomics-analysis'
+# Index archive kept inside the results directory it covers
+INDEX_NAME = 'results_index.npz'
+INDEX_FILE = os.path.join(RESULTS_DIR, INDEX_NAME)
+
+# Value columns stored for every (run, metabolite) row
+INDEX_COLUMNS = ['Mean', 'Std', 'Log2_FC', 'P_Value']
+
+# Files whose modification time defines whether a run must be re-indexed
+RUN_FILES = ['summary_statistics.csv', 'summary_stats.csv',
+             'differential_analysis_results.csv', 'fasting.csv']
+
+
+def discover_runs(results_dir=RESULTS_DIR):
+    """List timestamped run directories in chronological order"""
+    if not os.path.isdir(results_dir):
+        return []
+    return sorted(name for name in os.listdir(results_dir)
+                  if os.path.isdir(os.path.join(results_dir, name))
+                  and name[:8].isdigit())
+
+
+def run_signature(run_dir):
+    """Cheap change detector: latest mtime over the files we read"""
+    signature = 0
+    for filename in RUN_FILES:
+        path = os.path.join(run_dir, filename)
+        if os.path.exists(path):
+            signature = max(signature, os.stat(path).st_mtime_ns)
+    return signature
+
+
+def parse_summary_stats(path):
+    """Read Mean/Std from either the Python or the R summary() layout"""
+    raw = pd.read_csv(path, index_col=0)
+    raw.columns = [str(c).strip() for c in raw.columns]
+
+    # Python layout: one row per metabolite with Mean/Std columns
+    if 'Mean' in raw.columns:
+        if 'Metabolite' in raw.columns:
+            raw = raw.set_index('Metabolite')
+        summary = raw.reindex(columns=['Mean', 'Std'])
+        return summary.apply(pd.to_numeric, errors='coerce')
+
+    # R layout: summary(data) written as text cells such as "Mean   :0.000959"
+    cells = raw.astype(str)
+    mean_cells = cells.apply(lambda col: col[col.str.strip().str.startswith('Mean')]
+                             .str.split(':', n=1).str[-1].head(1))
+    if mean_cells.empty:
+        return pd.DataFrame(columns=['Mean', 'Std'])
+    means = pd.to_numeric(mean_cells.iloc[0], errors='coerce').dropna()
+    return pd.DataFrame({'Mean': means, 'Std': np.nan})
+
+
+def parse_differential_results(path):
+    """Read Log2_FC/P_Value from a differential_analysis_results.csv"""
+    results = pd.read_csv(path, index_col='Metabolite')
+    return results.reindex(columns=['Log2_FC', 'P_Value'])
+
+
+def snapshot_statistics(data_path):
+    """Derive Mean/Std/Log2_FC/P_Value from a run's fasting.csv snapshot"""
+    # metabolomics_analysis silences all warnings when imported; keep that local
+    with warnings.catch_warnings():
+        from metabolomics_analysis import load_data, preprocess_data
+
+    data = load_data(data_path)
+    if data is None:
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+    data = preprocess_data(data)
+
+    snapshot = pd.DataFrame({'Mean': data.mean(), 'Std': data.std()})
+    normal = data.index.str.lower().str.contains('normal')
+    fasting = data.index.str.lower().str.contains('fasting')
+    if normal.any() and fasting.any():
+        normal_values = data[normal]
+        fasting_values = data[fasting]
+        _, p_values = stats.ttest_ind(normal_values, fasting_values,
+                                      nan_policy='omit')
+        enough = (normal_values.count() >= 2) & (fasting_values.count() >= 2)
+        normal_mean = normal_values.mean()
+        fold_change = (fasting_values.mean() / normal_mean).where(normal_mean > 0)
+        snapshot['Log2_FC'] = np.log2(fold_change.where(fold_change > 0)).where(enough)
+        snapshot['P_Value'] = pd.Series(np.asarray(p_values), index=data.columns).where(enough)
+    return snapshot.reindex(columns=INDEX_COLUMNS)
+
+
+def index_run(run_dir):
+    """Collect the indexed columns for one run directory"""
+    stored = pd.DataFrame(columns=INDEX_COLUMNS, dtype=float)
+    for filename in ['summary_statistics.csv', 'summary_stats.csv']:
+        path = os.path.join(run_dir, filename)
+        if os.path.exists(path):
+            stored = parse_summary_stats(path).reindex(columns=INDEX_COLUMNS)
+            break
+
+    diff_path = os.path.join(run_dir, 'differential_analysis_results.csv')
+    if os.path.exists(diff_path):
+        diff = parse_differential_results(diff_path)
+        stored = stored.reindex(stored.index.union(diff.index))
+        stored[['Log2_FC', 'P_Value']] = diff.reindex(stored.index)
+
+    # Older runs only kept R summaries; fill the gaps from the input snapshot
+    snapshot_path = os.path.join(run_dir, 'fasting.csv')
+    if (stored.empty or stored.isnull().all().any()) and os.path.exists(snapshot_path):
+        stored = stored.combine_first(snapshot_statistics(snapshot_path))
+
+    stored = stored.reindex(columns=INDEX_COLUMNS).astype(float)
+    stored.index = stored.index.astype(str).str.strip()
+    return stored[~stored.index.duplicated()]
+
+
+def empty_index():
+    """Index with no runs"""
+    index = {
+        'runs': np.array([], dtype=str),
+        'signatures': np.array([], dtype=np.int64),
+        'metabolites': np.array([], dtype=str),
+        'run_code': np.array([], dtype=np.int32),
+        'metabolite_code': np.array([], dtype=np.int32),
+    }
+    for column in INDEX_COLUMNS:
+        index[column] = np.array([], dtype=np.float64)
+    return index
+
+
+def load_index(index_path=INDEX_FILE):
+    """Load a saved index, or an empty one if none exists yet"""
+    if not os.path.exists(index_path):
+        return empty_index()
+    with np.load(index_path, allow_pickle=False) as stored:
+        return {key: stored[key] for key in stored.files}
+
+
+def save_index(index, index_path=INDEX_FILE):
+    """Persist the index as a compressed columnar archive"""
+    os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+    np.savez_compressed(index_path, **index)
+
+
+def _sort_index(index):
+    """Keep rows ordered by (metabolite, run) so lookups are a binary search"""
+    order = np.lexsort((index['run_code'], index['metabolite_code']))
+    for key in ['run_code', 'metabolite_code'] + INDEX_COLUMNS:
+        index[key] = index[key][order]
+    return index
+
+
+def update_index(results_dir=RESULTS_DIR, index_path=None):
+    """Index new or modified runs and drop runs that disappeared
+
+    The index lives in results_dir unless index_path is given.
+    """
+    print("Updating cross-run results index...")
+    if index_path is None:
+        index_path = os.path.join(results_dir, INDEX_NAME)
+    index = load_index(index_path)
+
+    known = dict(zip(index['runs'].tolist(), index['signatures'].tolist()))
+    runs = discover_runs(results_dir)
+    signatures = {run: run_signature(os.path.join(results_dir, run)) for run in runs}
+    changed = [run for run in runs if known.get(run) != signatures[run]]
+    removed = [run for run, signature in known.items()
+               if run not in signatures and signature != -1]
+
+    if not changed and not removed:
+        print(f"Index up to date ({len(runs)} runs, {len(index['run_code'])} rows)")
+        return index
+
+    # Drop stale rows; codes stay valid because the run/metabolite tables only grow
+    run_ids = index['runs'].tolist()
+    stale = [run_ids.index(run) for run in changed + removed if run in run_ids]
+    keep = ~np.isin(index['run_code'], stale)
+    for key in ['run_code', 'metabolite_code'] + INDEX_COLUMNS:
+        index[key] = index[key][keep]
+
+    metabolite_ids = index['metabolites'].tolist()
+    metabolite_codes = {name: code for code, name in enumerate(metabolite_ids)}
+    new_blocks = []
+    for run in changed:
+        print(f"  Indexing run {run}")
+        run_stats = index_run(os.path.join(results_dir, run))
+        if run not in run_ids:
+            run_ids.append(run)
+        for name in run_stats.index:
+            if name not in metabolite_codes:
+                metabolite_codes[name] = len(metabolite_ids)
+                metabolite_ids.append(name)
+        block = {
+            'run_code': np.full(len(run_stats), run_ids.index(run), dtype=np.int32),
+            'metabolite_code': np.array([metabolite_codes[name] for name in run_stats.index],
+                                        dtype=np.int32),
+        }
+        for column in INDEX_COLUMNS:
+            block[column] = run_stats[column].to_numpy(dtype=np.float64)
+        new_blocks.append(block)
+
+    for key in ['run_code', 'metabolite_code'] + INDEX_COLUMNS:
+        index[key] = np.concatenate([index[key]] + [block[key] for block in new_blocks])
+
+    index['runs'] = np.array(run_ids, dtype=str)
+    index['metabolites'] = np.array(metabolite_ids, dtype=str)
+    index['signatures'] = np.array([signatures.get(run, -1) for run in run_ids], dtype=np.int64)
+    index = _sort_index(index)
+    save_index(index, index_path)
+
+    print(f"Indexed {len(changed)} run(s); removed {len(removed)}; "
+          f"index now holds {len(index['run_code'])} rows")
+    return index
+
+
+def metabolite_history(index, metabolite):
+    """Values of one metabolite across all indexed runs"""
+    matches = np.flatnonzero(index['metabolites'] == metabolite)
+    if len(matches) == 0:
+        return pd.DataFrame(columns=['Run'] + INDEX_COLUMNS)
+    code = matches[0]
+    start, stop = np.searchsorted(index['metabolite_code'], [code, code + 1])
+    history = pd.DataFrame({column: index[column][start:stop] for column in INDEX_COLUMNS})
+    history.insert(0, 'Run', index['runs'][index['run_code'][start:stop]])
+    return history.sort_values('Run').reset_index(drop=True)
+
+
+def run_table(index, run):
+    """All indexed metabolites for one run"""
+    matches = np.flatnonzero(index['runs'] == run)
+    if len(matches) == 0:
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+    rows = index['run_code'] == matches[0]
+    table = pd.DataFrame({column: index[column][rows] for column in INDEX_COLUMNS},
+                         index=index['metabolites'][index['metabolite_code'][rows]])
+    table.index.name = 'Metabolite'
+    return table
+
+
+def fold_change_drift(index, metabolite):
+    """Run-to-run change of Log2_FC for one metabolite"""
+    history = metabolite_history(index, metabolite)
+    history['Log2_FC_Delta'] = history['Log2_FC'].diff()
+    return history[['Run', 'Log2_FC', 'Log2_FC_Delta', 'P_Value']]
+
+
+def main():
+    """Update the index and optionally print the history of one metabolite"""
+    index = update_index()
+    if len(sys.argv) > 1:
+        metabolite = ' '.join(sys.argv[1:])
+        print(f"\nHistory for {metabolite}:")
+        print(metabolite_history(index, metabolite).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Sample QC and Outlier Detection
+Per-sample missingness, total signal and robust z-scores, plus Hotelling T2
+and DModX distances from a PCA model. Everything is computed as array
+operations so it can run on every batch.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from sklearn.decomposition import PCA
+
+# Confidence level of the T2/DModX limits and the robust-z cutoff
+QC_CONFIDENCE = 0.99
+ROBUST_Z_CUTOFF = 3.5
+# Components kept in the QC PCA model: enough for this much variance...
+QC_VARIANCE = 0.8
+# ...but never more than this
+QC_MAX_COMPONENTS = 10
+# Drop flagged samples before differential analysis instead of only flagging
+QC_EXCLUDE_OUTLIERS = False
+
+
+def robust_z(values):
+    """(x - median) / (1.4826 * MAD)
+
+    When more than half the values tie (e.g. most samples have no missing
+    values) the MAD is zero; the scale then falls back to 1.253314 times the
+    mean absolute deviation from the median, so a single deviating value
+    still stands out. Only all-equal values give z = 0.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    median = np.nanmedian(values)
+    deviation = np.abs(values - median)
+    scale = 1.4826 * np.nanmedian(deviation)
+    if not scale > 0:
+        scale = 1.253314 * np.nanmean(deviation)
+    if not scale > 0:
+        return np.zeros_like(values)
+    return (values - median) / scale
+
+
+def pca_distances(data, variance=QC_VARIANCE, max_components=QC_MAX_COMPONENTS,
+                  confidence=QC_CONFIDENCE):
+    """Hotelling T2 and normalized DModX per sample with their critical limits"""
+    values = data.to_numpy(dtype=np.float64)
+    # Median-impute, then autoscale; constant columns carry no information
+    values = np.where(np.isnan(values), np.nanmedian(values, axis=0), values)
+    std = values.std(axis=0, ddof=1)
+    values = values[:, std > 0]
+    values = (values - values.mean(axis=0)) / std[std > 0]
+    n_samples, n_features = values.shape
+
+    limit = min(max_components, n_samples - 2, n_features - 1)
+    if limit < 1:
+        nan = np.full(n_samples, np.nan)
+        return nan, nan, np.nan, np.nan, 0
+
+    full = PCA(n_components=limit, svd_solver='full' if n_samples < 500 else 'randomized',
+               random_state=0).fit(values)
+    n_components = int(np.searchsorted(np.cumsum(full.explained_variance_ratio_), variance) + 1)
+    n_components = min(n_components, limit)
+
+    scores = full.transform(values)[:, :n_components]
+    t2 = np.sum(scores ** 2 / full.explained_variance_[:n_components], axis=1)
+    t2_limit = (n_components * (n_samples - 1) / (n_samples - n_components)
+                * stats.f.ppf(confidence, n_components, n_samples - n_components))
+
+    # DModX: residual SD per sample relative to the pooled residual SD. The
+    # limit matches a scaled chi2 to the first two moments of the residual
+    # sums of squares (Nomikos-MacGregor), which holds up better than the
+    # F limit when there are many more features than samples.
+    residuals = values - scores @ full.components_[:n_components]
+    residual_df = n_features - n_components
+    sample_ss = np.sum(residuals ** 2, axis=1)
+    pooled_ss = sample_ss.mean()
+    dmodx = np.sqrt(sample_ss / pooled_ss)
+    scale = sample_ss.var(ddof=1) / (2 * pooled_ss) if n_samples > 2 else 0
+    if scale > 0:
+        dof = 2 * pooled_ss ** 2 / sample_ss.var(ddof=1)
+        dmodx_limit = np.sqrt(scale * stats.chi2.ppf(confidence, dof) / pooled_ss)
+    else:
+        dmodx_limit = np.sqrt(stats.f.ppf(confidence, residual_df, residual_df))
+    return t2, dmodx, t2_limit, dmodx_limit, n_components
+
+
+def sample_qc(data, report_file='sample_qc.csv'):
+    """Flag outlying samples; returns one row of QC metrics per sample"""
+    print("\nRunning sample QC...")
+    values = data.to_numpy(dtype=np.float64)
+
+    qc = pd.DataFrame(index=data.index)
+    qc['Missing_Ratio'] = np.isnan(values).mean(axis=1)
+    qc['Total_Signal'] = np.nansum(values, axis=1)
+    qc['Missing_Z'] = robust_z(qc['Missing_Ratio'])
+    qc['Signal_Z'] = robust_z(np.log10(qc['Total_Signal'].where(qc['Total_Signal'] > 0)))
+
+    t2, dmodx, t2_limit, dmodx_limit, n_components = pca_distances(data)
+    qc['Hotelling_T2'] = t2
+    qc['DModX'] = dmodx
+
+    flags = {
+        'missingness': qc['Missing_Z'] > ROBUST_Z_CUTOFF,
+        'total_signal': qc['Signal_Z'].abs() > ROBUST_Z_CUTOFF,
+        'hotelling_t2': qc['Hotelling_T2'] > t2_limit,
+        'dmodx': qc['DModX'] > dmodx_limit,
+    }
+    flag_matrix = np.column_stack([flag.to_numpy() for flag in flags.values()])
+    names = np.array(list(flags))
+    qc['Flags'] = [';'.join(names[row]) for row in flag_matrix]
+    qc['Outlier'] = flag_matrix.any(axis=1)
+
+    if report_file:
+        qc.rename_axis('Sample').to_csv(report_file)
+
+    print(f"QC PCA model: {n_components} components "
+          f"(T2 limit {t2_limit:.2f}, DModX limit {dmodx_limit:.2f})")
+    print(f"Outlier samples: {int(qc['Outlier'].sum())}/{len(qc)}")
+    for sample, reason in qc.loc[qc['Outlier'], 'Flags'].head(10).items():
+        print(f"  {sample}: {reason}")
+    if report_file:
+        print(f"Sample QC saved to {report_file}")
+    return qc
+
+
+def exclude_outliers(data, qc, exclude=QC_EXCLUDE_OUTLIERS):
+    """Samples passed on to the differential analysis"""
+    if not exclude or not qc['Outlier'].any():
+        return data
+    print(f"Excluding {int(qc['Outlier'].sum())} outlier sample(s) from differential analysis")
+    return data.loc[~qc['Outlier'].reindex(data.index, fill_value=False)]
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Feature-Sharded Execution
+Runs the per-metabolite t-tests and the block-pair correlations as
+independent tasks on a pluggable backend: an in-process loop, a local
+process pool, or Dask / Ray clusters when those packages are installed.
+Each task only receives the metabolite columns it needs, and the shard
+results are merged into the usual differential_analysis_results.csv and
+high_correlations.csv.
+Usage: python sharding.py [data.csv] [backend] [workers]
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from bootstrap import bootstrap_fold_change_ci
+from correlation_network import (center_columns, block_pairs, block_pair_edges,
+                                 edges_to_adjacency, BLOCK_SIZE)
+from incremental import batch_moments, moment_ttests
+
+try:
+    from dask.distributed import Client, LocalCluster
+except ImportError:
+    Client = None
+
+try:
+    import ray
+except ImportError:
+    ray = None
+
+# 'serial', 'multiprocessing', 'dask' or 'ray'
+SHARD_BACKEND = 'multiprocessing'
+# Workers of the local pool / cluster; None uses every core
+N_WORKERS = None
+# Metabolite columns per differential shard
+SHARD_SIZE = 2000
+# Scheduler of an existing cluster (e.g. 'tcp://host:8786' or 'ray://host:10001');
+# None starts a local one
+CLUSTER_ADDRESS = None
+
+
+def run_serial(func, tasks, n_workers=None):
+    """Run the tasks one after another in this process"""
+    return [func(task) for task in tasks]
+
+
+def run_multiprocessing(func, tasks, n_workers=None):
+    """Run the tasks in a local process pool"""
+    n_workers = min(n_workers or os.cpu_count() or 1, len(tasks))
+    if n_workers <= 1:
+        return run_serial(func, tasks)
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(func, tasks))
+
+
+def run_dask(func, tasks, n_workers=None):
+    """Run the tasks on a Dask cluster (a LocalCluster unless CLUSTER_ADDRESS is set)"""
+    if Client is None:
+        raise ImportError("dask.distributed is required for the 'dask' backend")
+    if CLUSTER_ADDRESS:
+        client = Client(CLUSTER_ADDRESS)
+    else:
+        client = Client(LocalCluster(n_workers=n_workers, threads_per_worker=1))
+    with client:
+        return client.gather(client.map(func, tasks, pure=False))
+
+
+def run_ray(func, tasks, n_workers=None):
+    """Run the tasks as Ray remote functions (local Ray unless CLUSTER_ADDRESS is set)"""
+    if ray is None:
+        raise ImportError("ray is required for the 'ray' backend")
+    if not ray.is_initialized():
+        ray.init(address=CLUSTER_ADDRESS, num_cpus=None if CLUSTER_ADDRESS else n_workers)
+    remote = ray.remote(func)
+    return ray.get([remote.remote(task) for task in tasks])
+
+
+# Backend name -> runner(func, tasks, n_workers) returning results in task order;
+# register other schedulers here
+BACKENDS = {
+    'serial': run_serial,
+    'multiprocessing': run_multiprocessing,
+    'dask': run_dask,
+    'ray': run_ray,
+}
+
+
+def run_tasks(func, tasks, backend=SHARD_BACKEND, n_workers=N_WORKERS):
+    """Map a module-level function over the tasks on the chosen backend"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    if not tasks:
+        return []
+    return BACKENDS[backend](func, tasks, n_workers)
+
+
+def shard_columns(n_features, shard_size=SHARD_SIZE):
+    """Contiguous column ranges of at most shard_size metabolites"""
+    return [(start, min(start + shard_size, n_features))
+            for start in range(0, n_features, shard_size)]
+
+
+def _differential_shard(task):
+    """t-tests and bootstrap fold-change CIs of one metabolite shard"""
+    names, normal_values, fasting_values = task
+    moments = [batch_moments(normal_values), batch_moments(fasting_values)]
+    counts, means, m2s = (np.vstack(part) for part in zip(*moments))
+    results = moment_ttests(names, counts, means, m2s)
+    # Same seed in every shard: the resample draws match the unsharded run
+    tested = np.isin(names, results['Metabolite'])
+    ci_lower, ci_upper = bootstrap_fold_change_ci(normal_values[:, tested],
+                                                  fasting_values[:, tested], n_jobs=1)
+    results['FC_CI_Lower'] = ci_lower
+    results['FC_CI_Upper'] = ci_upper
+    return results
+
+
+def sharded_ttests(data, normal_samples, fasting_samples, backend=SHARD_BACKEND,
+                   n_workers=N_WORKERS, shard_size=SHARD_SIZE):
+    """differential_analysis table with metabolite shards run on the backend"""
+    normal_values = data.loc[normal_samples].to_numpy(dtype=np.float64)
+    fasting_values = data.loc[fasting_samples].to_numpy(dtype=np.float64)
+    names = np.asarray(data.columns, dtype=object)
+    tasks = [(names[start:stop], normal_values[:, start:stop], fasting_values[:, start:stop])
+             for start, stop in shard_columns(data.shape[1], shard_size)]
+    print(f"{len(tasks)} metabolite shard(s) on the {backend} backend")
+    shards = run_tasks(_differential_shard, tasks, backend, n_workers)
+    if not shards:
+        return pd.DataFrame()
+    return pd.concat(shards, ignore_index=True)
+
+
+def _correlation_task(task):
+    """Edges of one correlation block pair"""
+    return block_pair_edges(*task)
+
+
+def sharded_threshold_correlations(data, threshold=0.7, backend=SHARD_BACKEND,
+                                   n_workers=N_WORKERS, block_size=BLOCK_SIZE):
+    """threshold_correlations with every block pair scheduled as a task"""
+    values, mask = center_columns(data)
+    pairs = block_pairs(values.shape[1], block_size)
+    tasks = [(values[:, start_i:stop_i], mask[:, start_i:stop_i],
+              values[:, start_j:stop_j], mask[:, start_j:stop_j],
+              start_i, start_j, threshold)
+             for start_i, stop_i, start_j, stop_j in pairs]
+    print(f"{len(tasks)} correlation block pair(s) on the {backend} backend")
+    return edges_to_adjacency(run_tasks(_correlation_task, tasks, backend, n_workers),
+                              values.shape[1])
+
+
+def main():
+    """python sharding.py [data.csv] [backend] [workers]"""
+    from metabolomics_analysis import load_data, preprocess_data, filter_features
+    from metabolomics_analysis import correlation_analysis, differential_analysis
+
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'fasting.csv'
+    backend = sys.argv[2] if len(sys.argv) > 2 else SHARD_BACKEND
+    n_workers = int(sys.argv[3]) if len(sys.argv) > 3 else N_WORKERS
+    data = load_data(filename)
+    if data is None:
+        return
+    numeric_data, _ = filter_features(preprocess_data(data))
+    correlation_analysis(numeric_data, backend=backend, n_workers=n_workers)
+    differential_analysis(numeric_data, backend=backend, n_workers=n_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Shared Statistics Helpers
+Small vectorized helpers used by several analysis stages.
+"""
+
+import numpy as np
+
+# Variances below this fraction of the mean square are rounding noise of
+# constant values and count as zero
+VARIANCE_EPS = 1e-10
+
+
+def adjust_pvalues_bh(p_values):
+    """Benjamini-Hochberg FDR adjustment; NaN p-values stay NaN"""
+    p_values = np.asarray(p_values, dtype=np.float64)
+    adjusted = np.full(p_values.shape, np.nan)
+    valid = ~np.isnan(p_values)
+    p = p_values[valid]
+    if len(p) == 0:
+        return adjusted
+    order = np.argsort(p)
+    ranked = p[order] * len(p) / np.arange(1, len(p) + 1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    result = np.empty(len(p))
+    result[order] = np.minimum(ranked, 1.0)
+    adjusted[valid] = result
+    return adjusted
+
+
+def bh_rejections(p_values, fdr=0.05):
+    """Benjamini-Hochberg rejections along the last axis (e.g. one row per simulation)
+
+    Same decisions as adjust_pvalues_bh(p) <= fdr row by row; NaN p-values
+    are not counted and never rejected.
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    n_tests = np.sum(~np.isnan(p_values), axis=-1, keepdims=True)
+    ordered = np.sort(p_values, axis=-1)
+    ranks = np.arange(1, p_values.shape[-1] + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        below = ordered <= fdr * ranks / n_tests
+    # Largest p-value under its BH line; everything up to it is rejected
+    last_below = p_values.shape[-1] - np.argmax(below[..., ::-1], axis=-1)
+    n_rejected = np.where(below.any(axis=-1), last_below, 0)
+    cutoff = np.take_along_axis(ordered, np.maximum(n_rejected - 1, 0)[..., None], axis=-1)
+    return (p_values <= cutoff) & (n_rejected[..., None] > 0)
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+from classifiers import build_folds, classification_analysis, nested_cv
+
+
+def small_cohort(n_normal, n_fasting, n_metabolites=6, seed=0):
+    rng = np.random.default_rng(seed)
+    index = [f'Normal_{i}' for i in range(n_normal)] + [f'Fasting_{i}' for i in range(n_fasting)]
+    values = rng.normal(size=(len(index), n_metabolites))
+    values[n_normal:] += 2
+    return pd.DataFrame(values, index=index, columns=[f'M{j}' for j in range(n_metabolites)])
+
+
+def test_build_folds_skips_inner_search_for_single_minority_sample():
+    labels = np.array([0, 0, 1, 1, 1, 1])
+    values = np.random.default_rng(0).normal(size=(6, 4))
+    folds = build_folds(values, labels, n_outer=2)
+    assert all(fold['inner'] == [] for fold in folds)
+    predictions, chosen = nested_cv('PLS-DA', [labels], folds)[0]
+    assert len(predictions) == 6
+    assert chosen == [2, 2]
+
+
+def test_two_vs_four_design_is_rejected_without_error(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert classification_analysis(small_cohort(2, 4), n_perm=2, n_jobs=1) is None
+    assert not (tmp_path / 'classifier_performance.csv').exists()
+
+
+def test_three_vs_four_design_runs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    performance, importance = classification_analysis(small_cohort(3, 4), n_perm=2, n_jobs=1)
+    assert len(performance) == 3
+    assert len(importance) == 6
@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+from linear_models import linear_model_analysis
+
+
+def test_constant_within_groups_gives_nan_statistics():
+    rng = np.random.default_rng(0)
+    index = [f'Normal_{i}' for i in range(5)] + [f'Fasting_{i}' for i in range(5)]
+    data = pd.DataFrame({
+        'Constant': [2e-5] * 5 + [7e-5] * 5,
+        'Small': rng.normal(5e-5, 1e-5, 10),
+        'Other': rng.normal(1.0, 0.2, 10),
+        'Third': rng.normal(3.0, 0.5, 10),
+    }, index=index)
+    results = linear_model_analysis(data, output_file=None).set_index('Metabolite')
+
+    assert np.isnan(results.loc['Constant', 'T_Statistic'])
+    assert np.isnan(results.loc['Constant', 'P_Value'])
+    assert np.isfinite(results.loc['Small', 'P_Value'])
+    plain = linear_model_analysis(data, moderated=False, output_file=None).set_index('Metabolite')
+    expected = stats.ttest_ind(data['Small'][:5], data['Small'][5:]).pvalue
+    assert np.isclose(plain.loc['Small', 'P_Value'], expected)
+
+
+def test_moderated_p_values_are_invariant_to_rescaling_metabolites():
+    rng = np.random.default_rng(1)
+    index = [f'Normal_{i}' for i in range(6)] + [f'Fasting_{i}' for i in range(6)]
+    values = rng.lognormal(size=(12, 30)) + np.r_[np.zeros(6), np.full(6, 0.5)][:, None]
+    data = pd.DataFrame(values, index=index, columns=[f'M{j}' for j in range(30)])
+    scaled = data * 10.0 ** rng.integers(-6, 4, size=30)
+
+    plain = linear_model_analysis(data, output_file=None).set_index('Metabolite')
+    rescaled = linear_model_analysis(scaled, output_file=None).set_index('Metabolite')
+    assert np.allclose(plain['P_Value'], rescaled.loc[plain.index, 'P_Value'], rtol=1e-8)
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+from sample_qc import robust_z, sample_qc, ROBUST_Z_CUTOFF
+
+
+def test_robust_z_with_zero_mad_still_scores_deviating_value():
+    z = robust_z([0.0] * 9 + [0.8])
+    assert z[-1] > ROBUST_Z_CUTOFF
+    assert np.all(z[:-1] == 0)
+
+
+def test_robust_z_of_constant_values_is_zero():
+    assert np.all(robust_z([0.2] * 5) == 0)
+
+
+def test_heavily_missing_sample_is_flagged():
+    rng = np.random.default_rng(0)
+    values = rng.lognormal(size=(10, 50))
+    values[-1, :40] = np.nan
+    data = pd.DataFrame(values, index=[f'Sample_{i}' for i in range(10)])
+    qc = sample_qc(data, report_file=None)
+    assert qc['Missing_Z'].iloc[-1] > ROBUST_Z_CUTOFF
+    assert 'missingness' in qc['Flags'].iloc[-1]
+    assert not any('missingness' in flags for flags in qc['Flags'].iloc[:-1])
@@ -7,9 +7,33 @@ Claude GitHub Actions基本機能でのメタボロミクス解析テスト
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+import os
+import sys
 import warnings
 warnings.filterwarnings('ignore')
 
+# 解析モジュール（250905/）を読み込めるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '250905'))
+from bootstrap import bootstrap_fold_change_ci
+from annotation import annotate_metabolites, class_members
+
+# 化合物クラス（annotation.py）→ レポート表示名
+CATEGORY_LABELS = {
+    'Amino acid': 'アミノ酸',
+    'Amino acid derivative': 'アミノ酸誘導体',
+    'Peptide': 'ペプチド',
+    'Central carbon metabolism': 'エネルギー代謝',
+    'Nucleotide': 'ヌクレオチド',
+    'Nucleoside/base': 'ヌクレオシド・塩基',
+    'Organic acid': '有機酸',
+    'Lipid metabolism': '脂質代謝',
+    'Cofactor/vitamin': '補酵素・ビタミン',
+    'Amine/polyamine': 'アミン・ポリアミン',
+    'Neurotransmitter': '神経伝達物質',
+    'Antioxidant': '抗酸化物質',
+    'Xenobiotic': '外因性物質',
+}
+
 def basic_metabolomics_analysis():
     """基本機能のみでの包括的メタボロミクス解析"""
     
@@ -42,22 +66,23 @@ def basic_metabolomics_analysis():
     print("\n4. 代謝物質カテゴリー分析")
     metabolites = data.columns.tolist()
     
-    categories = {
-        'アミノ酸': ['Ala', 'Arg', 'Asn', 'Asp', 'Cys', 'Gln', 'Glu', 'Gly', 'His', 'Ile', 'Leu', 'Lys', 'Met', 'Phe', 'Pro', 'Ser', 'Thr', 'Trp', 'Tyr', 'Val'],
-        'エネルギー代謝': ['ATP', 'ADP', 'AMP', 'GTP', 'GDP', 'GMP', 'UTP', 'UDP', 'UMP', 'glucose', 'pyruvic', 'citric', 'fumaric', 'succinic', 'malic'],
-        '脂質代謝': ['Carnitine', 'Choline', 'Betaine', 'CoA'],
-        '神経伝達物質': ['Serotonin', 'GABA', 'Histamine'],
-        '抗酸化物質': ['Glutathione', 'Ascorbic', 'Taurine']
-    }
+    # オフライン代謝物質辞書（250905/metabolite_annotations.csv）で分類
+    annotations = annotate_metabolites(metabolites)
+    members = class_members(annotations)
     
     found_metabolites = {}
-    for category, markers in categories.items():
-        found = [m for m in metabolites if any(marker in m for marker in markers)]
-        found_metabolites[category] = found
-        print(f"{category}: {len(found)} 種類")
+    for compound_class, label in CATEGORY_LABELS.items():
+        found = members.get(compound_class, [])
+        if not found:
+            continue
+        found_metabolites[label] = found
+        print(f"{label}: {len(found)} 種類")
         if found[:3]: 
             print(f"  例: {[m[:25]+'...' if len(m)>25 else m for m in found[:3]]}")
     
+    unclassified = int(annotations['Class'].isnull().sum())
+    print(f"未分類: {unclassified} 種類")
+    
     # 5. 基本統計解析
     print("\n5. 基本統計解析")
     data_stats = numeric_data.describe()
@@ -96,11 +121,21 @@ def basic_metabolomics_analysis():
     
     significant_metabolites.sort(key=lambda x: x['p_value'])
     
+    # 倍率変化のブートストラップ95%信頼区間（全代謝物質を一括計算）
+    if significant_metabolites:
+        sig_names = [m['metabolite'] for m in significant_metabolites]
+        ci_lower, ci_upper = bootstrap_fold_change_ci(
+            numeric_data.loc[normal_samples, sig_names].to_numpy(),
+            numeric_data.loc[fasting_samples, sig_names].to_numpy())
+        for met, lower, upper in zip(significant_metabolites, ci_lower, ci_upper):
+            met['fc_ci'] = (lower, upper)
+    
     print(f"有意差のある代謝物質: {len(significant_metabolites)} 種類 (p<0.05)")
     print("TOP5 有意差のある代謝物質:")
     for i, met in enumerate(significant_metabolites[:5], 1):
         name = met['metabolite'][:30] + '...' if len(met['metabolite']) > 30 else met['metabolite']
-        print(f"  {i}. {name} (p={met['p_value']:.3e}, FC={met['fold_change']:.2f})")
+        lower, upper = met['fc_ci']
+        print(f"  {i}. {name} (p={met['p_value']:.3e}, FC={met['fold_change']:.2f} [95%CI {lower:.2f}-{upper:.2f}])")
     
     # 7. 簡易相関解析
     print("\n7. 相関解析")